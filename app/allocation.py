@@ -0,0 +1,300 @@
+"""
+Batch allocation of terreni from ranked unit preferences.
+
+During the submission period units store ranked wishes (tag, day, time window,
+duration) as `Preferenza` rows instead of racing each other for bookings. The
+admin then runs the allocation, which assigns at most one slot per unit:
+
+1. Greedy, in rounds by rank: every unit (in a seeded random order, so nobody is
+   always first) gets its first wish if any matching terreno has room, then the
+   still-unplaced units try their second wish, and so on. Within a wish the
+   placement that packs tightest against existing bookings is chosen, keeping
+   long free runs for the units that follow.
+2. Local improvement: a unit that got a worse wish may take a slot from a single
+   other unit if that unit can move to a slot it likes at least as much; a unit
+   that got nothing may do so as long as the other unit still gets one of its
+   wishes. Repeated until nothing improves.
+
+Occupancy is tracked as one bitmap per (terreno, day), one bit per 15-minute
+slot as in app/availability.py, so every fit test is a couple of integer
+operations. The result is written with one bulk INSERT under the reservation
+writer lock, and the satisfied preferences are consumed.
+"""
+
+import random
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from app.availability import SLOT_MINUTES, SLOTS_PER_DAY, Reservation, days_spanned, get_reservation_index, slot_mask
+from app.booking import begin_serialized
+from app.models import Preferenza, Prenotazione, Terreno, TerrenoCategoria
+from app.writer import writer_lock
+
+SLOTS_PER_HOUR = 60 // SLOT_MINUTES
+MAX_IMPROVEMENT_PASSES = 10
+
+
+@dataclass(frozen=True)
+class Wish:
+    unita_id: int
+    rank: int
+    tag: str
+    day: date
+    earliest_hour: int
+    latest_hour: int
+    duration: int
+
+
+@dataclass(frozen=True)
+class Placement:
+    unita_id: int
+    terreno_id: int
+    day: date
+    first_slot: int
+    slots: int
+    choice: int  # Position of the satisfied wish in the unit's ranked list (0 = first choice)
+
+    @property
+    def mask(self) -> int:
+        return ((1 << self.slots) - 1) << self.first_slot
+
+    @property
+    def start(self) -> datetime:
+        return datetime.combine(self.day, time()) + timedelta(minutes=self.first_slot * SLOT_MINUTES)
+
+    @property
+    def end(self) -> datetime:
+        return self.start + timedelta(minutes=self.slots * SLOT_MINUTES)
+
+
+@dataclass
+class AllocationResult:
+    placements: list[Placement] = field(default_factory=list)
+    unplaced: list[int] = field(default_factory=list)  # Units with wishes that could not be satisfied
+
+
+class Allocator:
+    """
+    Solver state: fixed occupancy (existing reservations) plus the placements made so far.
+
+    `terreni` maps terreno id to its tags; `fixed` and `busy` map (terreno_id, day) and
+    (unita_id, day) to the occupancy bitmaps of reservations that already exist.
+    """
+
+    def __init__(
+        self,
+        terreni: dict[int, frozenset[str]],
+        fixed: dict[tuple[int, date], int] | None = None,
+        busy: dict[tuple[int, date], int] | None = None,
+        seed: int | None = None,
+    ):
+        self.terreni = terreni
+        self.fixed = dict(fixed or {})
+        self.busy = defaultdict(int, busy or {})
+        self.random = random.Random(seed)
+        self.occupied: dict[tuple[int, date], int] = defaultdict(int, self.fixed)
+        self.placed: dict[int, Placement] = {}
+        self.by_slot: dict[tuple[int, date], list[Placement]] = defaultdict(list)
+        self._candidates: dict[Wish, list[tuple[int, int]]] = {}
+
+    # --- Occupancy bookkeeping ---
+
+    def _place(self, p: Placement):
+        self.placed[p.unita_id] = p
+        self.occupied[(p.terreno_id, p.day)] |= p.mask
+        self.busy[(p.unita_id, p.day)] |= p.mask
+        self.by_slot[(p.terreno_id, p.day)].append(p)
+
+    def _unplace(self, p: Placement):
+        del self.placed[p.unita_id]
+        self.occupied[(p.terreno_id, p.day)] &= ~p.mask
+        self.busy[(p.unita_id, p.day)] &= ~p.mask
+        self.by_slot[(p.terreno_id, p.day)].remove(p)
+
+    def candidates(self, wish: Wish) -> list[tuple[int, int]]:
+        """(terreno_id, first_slot) pairs that satisfy the wish on an empty camp."""
+        cached = self._candidates.get(wish)
+        if cached is None:
+            slots = wish.duration * SLOTS_PER_HOUR
+            first = wish.earliest_hour * SLOTS_PER_HOUR
+            last = min(wish.latest_hour * SLOTS_PER_HOUR, SLOTS_PER_DAY) - slots
+            cached = [
+                (terreno_id, start)
+                for terreno_id, tags in sorted(self.terreni.items())
+                if wish.tag in tags
+                for start in range(first, last + 1)
+            ]
+            self._candidates[wish] = cached
+        return cached
+
+    def _best_fit(self, wish: Wish, choice: int) -> Placement | None:
+        """Free placement for the wish packing tightest against occupied slots, earliest first on ties."""
+        slots = wish.duration * SLOTS_PER_HOUR
+        mask = (1 << slots) - 1
+        unit_busy = self.busy[(wish.unita_id, wish.day)]
+        best, best_score = None, -1
+        for terreno_id, first in self.candidates(wish):
+            window = mask << first
+            occupied = self.occupied[(terreno_id, wish.day)]
+            if occupied & window or unit_busy & window:
+                continue
+            # Occupied (or day-boundary) neighbours of the window: higher means less fragmentation
+            before = first == 0 or (occupied >> (first - 1)) & 1
+            after = first + slots == SLOTS_PER_DAY or (occupied >> (first + slots)) & 1
+            score = bool(before) + bool(after)
+            if score > best_score:
+                best = Placement(wish.unita_id, terreno_id, wish.day, first, slots, choice)
+                best_score = score
+                if score == 2:
+                    break
+        return best
+
+    # --- Solver ---
+
+    def solve(self, wishes: list[Wish]) -> AllocationResult:
+        ranked: dict[int, list[Wish]] = defaultdict(list)
+        for wish in sorted(wishes, key=lambda w: (w.unita_id, w.rank)):
+            ranked[wish.unita_id].append(wish)
+        order = sorted(ranked)
+        self.random.shuffle(order)
+
+        # 1. Greedy rounds: everybody's first choice before anybody's second
+        for choice in range(max((len(w) for w in ranked.values()), default=0)):
+            for unita_id in order:
+                if unita_id in self.placed or choice >= len(ranked[unita_id]):
+                    continue
+                placement = self._best_fit(ranked[unita_id][choice], choice)
+                if placement is not None:
+                    self._place(placement)
+
+        # 2. Local improvement: single displacements placing more units, or improving one and worsening nobody
+        for _ in range(MAX_IMPROVEMENT_PASSES):
+            improved = [self._improve(unita_id, ranked) for unita_id in order]
+            if not any(improved):
+                break
+
+        return AllocationResult(
+            placements=sorted(self.placed.values(), key=lambda p: (p.day, p.terreno_id, p.first_slot)),
+            unplaced=sorted(u for u in ranked if u not in self.placed),
+        )
+
+    def _improve(self, unita_id: int, ranked: dict[int, list[Wish]]) -> bool:
+        current = self.placed.get(unita_id)
+        limit = current.choice if current is not None else len(ranked[unita_id])
+        for choice, wish in enumerate(ranked[unita_id][:limit]):
+            slots = wish.duration * SLOTS_PER_HOUR
+            for terreno_id, first in self.candidates(wish):
+                target = Placement(unita_id, terreno_id, wish.day, first, slots, choice)
+                if self.fixed.get((terreno_id, wish.day), 0) & target.mask:
+                    continue
+                blockers = [p for p in self.by_slot[(terreno_id, wish.day)] if p.mask & target.mask]
+                if len(blockers) > 1 or any(p.unita_id == unita_id for p in blockers):
+                    continue
+                if current is not None:
+                    self._unplace(current)
+                if self.busy[(unita_id, wish.day)] & target.mask:
+                    if current is not None:
+                        self._place(current)
+                    continue
+
+                if not blockers:
+                    self._place(target)
+                    return True
+
+                # Move the single blocker to a slot it likes at least as much, or to any of its
+                # wishes if that gets an unplaced unit in (more units placed beats better ranks)
+                blocker = blockers[0]
+                allowed = blocker.choice + 1 if current is not None else len(ranked[blocker.unita_id])
+                self._unplace(blocker)
+                self._place(target)
+                for alt_choice, alt_wish in enumerate(ranked[blocker.unita_id][:allowed]):
+                    moved = self._best_fit(alt_wish, alt_choice)
+                    if moved is not None:
+                        self._place(moved)
+                        return True
+                # No room for the blocker: undo
+                self._unplace(target)
+                self._place(blocker)
+                if current is not None:
+                    self._place(current)
+        return False
+
+
+def _occupancy(reservations: list[Reservation]) -> tuple[dict[tuple[int, date], int], dict[tuple[int, date], int]]:
+    fixed: dict[tuple[int, date], int] = defaultdict(int)
+    busy: dict[tuple[int, date], int] = defaultdict(int)
+    for r in reservations:
+        for day in days_spanned(r.start, r.end):
+            mask = slot_mask(day, r.start, r.end)
+            fixed[(r.terreno_id, day)] |= mask
+            busy[(r.unita_id, day)] |= mask
+    return fixed, busy
+
+
+def allocate(db: Session, seed: int | None = None) -> AllocationResult:
+    """
+    Allocate every stored preference, insert the resulting reservations in bulk and
+    delete the preferences of the units that got a slot.
+    """
+    with writer_lock:
+        try:
+            terreni = begin_serialized(db, [terreno_id for (terreno_id,) in db.query(Terreno.id)])
+            wishes = [
+                Wish(p.unita_id, p.rank, p.tag, p.day, p.earliest_hour, p.latest_hour, p.duration)
+                for p in db.query(Preferenza)
+            ]
+            if not wishes:
+                db.rollback()
+                return AllocationResult()
+
+            # Existing reservations on the requested days, read inside the locked transaction
+            first_day = datetime.combine(min(w.day for w in wishes), time())
+            last_day = datetime.combine(max(w.day for w in wishes), time()) + timedelta(days=1)
+            existing = [
+                Reservation(p.id, p.terreno_id, p.unita_id, p.start_time, p.end_time, p.status)
+                for p in db.query(Prenotazione).filter(
+                    Prenotazione.start_time < last_day, Prenotazione.end_time > first_day
+                )
+            ]
+            fixed, busy = _occupancy(existing)
+            tags = {t.id: frozenset(TerrenoCategoria.split(t.tags)) for t in terreni.values()}
+            result = Allocator(tags, fixed, busy, seed).solve(wishes)
+
+            inserted: list[Prenotazione] = []
+            if result.placements:
+                inserted = list(
+                    db.scalars(
+                        insert(Prenotazione).returning(Prenotazione),
+                        [
+                            {
+                                "terreno_id": p.terreno_id,
+                                "unita_id": p.unita_id,
+                                "start_time": p.start,
+                                "end_time": p.end,
+                                "duration": p.slots // SLOTS_PER_HOUR,
+                                "status": "PENDING",
+                            }
+                            for p in result.placements
+                        ],
+                    )
+                )
+                db.query(Preferenza).filter(Preferenza.unita_id.in_([p.unita_id for p in result.placements])).delete(
+                    synchronize_session=False
+                )
+            new_reservations = [
+                Reservation(p.id, p.terreno_id, p.unita_id, p.start_time, p.end_time, p.status) for p in inserted
+            ]
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+
+    # Bulk inserts bypass the flush hooks that keep the reservation index in sync
+    index = get_reservation_index(db)
+    for r in new_reservations:
+        index.upsert(r)
+    return result
@@ -1,9 +1,31 @@
+"""
+Cookie JWT authentication.
+
+The token carries everything the routes need to know about the user (id, role,
+unità) so an authenticated request costs no user query. Decoded tokens are kept
+in a bounded TTL/LRU cache, which saves the signature check as well. Each user
+has a token_version, bumped on every flush that changes their password, role or
+unità. The version is signed into the token and compared with the current one
+on every request, so a changed user's tokens are refused at once. Current
+versions are read from the database once per user and process, and kept up to
+date by the commit hooks below. A change made by another process (a script on
+the same database) is only seen after a restart. The app runs as a single
+uvicorn process.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from weakref import WeakKeyDictionary
 
 from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
 from app.database import get_db
@@ -13,6 +35,8 @@ from app.models import User
 SECRET_KEY = "CHANGE_THIS_IN_PRODUCTION_SECRET_KEY"  # In prod use env var
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 1 week
+TOKEN_CACHE_SIZE = 4096
+TOKEN_CACHE_TTL_SECONDS = 300
 
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -32,8 +56,119 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
+@dataclass(frozen=True)
+class AuthenticatedUser:
+    """The user as described by their token claims; what the route dependencies hand out."""
+
+    id: int
+    username: str
+    role: str  # 'unit', 'tech', 'admin'
+    unita_id: int | None
+
+
+@dataclass(frozen=True)
+class _DecodedToken:
+    user: AuthenticatedUser
+    version: int
+    expires_at: float  # Monotonic time after which the entry is decoded again
+
+
+def token_claims(user) -> dict:
+    """Claims of a User, or of a row with the same columns."""
+    return {
+        "sub": user.username,
+        "uid": user.id,
+        "role": user.role,
+        "unita_id": user.unita_id,
+        "ver": user.token_version,
+    }
+
+
+class TokenCache:
+    """Bounded LRU of decoded tokens, each kept at most ttl seconds and never past its own expiry."""
+
+    def __init__(self, size: int = TOKEN_CACHE_SIZE, ttl: float = TOKEN_CACHE_TTL_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, _DecodedToken] = OrderedDict()
+
+    def get(self, token: str) -> _DecodedToken | None:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.monotonic():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return entry
+
+    def decode(self, token: str) -> _DecodedToken | None:
+        """Verified claims of the token, None when it is invalid, expired or lacks the claims."""
+        entry = self.get(token)
+        if entry is not None:
+            return entry
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            user = AuthenticatedUser(payload["uid"], payload["sub"], payload["role"], payload["unita_id"])
+            version = int(payload["ver"])
+        except (JWTError, KeyError, TypeError, ValueError):
+            return None  # Tokens issued before the claims existed included: log in again
+        ttl = min(self.ttl, payload["exp"] - time.time())
+        entry = _DecodedToken(user, version, time.monotonic() + ttl)
+        with self._lock:
+            self._entries[token] = entry
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache()
+
+
+class TokenVersions:
+    """Current token_version of each user seen so far, None for users that no longer exist."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions: dict[int, int | None] = {}
+
+    def current(self, db: Session, user_id: int) -> int | None:
+        with self._lock:
+            if user_id in self._versions:
+                return self._versions[user_id]
+        version = db.query(User.token_version).filter(User.id == user_id).scalar()
+        with self._lock:
+            # A commit may have recorded a newer version meanwhile
+            return self._versions.setdefault(user_id, version)
+
+    def update(self, versions: dict[int, int | None]):
+        with self._lock:
+            self._versions.update(versions)
+
+
+_versions: WeakKeyDictionary[Engine, TokenVersions] = WeakKeyDictionary()
+_registry_lock = threading.Lock()
+
+
+def get_token_versions(db: Session) -> TokenVersions:
+    engine = db.get_bind().engine
+    with _registry_lock:
+        versions = _versions.get(engine)
+        if versions is None:
+            versions = TokenVersions()
+            _versions[engine] = versions
+        return versions
+
+
 # Dependency to get current user from cookie
-def get_current_user(request: Request, db: Session = Depends(get_db)):
+def get_current_user(request: Request, db: Session = Depends(get_db)) -> AuthenticatedUser | None:
     token = request.cookies.get("access_token")
     if not token:
         # If no token, return None (allow public access to some pages if we wanted,
@@ -45,22 +180,19 @@ def get_current_user(request: Request, db: Session = Depends(get_db)):
     if token.startswith("Bearer "):
         token = token.split(" ")[1]
 
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str | None = payload.get("sub")
-        if username is None:
-            return None
-    except JWTError:
+    decoded = token_cache.decode(token)
+    if decoded is None:
         return None
-
-    user = db.query(User).filter(User.username == username).first()
-    return user
+    # Issued before a password, role or unità change (or the user is gone)
+    if decoded.version != get_token_versions(db).current(db, decoded.user.id):
+        return None
+    return decoded.user
 
 
 # --- Role Dependencies ---
 
 
-def get_authenticated_user(user: User | None = Depends(get_current_user)):
+def get_authenticated_user(user: AuthenticatedUser | None = Depends(get_current_user)):
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -70,7 +202,7 @@ def get_authenticated_user(user: User | None = Depends(get_current_user)):
     return user
 
 
-def get_unit_user(user: User = Depends(get_authenticated_user)):
+def get_unit_user(user: AuthenticatedUser = Depends(get_authenticated_user)):
     # Unit user or higher (Tech, Admin)
     # Actually, unit pages are accessible to everyone logged in?
     # The requirement says "These users will get access to the public area".
@@ -78,13 +210,55 @@ def get_unit_user(user: User = Depends(get_authenticated_user)):
     return user
 
 
-def get_tech_user(user: User = Depends(get_authenticated_user)):
+def get_tech_user(user: AuthenticatedUser = Depends(get_authenticated_user)):
     if user.role not in ["tech", "admin"]:
         raise HTTPException(status_code=403, detail="Not enough privileges")
     return user
 
 
-def get_admin_user(user: User = Depends(get_authenticated_user)):
+def get_admin_user(user: AuthenticatedUser = Depends(get_authenticated_user)):
     if user.role != "admin":
         raise HTTPException(status_code=403, detail="Not enough privileges")
     return user
+
+
+# --- Session event hooks ---
+
+_PENDING_KEY = "token_versions_pending"
+_REVOKING_ATTRIBUTES = ("password_hash", "role", "unita_id")
+
+
+@event.listens_for(Session, "before_flush")
+def _bump_token_versions(session: Session, flush_context, instances):
+    for obj in session.dirty:
+        if not isinstance(obj, User):
+            continue
+        state = inspect(obj)
+        if any(state.attrs[name].history.has_changes() for name in _REVOKING_ATTRIBUTES):
+            obj.token_version = (obj.token_version or 0) + 1
+
+
+@event.listens_for(Session, "after_flush")
+def _record_token_versions(session: Session, flush_context):
+    changed: dict[int, int | None] = {
+        obj.id: obj.token_version for obj in (*session.new, *session.dirty) if isinstance(obj, User)
+    }
+    changed.update({obj.id: None for obj in session.deleted if isinstance(obj, User)})
+    if changed:
+        session.info.setdefault(_PENDING_KEY, {}).update(changed)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_token_versions(session: Session):
+    changed = session.info.pop(_PENDING_KEY, None)
+    if not changed:
+        return
+    with _registry_lock:
+        versions = _versions.get(session.get_bind().engine)
+    if versions is not None:
+        versions.update(changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_token_versions(session: Session):
+    session.info.pop(_PENDING_KEY, None)
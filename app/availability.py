@@ -0,0 +1,412 @@
+"""
+In-memory interval index of reservations per terreno.
+
+Answers the questions the reservation map and booking checks keep asking
+(what overlaps this window, how much of it is covered, when is the next free
+gap) without scanning the prenotazioni table. Like the ranking index it is
+built once per database engine and kept in sync by SQLAlchemy session events,
+so every committed reservation write or delete (including deleting a terreno)
+is reflected immediately.
+
+Each terreno also keeps one occupancy bitmap per day (an int, one bit per
+15-minute slot), so the FREE/PARTIAL/BOOKED status of a window is a couple of
+bitwise operations per day instead of a loop over reservations.
+
+Every change also bumps a reservation version and is kept in a bounded change
+log, so clients holding a copy can ask for what changed since their version
+instead of refetching everything.
+"""
+
+import bisect
+import math
+import sys
+import threading
+import time as clock
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.models import Prenotazione, Terreno, Unita
+
+_PENDING_KEY = "availability_pending"
+
+CHANGE_LOG_SIZE = 10_000
+
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+_SLOT_SECONDS = SLOT_MINUTES * 60
+
+
+@dataclass(frozen=True)
+class Reservation:
+    id: int
+    terreno_id: int
+    unita_id: int
+    start: datetime
+    end: datetime
+    status: str
+
+
+def _start(r: Reservation) -> datetime:
+    return r.start
+
+
+def _is_aligned(dt: datetime) -> bool:
+    return dt.second == 0 and dt.microsecond == 0 and dt.minute % SLOT_MINUTES == 0
+
+
+def days_spanned(start: datetime, end: datetime) -> list[date]:
+    """Calendar days touched by [start, end)."""
+    if end <= start:
+        return []
+    last = (end - timedelta(microseconds=1)).date()
+    return [start.date() + timedelta(days=i) for i in range((last - start.date()).days + 1)]
+
+
+def slot_range(day: date, start: datetime, end: datetime) -> tuple[int, int]:
+    """First and one-past-last slot of the day intersecting [start, end); empty if first >= last."""
+    day_start = datetime.combine(day, time())
+    lo = max(start, day_start)
+    hi = min(end, day_start + timedelta(days=1))
+    if hi <= lo:
+        return 0, 0
+    first = int((lo - day_start).total_seconds() // _SLOT_SECONDS)
+    last = math.ceil((hi - day_start).total_seconds() / _SLOT_SECONDS)
+    return first, last
+
+
+def slot_mask(day: date, start: datetime, end: datetime) -> int:
+    """Bitmask of the day's slots intersecting [start, end), bit i being the slot starting at i * SLOT_MINUTES."""
+    first, last = slot_range(day, start, end)
+    if first >= last:
+        return 0
+    return ((1 << last) - 1) ^ ((1 << first) - 1)
+
+
+class TerrenoIntervals:
+    """
+    Reservations of one terreno sorted by start time.
+
+    Overlap queries bisect on the start time and only look back as far as the
+    longest reservation ever stored, so they cost O(log n + k).
+    """
+
+    def __init__(self):
+        self.items: list[Reservation] = []
+        self.max_length = timedelta(0)
+        self.days: dict[date, int] = {}  # Occupancy bitmap per day
+        self.unaligned = 0  # Reservations not on slot boundaries, the bitmaps are approximate for those
+
+    def add(self, r: Reservation):
+        bisect.insort(self.items, r, key=_start)
+        self.max_length = max(self.max_length, r.end - r.start)
+        if not (_is_aligned(r.start) and _is_aligned(r.end)):
+            self.unaligned += 1
+        for day in days_spanned(r.start, r.end):
+            self.days[day] = self.days.get(day, 0) | slot_mask(day, r.start, r.end)
+
+    def remove(self, r: Reservation):
+        i = bisect.bisect_left(self.items, r.start, key=_start)
+        while i < len(self.items) and self.items[i].start == r.start:
+            if self.items[i].id == r.id:
+                del self.items[i]
+                break
+            i += 1
+        else:
+            return
+        if not (_is_aligned(r.start) and _is_aligned(r.end)):
+            self.unaligned -= 1
+        # Other reservations may share slots with the removed one: rebuild the touched days
+        for day in days_spanned(r.start, r.end):
+            day_start = datetime.combine(day, time())
+            day_end = day_start + timedelta(days=1)
+            mask = 0
+            for other in self.overlapping(day_start, day_end):
+                mask |= slot_mask(day, other.start, other.end)
+            if mask:
+                self.days[day] = mask
+            else:
+                self.days.pop(day, None)
+
+    def overlapping(self, start: datetime, end: datetime) -> list[Reservation]:
+        # Overlap logic: (StartA < EndB) and (EndA > StartB)
+        lo = bisect.bisect_left(self.items, start - self.max_length, key=_start)
+        hi = bisect.bisect_left(self.items, end, key=_start)
+        return [r for r in self.items[lo:hi] if r.end > start]
+
+    def bitmap_status(self, start: datetime, end: datetime) -> str:
+        """FREE, PARTIAL or BOOKED from the occupancy bitmaps (exact for slot-aligned windows)."""
+        any_free = any_booked = False
+        for day in days_spanned(start, end):
+            window = slot_mask(day, start, end)
+            occupied = self.days.get(day, 0) & window
+            any_booked = any_booked or occupied != 0
+            any_free = any_free or occupied != window
+        if not any_booked:
+            return "FREE"
+        return "PARTIAL" if any_free else "BOOKED"
+
+    def covered_seconds(self, start: datetime, end: datetime) -> float:
+        """Seconds of [start, end) covered by at least one reservation (overlapping bookings count once)."""
+        covered = 0.0
+        cursor = start
+        for r in self.overlapping(start, end):
+            segment_start = max(r.start, cursor)
+            segment_end = min(r.end, end)
+            if segment_end > segment_start:
+                covered += (segment_end - segment_start).total_seconds()
+                cursor = segment_end
+        return covered
+
+    def next_free_gap(self, after: datetime, duration: timedelta, until: datetime | None = None) -> datetime | None:
+        """Earliest start >= after where [start, start + duration) is free, or None if it would end past until."""
+        candidate = after
+        lo = bisect.bisect_left(self.items, after - self.max_length, key=_start)
+        for r in self.items[lo:]:
+            if r.start >= candidate + duration:
+                break
+            if r.end > candidate:
+                candidate = r.end
+        if until is not None and candidate + duration > until:
+            return None
+        return candidate
+
+
+class ReservationIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._terreni: dict[int, TerrenoIntervals] = {}
+        self._by_id: dict[int, Reservation] = {}
+        self._unit_names: dict[int, str] = {}
+        # Versions start from the build time in ms, so they keep increasing across restarts
+        self.version = int(clock.time() * 1000)
+        self._log_floor = self.version  # Changes after this version are all in the log
+        self._log: deque[tuple[int, int]] = deque()  # (version, reservation id)
+
+    @classmethod
+    def from_session(cls, db: Session) -> "ReservationIndex":
+        index = cls()
+        for unita_id, name in db.query(Unita.id, Unita.name):
+            index.set_unit_name(unita_id, name)
+        for p in db.query(Prenotazione).all():
+            index.upsert(Reservation(p.id, p.terreno_id, p.unita_id, p.start_time, p.end_time, p.status))
+        # The initial load is not a change: clients start from a full fetch
+        index._log.clear()
+        index._log_floor = index.version
+        return index
+
+    # --- Writes ---
+
+    def _log_change(self, reservation_id: int):
+        self.version += 1
+        self._log.append((self.version, reservation_id))
+        if len(self._log) > CHANGE_LOG_SIZE:
+            self._log_floor = self._log.popleft()[0]
+
+    def upsert(self, r: Reservation):
+        with self._lock:
+            if self._by_id.get(r.id) == r:
+                return
+            self._discard(r.id)
+            self._by_id[r.id] = r
+            self._terreni.setdefault(r.terreno_id, TerrenoIntervals()).add(r)
+            self._log_change(r.id)
+
+    def _discard(self, reservation_id: int) -> bool:
+        old = self._by_id.pop(reservation_id, None)
+        if old is None:
+            return False
+        self._terreni[old.terreno_id].remove(old)
+        return True
+
+    def remove(self, reservation_id: int):
+        with self._lock:
+            if self._discard(reservation_id):
+                self._log_change(reservation_id)
+
+    def drop_terreno(self, terreno_id: int):
+        with self._lock:
+            intervals = self._terreni.pop(terreno_id, None)
+            if intervals is not None:
+                for r in intervals.items:
+                    self._by_id.pop(r.id, None)
+                    self._log_change(r.id)
+
+    def set_unit_name(self, unita_id: int, name: str):
+        with self._lock:
+            renamed = self._unit_names.get(unita_id, name) != name
+            self._unit_names[unita_id] = name
+            if renamed:
+                # Clients show the unit name on each reservation
+                for r in sorted(self._by_id.values(), key=lambda r: r.id):
+                    if r.unita_id == unita_id:
+                        self._log_change(r.id)
+
+    # --- Reads ---
+
+    def changes_since(self, since: int) -> tuple[int, list[Reservation], list[int]] | None:
+        """
+        (current version, reservations inserted or updated, ids deleted) after `since`,
+        or None if the log no longer reaches back that far (the client must resync).
+        """
+        with self._lock:
+            if since < self._log_floor or since > self.version:
+                return None
+            changed = (
+                {rid for version, rid in reversed(self._log) if version > since} if since < self.version else set()
+            )
+            upserts = sorted((self._by_id[rid] for rid in changed if rid in self._by_id), key=lambda r: r.id)
+            deleted = sorted(rid for rid in changed if rid not in self._by_id)
+            return self.version, upserts, deleted
+
+    def unit_name(self, unita_id: int) -> str:
+        return self._unit_names.get(unita_id, "")
+
+    def overlapping(self, terreno_id: int, start: datetime, end: datetime) -> list[Reservation]:
+        with self._lock:
+            intervals = self._terreni.get(terreno_id)
+            return intervals.overlapping(start, end) if intervals else []
+
+    def covered_seconds(self, terreno_id: int, start: datetime, end: datetime) -> float:
+        with self._lock:
+            intervals = self._terreni.get(terreno_id)
+            return intervals.covered_seconds(start, end) if intervals else 0.0
+
+    def status(self, terreno_id: int, start: datetime, end: datetime) -> str:
+        """FREE, PARTIAL or BOOKED for the window."""
+        with self._lock:
+            intervals = self._terreni.get(terreno_id)
+            if intervals is None or end <= start:
+                return "FREE"
+            if intervals.unaligned == 0 and _is_aligned(start) and _is_aligned(end):
+                return intervals.bitmap_status(start, end)
+
+            # Off-grid window or reservations: fall back to exact coverage
+            covered = intervals.covered_seconds(start, end)
+            if covered <= 0:
+                return "FREE"
+            if covered >= (end - start).total_seconds():
+                return "BOOKED"
+            return "PARTIAL"
+
+    def day_masks(self, terreno_id: int, days: list[date]) -> list[int]:
+        """Occupancy bitmap of each day (slots touched by any reservation are set)."""
+        with self._lock:
+            intervals = self._terreni.get(terreno_id)
+            if intervals is None:
+                return [0] * len(days)
+            return [intervals.days.get(day, 0) for day in days]
+
+    def grid(self, terreno_id: int, first_day: date, days: int) -> tuple[list[int], list[bytes], list[int]]:
+        """
+        Occupancy of a terreno over consecutive days, one row per day.
+
+        Returns the per-day bitmaps, the per-day owner rows (one little-endian uint16 per slot,
+        0 when free, otherwise 1 + the position of the unit in the returned unit-id list) and that
+        unit-id list. Two bytes per slot: a month-long window can hold more than 255 units.
+        """
+        with self._lock:
+            intervals = self._terreni.get(terreno_id)
+            all_days = [first_day + timedelta(days=i) for i in range(days)]
+            if intervals is None:
+                return [0] * days, [bytes(2 * SLOTS_PER_DAY)] * days, []
+
+            masks = [intervals.days.get(day, 0) for day in all_days]
+            owners = [array("H", [0]) * SLOTS_PER_DAY for _ in all_days]
+            unit_ids: list[int] = []
+            positions: dict[int, int] = {}
+
+            window_start = datetime.combine(first_day, time())
+            for r in intervals.overlapping(window_start, window_start + timedelta(days=days)):
+                if r.unita_id not in positions:
+                    unit_ids.append(r.unita_id)
+                    positions[r.unita_id] = len(unit_ids)
+                for row, day in zip(owners, all_days, strict=True):
+                    first, last = slot_range(day, r.start, r.end)
+                    row[first:last] = array("H", [positions[r.unita_id]]) * max(0, last - first)
+            return masks, [_little_endian(row) for row in owners], unit_ids
+
+    def next_free_gap(
+        self, terreno_id: int, after: datetime, duration: timedelta, until: datetime | None = None
+    ) -> datetime | None:
+        with self._lock:
+            intervals = self._terreni.get(terreno_id)
+            if intervals is None:
+                return after if until is None or after + duration <= until else None
+            return intervals.next_free_gap(after, duration, until)
+
+
+def _little_endian(row: array) -> bytes:
+    if sys.byteorder == "big":
+        row = array(row.typecode, row)
+        row.byteswap()
+    return row.tobytes()
+
+
+# --- Registry (one index per database engine) ---
+
+_indexes: WeakKeyDictionary[Engine, ReservationIndex] = WeakKeyDictionary()
+_registry_lock = threading.Lock()
+
+
+def get_reservation_index(db: Session) -> ReservationIndex:
+    """Return the reservation index for the session's database, building it on first use."""
+    engine = db.get_bind().engine
+    with _registry_lock:
+        index = _indexes.get(engine)
+        if index is None:
+            index = ReservationIndex.from_session(db)
+            _indexes[engine] = index
+        return index
+
+
+# --- Session event hooks ---
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_reservation_changes(session: Session, flush_context):
+    pending = session.info.setdefault(_PENDING_KEY, {})
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Prenotazione):
+            pending[(Prenotazione, obj.id)] = Reservation(
+                obj.id, obj.terreno_id, obj.unita_id, obj.start_time, obj.end_time, obj.status
+            )
+        elif isinstance(obj, Unita):
+            pending[(Unita, obj.id)] = obj.name
+    for obj in session.deleted:
+        if isinstance(obj, Prenotazione | Terreno):
+            pending[(type(obj), obj.id)] = None
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_reservation_changes(session: Session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    with _registry_lock:
+        index = _indexes.get(session.get_bind().engine)
+        if index is None:
+            return
+        for (model, obj_id), value in pending.items():
+            if model is Unita:
+                index.set_unit_name(obj_id, value)
+            elif model is Prenotazione:
+                if value is None:
+                    index.remove(obj_id)
+                else:
+                    index.upsert(value)
+        # Reservations of a deleted terreno are bulk-deleted and never reach the flush
+        for (model, obj_id), value in pending.items():
+            if model is Terreno and value is None:
+                index.drop_terreno(obj_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_reservation_changes(session: Session):
+    session.info.pop(_PENDING_KEY, None)
@@ -0,0 +1,130 @@
+"""
+Conflict-checked reservation booking.
+
+When the booking window opens every unit hits the popular terreni in the same
+minute, so the check "is this window still free" and the insert must not
+interleave. Bookings go through a single serialized writer: a process-wide lock
+plus `BEGIN IMMEDIATE` on SQLite (the database write lock is taken before the
+conflict probe, so other processes wait instead of racing) or `SELECT ... FOR
+UPDATE` on the terreno row elsewhere. The probe itself is an index range scan on
+ix_prenotazioni_terreno_window.
+
+Requests that are already known to conflict are rejected by `check_booking`
+from the in-memory reservation index, before queuing for the lock.
+`apply_booking` is the serialized part: the route commits it through
+app/writer.py, alone or in a group.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import Session
+
+from app.availability import SLOT_MINUTES, get_reservation_index
+from app.models import Prenotazione, Terreno, Unita
+from app.writer import Rejection, begin_write
+
+MIN_DURATION_HOURS = 1
+MAX_DURATION_HOURS = 4
+
+
+class BookingConflict(Rejection):
+    """A booking that cannot be made; `reason` is a stable code for clients."""
+
+    def __init__(self, reason: str, message: str, conflicting: Prenotazione | None = None):
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+        # Captured now: the session is rolled back before the caller reports it
+        self.conflict = (
+            {
+                "id": conflicting.id,
+                "terreno_id": conflicting.terreno_id,
+                "unita_id": conflicting.unita_id,
+                "start": conflicting.start_time.isoformat(),
+                "end": conflicting.end_time.isoformat(),
+                "status": conflicting.status,
+            }
+            if conflicting is not None
+            else None
+        )
+
+    @property
+    def status_code(self) -> int:
+        if self.reason.startswith("invalid_"):
+            return 400
+        if self.reason.endswith("_not_found"):
+            return 404
+        return 409
+
+    def to_dict(self) -> dict:
+        detail: dict = {"reason": self.reason, "message": self.message}
+        if self.conflict is not None:
+            detail["conflict"] = self.conflict
+        return detail
+
+
+def _validate(start: datetime, duration: int):
+    if not MIN_DURATION_HOURS <= duration <= MAX_DURATION_HOURS:
+        raise BookingConflict(
+            "invalid_duration", f"La durata deve essere tra {MIN_DURATION_HOURS} e {MAX_DURATION_HOURS} ore"
+        )
+    if start.second or start.microsecond or start.minute % SLOT_MINUTES:
+        raise BookingConflict("invalid_start", f"L'inizio deve cadere su un multiplo di {SLOT_MINUTES} minuti")
+
+
+def begin_serialized(db: Session, terreno_ids: list[int]) -> dict[int, Terreno]:
+    """
+    Take the database write lock (SQLite) or lock the terreno rows, and return the
+    terreni found by id. Call with writer_lock held.
+    """
+    begin_write(db)
+    query = db.query(Terreno).filter(Terreno.id.in_(terreno_ids))
+    if db.get_bind().dialect.name != "sqlite":
+        query = query.with_for_update()
+    return {t.id: t for t in query}
+
+
+def _probe(db: Session, start: datetime, end: datetime, terreno_id: int | None = None, unita_id: int | None = None):
+    # Overlap logic: (StartA < EndB) and (EndA > StartB)
+    query = db.query(Prenotazione).filter(Prenotazione.start_time < end, Prenotazione.end_time > start)
+    if terreno_id is not None:
+        query = query.filter(Prenotazione.terreno_id == terreno_id)
+    if unita_id is not None:
+        query = query.filter(Prenotazione.unita_id == unita_id)
+    return query.order_by(Prenotazione.start_time).first()
+
+
+def check_booking(db: Session, terreno_id: int, start: datetime, duration: int):
+    """The lock-free checks of a booking: raises BookingConflict for invalid or already known conflicting requests."""
+    _validate(start, duration)
+    end = start + timedelta(hours=duration)
+
+    # Rush-hour fast path: the in-memory index spots most conflicts, confirmed by a lock-free probe.
+    # Only the probe inside the serialized transaction (apply_booking) is authoritative.
+    if get_reservation_index(db).overlapping(terreno_id, start, end):
+        known = _probe(db, start, end, terreno_id=terreno_id)
+        if known is not None:
+            raise BookingConflict("terreno_booked", "Il terreno è già prenotato in questo orario", known)
+
+
+def apply_booking(db: Session, terreno_id: int, unita_id: int, start: datetime, duration: int) -> Prenotazione:
+    """Probe and insert inside the caller's serialized transaction (writer_lock held), without committing."""
+    end = start + timedelta(hours=duration)
+    if terreno_id not in begin_serialized(db, [terreno_id]):
+        raise BookingConflict("terreno_not_found", "Terreno non trovato")
+    if db.get(Unita, unita_id) is None:
+        raise BookingConflict("unita_not_found", "Unità non trovata")
+
+    conflicting = _probe(db, start, end, terreno_id=terreno_id)
+    if conflicting is not None:
+        raise BookingConflict("terreno_booked", "Il terreno è già prenotato in questo orario", conflicting)
+    conflicting = _probe(db, start, end, unita_id=unita_id)
+    if conflicting is not None:
+        raise BookingConflict("unita_busy", "L'unità ha già un'altra prenotazione in questo orario", conflicting)
+
+    prenotazione = Prenotazione(
+        terreno_id=terreno_id, unita_id=unita_id, start_time=start, end_time=end, duration=duration
+    )
+    db.add(prenotazione)
+    db.flush()
+    return prenotazione
@@ -0,0 +1,348 @@
+"""
+Completion write path.
+
+Two tech users can enter the same result at the same moment (or one taps twice
+on a slow connection). Completions are unique per (pattuglia, challenge) in the
+database, the row goes in with `INSERT ... ON CONFLICT DO NOTHING` and the score
+is bumped in SQL with `current_score = current_score + :points`, both in one
+short transaction: no duplicate rows and no lost score updates, whatever the
+interleaving.
+
+Batches (the offline queue of /input) take the database write lock up front
+and go in with one multi-row INSERT and one grouped UPDATE of the scores. Each
+entry may carry a client idempotency key: keys are stored with their outcome, so
+a batch resent after a lost response is answered without applying it twice.
+
+These statements bypass the flush hooks, so the score changes and live events
+they cause are kept in `session.info` and handed to the ranking index and the
+event bus by this module's own after_commit hook (dropped on rollback). The
+`apply_*` functions write without committing, for the group-commit writer of
+app/writer.py; `register_*` and `rollback_completion` commit on their own.
+"""
+
+import csv
+import io
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, delete, event, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, joinedload
+
+from app.events import bus, completion_event
+from app.models import Challenge, Completion, CompletionKey, Pattuglia
+from app.ranking import apply_scores
+from app.writer import Rejection, commit_alone
+
+_PENDING_KEY = "completions_pending"
+
+# Client clocks ahead of the server by more than this are not trusted
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+
+
+class CompletionRejected(Rejection):
+    """A completion that was not registered; `reason` is the code shown by /input."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+@dataclass(frozen=True)
+class Registered:
+    completion_id: int
+    timestamp: datetime
+    score: int  # Score of the pattuglia right after this completion
+
+
+@dataclass(frozen=True)
+class Entry:
+    pattuglia_id: int
+    challenge_id: int
+    timestamp: datetime | None = None  # When it was entered (naive UTC), now if unknown
+    key: str | None = None  # Client idempotency key
+
+
+@dataclass(frozen=True)
+class Outcome:
+    status: str  # ok, already_completed, not_found
+    completion_id: int | None = None
+    replayed: bool = False  # The key was seen before: this is the outcome stored back then
+
+
+@dataclass(frozen=True)
+class SheetRow:
+    line: int
+    text: str
+    entry: Entry | None  # None if the row could not be read
+    error: str | None = None  # invalid_row, unknown_pattuglia, unknown_challenge
+
+
+def parse_sheet(text: str, pattuglie: dict[str, int], challenges: dict[str, int]) -> list[SheetRow]:
+    """
+    Rows of a pasted score sheet, "pattuglia,sfida" per line (`;` and tabs work too,
+    as exported by spreadsheets). Names are matched case-insensitively against the
+    given name -> id maps; a header line that matches nothing is skipped.
+    """
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return []
+    try:
+        dialect = csv.Sniffer().sniff(lines[0], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    pattuglie = {name.strip().casefold(): pid for name, pid in pattuglie.items()}
+    challenges = {name.strip().casefold(): cid for name, cid in challenges.items()}
+
+    rows = []
+    first = True
+    for line_no, fields in enumerate(csv.reader(io.StringIO(text), dialect), start=1):
+        raw = ", ".join(fields).strip()
+        if not raw.strip(", "):
+            continue
+        header, first = first, False
+        if len(fields) < 2:
+            rows.append(SheetRow(line_no, raw, None, "invalid_row"))
+            continue
+        pattuglia_id = pattuglie.get(fields[0].strip().casefold())
+        challenge_id = challenges.get(fields[1].strip().casefold())
+        if header and pattuglia_id is None and challenge_id is None:
+            continue  # Header
+        if pattuglia_id is None:
+            rows.append(SheetRow(line_no, raw, None, "unknown_pattuglia"))
+        elif challenge_id is None:
+            rows.append(SheetRow(line_no, raw, None, "unknown_challenge"))
+        else:
+            rows.append(SheetRow(line_no, raw, Entry(pattuglia_id, challenge_id)))
+    return rows
+
+
+def _insert(db: Session):
+    return postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+
+
+def _pending(db: Session) -> dict:
+    return db.info.setdefault(_PENDING_KEY, {"scores": {}, "deltas": defaultdict(int), "events": []})
+
+
+def _record(db: Session, pattuglia_id: int, score: int, delta: int, live_events: list[dict]):
+    """Score change and live events to publish once the transaction commits."""
+    pending = _pending(db)
+    pending["scores"][pattuglia_id] = score
+    pending["deltas"][pattuglia_id] += delta
+    _record_events(db, live_events)
+
+
+def _record_events(db: Session, live_events: list[dict]):
+    _pending(db)["events"].extend(live_events)
+
+
+def apply_completion(db: Session, pattuglia_id: int, challenge_id: int) -> Registered:
+    """Insert the completion and add its points inside the caller's transaction, or raise CompletionRejected."""
+    pattuglia = db.get(Pattuglia, pattuglia_id)
+    challenge = db.get(Challenge, challenge_id)
+    if pattuglia is None or challenge is None:
+        raise CompletionRejected("not_found")
+
+    inserted = db.execute(
+        _insert(db)(Completion)
+        .values(pattuglia_id=pattuglia_id, challenge_id=challenge_id, timestamp=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=[Completion.pattuglia_id, Completion.challenge_id])
+        .returning(Completion.id, Completion.timestamp)
+    ).first()
+    if inserted is None:
+        raise CompletionRejected("already_completed")
+    score = db.execute(
+        update(Pattuglia)
+        .where(Pattuglia.id == pattuglia_id)
+        .values(current_score=Pattuglia.current_score + challenge.points)
+        .returning(Pattuglia.current_score)
+    ).scalar_one()
+    _record(
+        db,
+        pattuglia_id,
+        score,
+        challenge.points,
+        [completion_event(inserted.id, inserted.timestamp, pattuglia, challenge)],
+    )
+    return Registered(inserted.id, inserted.timestamp, score)
+
+
+def register_completion(db: Session, pattuglia_id: int, challenge_id: int) -> Registered:
+    """Record that the pattuglia completed the challenge and add its points, or raise CompletionRejected."""
+    return commit_alone(db, lambda session: apply_completion(session, pattuglia_id, challenge_id))
+
+
+def apply_rollback(db: Session, completion_id: int) -> bool:
+    """Delete the completion and take its points back inside the caller's transaction; False if it does not exist."""
+    removed = db.execute(
+        delete(Completion)
+        .where(Completion.id == completion_id)
+        .returning(Completion.pattuglia_id, Completion.challenge_id)
+    ).first()
+    if removed is None:
+        return False
+    challenge = db.get(Challenge, removed.challenge_id)
+    points = challenge.points if challenge is not None else 0  # Its challenge deleted from under it: nothing to take
+    score = db.execute(
+        update(Pattuglia)
+        .where(Pattuglia.id == removed.pattuglia_id)
+        .values(current_score=Pattuglia.current_score - points)
+        .returning(Pattuglia.current_score)
+    ).scalar_one()
+    _record(db, removed.pattuglia_id, score, -points, [{"type": "completion_removed", "id": completion_id}])
+    return True
+
+
+def rollback_completion(db: Session, completion_id: int) -> bool:
+    """Cancel a completion and its points (admin correction)."""
+    return commit_alone(db, lambda session: apply_rollback(session, completion_id))
+
+
+def apply_points_change(db: Session, challenge_id: int, diff: int):
+    """Add diff to the score of every pattuglia that completed the challenge, inside the caller's transaction."""
+    # The unique (pattuglia, challenge) index means one completion per pattuglia
+    completed = select(Completion.pattuglia_id).where(Completion.challenge_id == challenge_id)
+    scores = db.execute(
+        update(Pattuglia)
+        .where(Pattuglia.id.in_(completed))
+        .values(current_score=Pattuglia.current_score + diff)
+        .returning(Pattuglia.id, Pattuglia.current_score)
+        .execution_options(synchronize_session=False)
+    ).all()
+    for pattuglia_id, score in scores:
+        _record(db, pattuglia_id, score, diff, [])
+
+
+def _apply_batch(db: Session, entries: list[Entry]) -> list[Outcome]:
+    """The batch inside the caller's transaction: one multi-row INSERT and one grouped UPDATE."""
+    now = datetime.utcnow()
+    keys = {e.key for e in entries if e.key}
+    pattuglia_ids = {e.pattuglia_id for e in entries}
+    challenge_ids = {e.challenge_id for e in entries}
+    seen = {k.key: k for k in db.query(CompletionKey).filter(CompletionKey.key.in_(keys))} if keys else {}
+    pattuglie = {
+        p.id: p
+        for p in db.query(Pattuglia).options(joinedload(Pattuglia.unita)).filter(Pattuglia.id.in_(pattuglia_ids))
+    }
+    challenges = {c.id: c for c in db.query(Challenge).filter(Challenge.id.in_(challenge_ids))}
+    registered = {
+        (pattuglia_id, challenge_id)
+        for pattuglia_id, challenge_id in db.query(Completion.pattuglia_id, Completion.challenge_id).filter(
+            Completion.pattuglia_id.in_(pattuglia_ids), Completion.challenge_id.in_(challenge_ids)
+        )
+    }
+
+    outcomes: list[Outcome | None] = []
+    first_with_key: dict[str, int] = {}
+    replays: dict[int, int] = {}  # Entry repeating a key earlier in the batch -> that first entry
+    rows = []
+    for i, e in enumerate(entries):
+        if e.key in seen:
+            stored = seen[e.key]
+            outcomes.append(Outcome(stored.outcome, stored.completion_id, replayed=True))
+            continue
+        if e.key in first_with_key:
+            replays[i] = first_with_key[e.key]
+            outcomes.append(None)  # Resolved once the first entry with this key is
+            continue
+        if e.key:
+            first_with_key[e.key] = i
+        pair = (e.pattuglia_id, e.challenge_id)
+        if e.pattuglia_id not in pattuglie or e.challenge_id not in challenges:
+            outcomes.append(Outcome("not_found"))
+        elif pair in registered:
+            outcomes.append(Outcome("already_completed"))
+        else:
+            registered.add(pair)
+            timestamp = min(e.timestamp or now, now + MAX_CLOCK_SKEW)
+            rows.append({"pattuglia_id": e.pattuglia_id, "challenge_id": e.challenge_id, "timestamp": timestamp})
+            outcomes.append(None)
+
+    inserted = {}
+    if rows:
+        # A concurrent writer on another database may still win a pair: matched by pair, not position
+        result = db.execute(
+            _insert(db)(Completion)
+            .on_conflict_do_nothing(index_elements=[Completion.pattuglia_id, Completion.challenge_id])
+            .returning(Completion.id, Completion.pattuglia_id, Completion.challenge_id, Completion.timestamp),
+            rows,
+        )
+        inserted = {(r.pattuglia_id, r.challenge_id): r for r in result}
+
+    deltas: dict[int, int] = defaultdict(int)
+    live_events = []
+    for i, e in enumerate(entries):
+        if outcomes[i] is not None or i in replays:
+            continue
+        row = inserted.get((e.pattuglia_id, e.challenge_id))
+        if row is None:
+            outcomes[i] = Outcome("already_completed")
+            continue
+        outcomes[i] = Outcome("ok", row.id)
+        deltas[e.pattuglia_id] += challenges[e.challenge_id].points
+        live_events.append(
+            completion_event(row.id, row.timestamp, pattuglie[e.pattuglia_id], challenges[e.challenge_id])
+        )
+    for i, first in replays.items():
+        replayed = outcomes[first]
+        assert replayed is not None  # Only first entries were resolved above, all of them
+        outcomes[i] = Outcome(replayed.status, replayed.completion_id, replayed=True)
+    resolved = [outcome for outcome in outcomes if outcome is not None]
+    assert len(resolved) == len(entries)
+
+    scores: dict[int, int] = {}
+    if deltas:
+        scores = {
+            pattuglia_id: score
+            for pattuglia_id, score in db.execute(
+                update(Pattuglia)
+                .where(Pattuglia.id.in_(deltas))
+                .values(current_score=Pattuglia.current_score + case(deltas, value=Pattuglia.id, else_=0))
+                .returning(Pattuglia.id, Pattuglia.current_score)
+                .execution_options(synchronize_session=False)
+            )
+        }
+    new_keys = [
+        {"key": key, "outcome": resolved[i].status, "completion_id": resolved[i].completion_id, "received_at": now}
+        for key, i in first_with_key.items()
+    ]
+    if new_keys:
+        db.execute(insert(CompletionKey), new_keys)
+    for pattuglia_id, score in scores.items():
+        _record(db, pattuglia_id, score, deltas[pattuglia_id], [])
+    _record_events(db, live_events)
+    return resolved
+
+
+def register_batch(db: Session, entries: list[Entry]) -> list[Outcome]:
+    """
+    Register many completions in one transaction and return one Outcome per entry.
+
+    An entry repeating a (pattuglia, challenge) pair already registered, or earlier
+    in the batch, is already_completed; an entry whose key was synced before gets
+    the stored outcome back.
+    """
+    return commit_alone(db, lambda session: _apply_batch(session, entries))
+
+
+# --- Session event hooks ---
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_completion_changes(session: Session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    apply_scores(session, pending["scores"])
+    for pattuglia_id, score in pending["scores"].items():
+        if pending["deltas"][pattuglia_id] != 0:
+            bus.publish({"type": "score", "id": pattuglia_id, "score": score, "delta": pending["deltas"][pattuglia_id]})
+    for live_event in pending["events"]:
+        bus.publish(live_event)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_completion_changes(session: Session):
+    session.info.pop(_PENDING_KEY, None)
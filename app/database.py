@@ -1,19 +1,132 @@
+"""
+Engine, sessions and the request-scoped session dependencies.
+
+SQLAlchemy here is synchronous (pysqlite), so database work must stay off the
+event loop. Route handlers that only touch the database are plain `def`, and
+FastAPI runs them on its worker thread pool. Handlers that also await something
+(a password hash, a group commit) take `get_async_db` and run their queries
+through `await db.run(...)` on that same pool. DB_THREADS sizes the pool.
+A thread waiting for a pooled connection only holds a worker: it never holds
+the loop.
+
+All tuning comes from environment variables next to DATABASE_URL. DB_POOL_*
+sizes the connection pool. SQLITE_PROFILE picks the PRAGMAs set on every new
+SQLite connection from a connect-event hook, and SQLITE_<PRAGMA> overrides a
+single one of them. benchmarks/sqlite_profiles.py compares the profiles.
+"""
+
 import os
+from collections.abc import Callable
+from typing import Any
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+import anyio.to_thread
+from fastapi import Depends
+from sqlalchemy import create_engine, event, make_url
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, declarative_base, sessionmaker
+from starlette.concurrency import run_in_threadpool
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./camp.db")
+# PRAGMAs set on every new SQLite connection, see SQLITE_PROFILES; single PRAGMAs can be overridden below
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "wal-durable")
+# Connection pool of file databases; a thread waiting longer than the timeout gets an error
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Worker threads for database work: by default one per connection the pool can hand out
+DB_THREADS = int(os.getenv("DB_THREADS", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+
+SQLITE_PROFILES: dict[str, dict[str, str | int]] = {
+    # Driver defaults: rollback journal, readers and the writer lock each other out, an fsync per commit
+    "default": {},
+    # The default. Readers never wait for the writer nor it for them, and every commit is fsynced
+    # before it is answered, like with the rollback journal
+    "wal-durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,  # ms a writer waits for the lock before "database is locked"
+        "cache_size": -64000,  # Negative: KiB, per connection
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+    # Opt-in, for throwaway databases: synchronous=NORMAL fsyncs the WAL at checkpoints only, so a power
+    # cut can lose the last acknowledged commits (never corrupt the database)
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+}
+_PRAGMA_OVERRIDES = ("journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size", "temp_store")
+
+
+def sqlite_pragmas(profile: str = SQLITE_PROFILE) -> dict[str, str | int]:
+    """The PRAGMAs of the profile, with SQLITE_<PRAGMA> environment variables taking precedence."""
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Unknown SQLITE_PROFILE {profile!r}, expected one of {', '.join(SQLITE_PROFILES)}")
+    pragmas = dict(SQLITE_PROFILES[profile])
+    for name in _PRAGMA_OVERRIDES:
+        value = os.getenv(f"SQLITE_{name.upper()}")
+        if value:
+            pragmas[name] = value
+    return pragmas
+
+
+def create_app_engine(url: str = SQLALCHEMY_DATABASE_URL, profile: str = SQLITE_PROFILE) -> Engine:
+    """The engine with the configured pool, and for SQLite the profile's PRAGMAs on every new connection."""
+    database_url = make_url(url)
+    options = {}
+    if database_url.get_backend_name() != "sqlite" or database_url.database not in (None, "", ":memory:"):
+        options = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT}
+    if database_url.get_backend_name() != "sqlite":
+        return create_engine(url, **options)
+
+    new_engine = create_engine(url, connect_args={"check_same_thread": False}, **options)
+    pragmas = sqlite_pragmas(profile)
+
+    @event.listens_for(new_engine, "connect")
+    def _apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+    return new_engine
+
+
+engine = create_app_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
 
+def configure_thread_pool(threads: int = DB_THREADS):
+    """Size the worker pool of the running event loop (def handlers, sync dependencies, AsyncDB.run)."""
+    anyio.to_thread.current_default_thread_limiter().total_tokens = threads
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+class AsyncDB:
+    """The request's session, for async handlers: each piece of work is awaited on the worker thread pool."""
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    async def run(self, fn: Callable[..., Any], /, *args, **kwargs) -> Any:
+        """fn(session, *args, **kwargs) on a worker thread."""
+        return await run_in_threadpool(fn, self.session, *args, **kwargs)
+
+
+async def get_async_db(db: Session = Depends(get_db)) -> AsyncDB:
+    # Built on get_db: the session is opened and closed like the sync one (and tests override only get_db)
+    return AsyncDB(db)
@@ -0,0 +1,181 @@
+"""
+In-process pub/sub bus for live ranking and timeline updates.
+
+Committed writes are turned into compact events by SQLAlchemy session hooks and
+fanned out to every Server-Sent Events subscriber of this worker. Each subscriber
+has a small bounded queue: a client that cannot keep up is dropped, so one slow
+phone never makes the publisher block or buffer without bound. Its stream ends,
+the browser's EventSource reconnects, and the pages reload on any connection
+after their first to catch up on the events they missed.
+"""
+
+import asyncio
+import json
+import threading
+from datetime import datetime
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from app.models import Challenge, Completion, Pattuglia, Unita
+
+_PENDING_KEY = "live_events_pending"
+
+SUBSCRIBER_QUEUE_SIZE = 32
+KEEPALIVE_SECONDS = 15
+
+
+class Subscription:
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue[dict | None] = asyncio.Queue(maxsize=maxsize)
+        self.dropped = False
+
+    async def get(self) -> dict | None:
+        """Next event, or None once the subscription has been dropped."""
+        return await self.queue.get()
+
+
+class EventBus:
+    def __init__(self, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: set[Subscription] = set()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> Subscription:
+        """Must be called from the event loop that will consume the events."""
+        subscription = Subscription(self.queue_size)
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event: dict):
+        """Thread-safe: events published from a worker thread are handed over to the loop."""
+        with self._lock:
+            loop = self._loop
+            if loop is None or not self._subscribers:
+                return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._dispatch(event)
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(self._dispatch, event)
+
+    def _dispatch(self, event: dict):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._drop(subscription)
+
+    def _drop(self, subscription: Subscription):
+        self.unsubscribe(subscription)
+        subscription.dropped = True
+        # Make room for the end-of-stream marker; the client reloads everything on reconnect anyway
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
+
+
+bus = EventBus()
+
+
+def format_sse(event: dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event, separators=(',', ':'))}\n\n"
+
+
+# --- Session event hooks ---
+
+
+def completion_event(completion_id: int, timestamp: datetime, pattuglia: Pattuglia, challenge: Challenge) -> dict:
+    return {
+        "type": "completion",
+        "id": completion_id,
+        "pattuglia": pattuglia.name,
+        "sottocampo": pattuglia.unita.sottocampo,
+        "challenge": challenge.name,
+        "points": challenge.points,
+        "is_fungo": challenge.is_fungo,
+        "timestamp": timestamp.isoformat(),
+    }
+
+
+def _completion_event(session: Session, c: Completion) -> dict | None:
+    with session.no_autoflush:
+        # Relationships are not loaded on freshly inserted rows, go through the identity map
+        pattuglia = session.get(Pattuglia, c.pattuglia_id)
+        challenge = session.get(Challenge, c.challenge_id)
+        if pattuglia is None or challenge is None:
+            return None
+        return completion_event(c.id, c.timestamp, pattuglia, challenge)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_live_events(session: Session, flush_context):
+    if not bus.subscriber_count:
+        return
+    pending = session.info.setdefault(_PENDING_KEY, {"scores": {}, "events": [], "ranking_changed": False})
+
+    for obj in session.new:
+        if isinstance(obj, Completion):
+            completion_event = _completion_event(session, obj)
+            if completion_event is not None:
+                pending["events"].append(completion_event)
+        elif isinstance(obj, Pattuglia | Unita):
+            pending["ranking_changed"] = True
+
+    for obj in session.dirty:
+        if isinstance(obj, Pattuglia):
+            state = inspect(obj)
+            score = state.attrs.current_score.history
+            if score.added:
+                # The previous value is unknown if the attribute was never loaded before being set
+                delta = score.added[0] - score.deleted[0] if score.deleted else None
+                _, previous_delta = pending["scores"].get(obj.id, (None, 0))
+                if delta is not None and previous_delta is not None:
+                    delta += previous_delta
+                pending["scores"][obj.id] = (score.added[0], delta)
+            if any(state.attrs[name].history.has_changes() for name in ("name", "capo_pattuglia", "unita_id")):
+                pending["ranking_changed"] = True
+        elif isinstance(obj, Unita):
+            pending["ranking_changed"] = True
+
+    for obj in session.deleted:
+        if isinstance(obj, Completion):
+            pending["events"].append({"type": "completion_removed", "id": obj.id})
+        elif isinstance(obj, Pattuglia | Unita):
+            pending["ranking_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_live_events(session: Session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    for pattuglia_id, (score, delta) in pending["scores"].items():
+        if delta != 0:
+            bus.publish({"type": "score", "id": pattuglia_id, "score": score, "delta": delta})
+    for live_event in pending["events"]:
+        bus.publish(live_event)
+    if pending["ranking_changed"]:
+        # Rows added, removed or moved between units: not worth patching, clients reload
+        bus.publish({"type": "ranking_changed"})
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_live_events(session: Session):
+    session.info.pop(_PENDING_KEY, None)
@@ -0,0 +1,142 @@
+"""
+Static terreno geometry and metadata, served separately from availability.
+
+Polygons, descriptions, images and tags only change when an admin edits a
+terreno, so they are serialized once into a JSON payload versioned by its
+content hash. Clients fetch it with the hash in the URL and cache it for good;
+any committed terreno change drops the payload and the next request rebuilds it
+under a new hash.
+
+With a zoom level the polygons are sent as encoded polylines simplified for that
+zoom (see app/polyline.py) instead of the raw JSON coordinates.
+"""
+
+import hashlib
+import json
+import threading
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.models import Terreno
+from app.polyline import FULL
+
+_DIRTY_KEY = "geometry_dirty"
+
+
+class GeometryCatalog:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: list[dict] | None = None
+        self._encoded: dict[int, dict[str, str]] = {}
+        self._bodies: dict[str | None, bytes] = {}
+        self._version = ""
+
+    def _ensure(self, db: Session):
+        if self._entries is not None:
+            return
+        terreni = db.query(Terreno).order_by(Terreno.id).all()
+        self._entries = [
+            {
+                "id": t.id,
+                "name": t.name,
+                "tags": t.tags,
+                "polygon": t.polygon,
+                "center_lat": t.center_lat,
+                "center_lon": t.center_lon,
+                "description": t.description,
+                "image_urls": t.image_urls,
+            }
+            for t in terreni
+        ]
+        self._encoded = {t.id: json.loads(t.polygon_encoded) for t in terreni if t.polygon_encoded}
+        self._bodies = {None: json.dumps(self._entries, separators=(",", ":")).encode()}
+        # Variants are derived from the polygons, so one hash versions all of them
+        self._version = hashlib.sha256(self._bodies[None]).hexdigest()[:16]
+
+    def _render(self, level: str) -> bytes:
+        assert self._entries is not None
+        payload = []
+        for entry in self._entries:
+            variants = self._encoded.get(entry["id"])
+            if variants is None:
+                # Polygon that could not be encoded: ship it as stored
+                payload.append(entry)
+            else:
+                compact = {k: v for k, v in entry.items() if k != "polygon"}
+                compact["path"] = variants.get(level, variants[FULL])
+                payload.append(compact)
+        return json.dumps(payload, separators=(",", ":")).encode()
+
+    def payload(self, db: Session, level: str | None = None) -> tuple[bytes, str]:
+        """Serialized geometry (raw, or encoded at a zoom level) and the content hash."""
+        with self._lock:
+            self._ensure(db)
+            body = self._bodies.get(level)
+            if body is None:
+                assert level is not None  # The raw body is built along with the entries
+                body = self._bodies[level] = self._render(level)
+            return body, self._version
+
+    def version(self, db: Session) -> str:
+        return self.payload(db)[1]
+
+    def ids(self, db: Session) -> list[int]:
+        with self._lock:
+            self._ensure(db)
+            assert self._entries is not None
+            return [entry["id"] for entry in self._entries]
+
+    def terreni(self, db: Session) -> list[tuple[int, str, str]]:
+        """(id, name, comma-separated tags) of every terreno."""
+        with self._lock:
+            self._ensure(db)
+            assert self._entries is not None
+            return [(entry["id"], entry["name"], entry["tags"]) for entry in self._entries]
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+            self._bodies = {}
+
+
+# --- Registry (one catalog per database engine) ---
+
+_catalogs: WeakKeyDictionary[Engine, GeometryCatalog] = WeakKeyDictionary()
+_registry_lock = threading.Lock()
+
+
+def get_geometry_catalog(db: Session) -> GeometryCatalog:
+    engine = db.get_bind().engine
+    with _registry_lock:
+        catalog = _catalogs.get(engine)
+        if catalog is None:
+            catalog = GeometryCatalog()
+            _catalogs[engine] = catalog
+        return catalog
+
+
+# --- Session event hooks ---
+
+
+@event.listens_for(Session, "after_flush")
+def _mark_terreno_changes(session: Session, flush_context):
+    if any(isinstance(obj, Terreno) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info[_DIRTY_KEY] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_catalog(session: Session):
+    if not session.info.pop(_DIRTY_KEY, False):
+        return
+    with _registry_lock:
+        catalog = _catalogs.get(session.get_bind().engine)
+    if catalog is not None:
+        catalog.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_mark(session: Session):
+    session.info.pop(_DIRTY_KEY, None)
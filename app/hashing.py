@@ -0,0 +1,67 @@
+"""
+Password hashing off the event loop.
+
+An argon2 hash or verify burns tens of milliseconds of CPU. Called from an async
+handler, that blocks every other request for as long. Both now run on a small
+thread pool. argon2-cffi releases the GIL while hashing, so the threads really
+run in parallel, up to HASH_WORKERS at a time.
+
+Admission control: at most HASH_MAX_PENDING calls may be running or queued.
+Beyond that, a call fails at once with HashingBusy instead of queueing. The
+login storm at camp opening then gets "retry in a moment" answers, and never a
+backlog that times out.
+"""
+
+import asyncio
+import os
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from app.auth import pwd_context
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", "32"))
+RETRY_AFTER_SECONDS = 2
+
+
+class HashingBusy(Exception):
+    """Too many hashing calls in flight; the caller should answer 503 with Retry-After."""
+
+
+class HashPool:
+    def __init__(self, workers: int = HASH_WORKERS, max_pending: int = HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="argon2")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise HashingBusy()
+            self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self.run(pwd_context.hash, password)
+
+    async def verify_and_update(self, password: str, hashed: str) -> tuple[bool, str | None]:
+        """(valid, new hash). The new hash is set when the stored one uses outdated argon2 parameters."""
+        return await self.run(pwd_context.verify_and_update, password, hashed)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+hash_pool = HashPool()
@@ -1,4 +1,5 @@
 import os
+from contextlib import asynccontextmanager
 from datetime import timedelta
 
 from fastapi import Depends, FastAPI, Form, HTTPException, Request, status
@@ -7,15 +8,42 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 
-from app.auth import ACCESS_TOKEN_EXPIRE_MINUTES, create_access_token, verify_password
-from app.database import Base, engine, get_db
+from app.auth import ACCESS_TOKEN_EXPIRE_MINUTES, create_access_token, token_claims
+from app.availability import get_reservation_index
+from app.database import AsyncDB, configure_thread_pool, get_async_db, get_db
+from app.hashing import RETRY_AFTER_SECONDS, HashingBusy, hash_pool
+from app.migrations import upgrade_schema
 from app.models import User
+from app.ranking import get_ranking_index
 from app.routers import admin, public
+from app.writer import stop_writers
 
-# Create tables (if not using init_db)
-Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+def prepare_database(app: FastAPI):
+    """Bring the schema up to date and build the in-memory indexes, so the first visitor does not pay for them."""
+    # Through get_db, so a test's overridden database is prepared and camp.db is left alone
+    sessions = app.dependency_overrides.get(get_db, get_db)()
+    db = next(sessions)
+    try:
+        # Create tables and bring existing databases up to date (if not using init_db)
+        upgrade_schema(db.get_bind())
+        get_ranking_index(db)
+        get_reservation_index(db)
+        db.rollback()
+    finally:
+        sessions.close()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_thread_pool()
+    prepare_database(app)
+    yield
+    # Let the group-commit writers (GROUP_COMMIT=1) finish with the loop
+    await stop_writers()
+
+
+app = FastAPI(lifespan=lifespan)
 
 if not os.path.exists("app/static"):
     os.makedirs("app/static")
@@ -31,14 +59,48 @@ async def login_page(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
 
 
+def _login_user(db: Session, username: str):
+    user = (
+        db.query(User.id, User.username, User.password_hash, User.role, User.unita_id, User.token_version)
+        .filter(User.username == username)
+        .first()
+    )
+    # End the read transaction and give the pooled connection back while hashing:
+    # a login storm would otherwise hold every connection of the pool
+    db.rollback()
+    return user
+
+
+def _store_rehash(db: Session, user_id: int, password_hash: str):
+    # Same password under the current argon2 parameters. A bulk update skips the flush hook
+    # that bumps token_version: the user's other sessions stay valid
+    db.query(User).filter(User.id == user_id).update({"password_hash": password_hash}, synchronize_session=False)
+    db.commit()
+
+
 @app.post("/login")
-async def login(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == username).first()
-    if not user or not verify_password(password, user.password_hash):
+async def login(
+    request: Request, username: str = Form(...), password: str = Form(...), db: AsyncDB = Depends(get_async_db)
+):
+    user = await db.run(_login_user, username)
+    if not user:
+        return templates.TemplateResponse("login.html", {"request": request, "error": "Credenziali non valide"})
+    try:
+        valid, new_hash = await hash_pool.verify_and_update(password, user.password_hash)
+    except HashingBusy:
+        return templates.TemplateResponse(
+            "login.html",
+            {"request": request, "error": "Troppi accessi in questo momento, riprova tra qualche secondo"},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+    if not valid:
         return templates.TemplateResponse("login.html", {"request": request, "error": "Credenziali non valide"})
+    if new_hash:
+        await db.run(_store_rehash, user.id, new_hash)
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(data={"sub": user.username}, expires_delta=access_token_expires)
+    access_token = create_access_token(data=token_claims(user), expires_delta=access_token_expires)
 
     response = RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
     response.set_cookie(key="access_token", value=f"{access_token}", httponly=True)
@@ -0,0 +1,92 @@
+"""
+Schema upgrades for existing databases.
+
+`Base.metadata.create_all` only creates missing tables: columns and indexes added
+to tables that already exist (e.g. the production camp.db on the Fly volume) are
+not picked up. `upgrade_schema` is idempotent and safe to run on every startup.
+"""
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from app import models  # noqa: F401  (registers every table on Base.metadata)
+from app.database import Base
+from app.models import TerrenoCategoria
+from app.polyline import encode_variants
+
+
+def _add_missing_columns(bind: Engine):
+    """ALTER TABLE ... ADD COLUMN for columns declared after the table was created: nullable or server-defaulted."""
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=bind.dialect)
+                definition = f'"{column.name}" {column_type}'
+                if not column.nullable:
+                    if column.server_default is None:
+                        raise RuntimeError(
+                            f"Cannot add NOT NULL column {table.name}.{column.name} without a server default"
+                        )
+                    definition += f" NOT NULL DEFAULT {column.server_default.arg}"
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+
+
+def _backfill_polygon_encodings(bind: Engine):
+    with bind.begin() as conn:
+        rows = conn.execute(text("SELECT id, polygon FROM terreni WHERE polygon_encoded IS NULL")).all()
+        updates = [{"id": row.id, "encoded": encode_variants(row.polygon)} for row in rows]
+        updates = [u for u in updates if u["encoded"] is not None]
+        if updates:
+            conn.execute(text("UPDATE terreni SET polygon_encoded = :encoded WHERE id = :id"), updates)
+
+
+def _backfill_terreno_tags(bind: Engine):
+    """terreno_tags rows for terreni written before the table existed (e.g. camp.db, older terreni.csv imports)."""
+    with bind.begin() as conn:
+        rows = conn.execute(
+            text("SELECT id, tags FROM terreni WHERE id NOT IN (SELECT terreno_id FROM terreno_tags)")
+        ).all()
+        links = [{"terreno_id": row.id, "tag": tag} for row in rows for tag in TerrenoCategoria.split(row.tags)]
+        if links:
+            conn.execute(text("INSERT INTO terreno_tags (terreno_id, tag) VALUES (:terreno_id, :tag)"), links)
+
+
+def _dedupe_completions(bind: Engine):
+    """
+    Remove duplicate (pattuglia, challenge) completions left by the old check-then-insert
+    path before the unique index is created: the earliest row is kept and the points of
+    every extra row are taken back, as the admin rollback of a completion does.
+    """
+    with bind.begin() as conn:
+        duplicates = conn.execute(
+            text(
+                "SELECT c.id, c.pattuglia_id, ch.points FROM completions c "
+                "JOIN challenges ch ON ch.id = c.challenge_id "
+                "WHERE c.id NOT IN (SELECT MIN(id) FROM completions GROUP BY pattuglia_id, challenge_id)"
+            )
+        ).all()
+        if not duplicates:
+            return
+        conn.execute(
+            text("UPDATE pattuglie SET current_score = current_score - :points WHERE id = :pattuglia_id"),
+            [{"points": row.points, "pattuglia_id": row.pattuglia_id} for row in duplicates],
+        )
+        conn.execute(text("DELETE FROM completions WHERE id = :id"), [{"id": row.id} for row in duplicates])
+
+
+def upgrade_schema(bind: Engine):
+    Base.metadata.create_all(bind=bind)
+    _add_missing_columns(bind)
+    _dedupe_completions(bind)
+
+    # Indexes declared on tables that predate them
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+    _backfill_polygon_encodings(bind)
+    _backfill_terreno_tags(bind)
@@ -1,11 +1,12 @@
-from datetime import datetime
+from datetime import date, datetime
 from enum import Enum
 from typing import Optional
 
-from sqlalchemy import ForeignKey
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import ForeignKey, Index, UniqueConstraint
+from sqlalchemy.orm import Mapped, mapped_column, relationship, validates
 
 from .database import Base
+from .polyline import encode_variants
 
 
 class TerrenoCategoria(str, Enum):
@@ -31,6 +32,12 @@ class TerrenoCategoria(str, Enum):
 
         return len(invalid_tags) == 0, invalid_tags
 
+    @classmethod
+    def split(cls, tags_str: str | None) -> list[str]:
+        """Normalized tags of a comma-separated string: stripped, upper-case, de-duplicated, in order."""
+        tags = [t.strip().upper() for t in (tags_str or "").split(",") if t.strip()]
+        return list(dict.fromkeys(tags))
+
     @classmethod
     def all_values(cls) -> list[str]:
         """Return all valid category values."""
@@ -76,6 +83,14 @@ class Challenge(Base):
 
 class Completion(Base):
     __tablename__ = "completions"
+    # A unique index rather than a constraint, so upgrade_schema can add it to existing databases
+    __table_args__ = (
+        Index("uq_completions_pattuglia_challenge", "pattuglia_id", "challenge_id", unique=True),
+        # Keyset pagination of the timeline (app/timeline.py), unfiltered and per pattuglia or challenge
+        Index("ix_completions_timestamp_id", "timestamp", "id"),
+        Index("ix_completions_pattuglia_timestamp_id", "pattuglia_id", "timestamp", "id"),
+        Index("ix_completions_challenge_timestamp_id", "challenge_id", "timestamp", "id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     pattuglia_id: Mapped[int] = mapped_column(ForeignKey("pattuglie.id"))
@@ -86,6 +101,17 @@ class Completion(Base):
     challenge: Mapped["Challenge"] = relationship(back_populates="completions")
 
 
+class CompletionKey(Base):
+    """Idempotency key of a completion synced from the offline queue of /input, with its outcome."""
+
+    __tablename__ = "completion_keys"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    outcome: Mapped[str] = mapped_column()  # ok, already_completed, not_found
+    completion_id: Mapped[int | None] = mapped_column(nullable=True)
+    received_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -94,6 +120,8 @@ class User(Base):
     password_hash: Mapped[str] = mapped_column()
     role: Mapped[str] = mapped_column()  # 'unit', 'tech', 'admin'
     unita_id: Mapped[int | None] = mapped_column(ForeignKey("unita.id"), nullable=True)
+    # Signed into the access token; bumped on password, role or unità changes to revoke older tokens
+    token_version: Mapped[int] = mapped_column(default=0, server_default="0")
 
     unita: Mapped[Optional["Unita"]] = relationship()
 
@@ -107,14 +135,45 @@ class Terreno(Base):
     center_lat: Mapped[str] = mapped_column()
     center_lon: Mapped[str] = mapped_column()
     polygon: Mapped[str] = mapped_column()  # JSON string of coordinates
+    # Encoded polyline per zoom level, derived from polygon (see app/polyline.py)
+    polygon_encoded: Mapped[str | None] = mapped_column(nullable=True, default=None)
     description: Mapped[str] = mapped_column(default="")
     image_urls: Mapped[str] = mapped_column(default="[]")  # JSON string of list of URLs
 
     prenotazioni: Mapped[list["Prenotazione"]] = relationship(back_populates="terreno")
+    tag_links: Mapped[list["TerrenoTag"]] = relationship(cascade="all, delete-orphan")
+
+    @validates("tags")
+    def _index_tags(self, key, value):
+        tags = TerrenoCategoria.split(value)
+        existing = {link.tag: link for link in self.tag_links}
+        self.tag_links = [existing.get(tag) or TerrenoTag(tag=tag) for tag in tags]
+        return ",".join(tags)
+
+    @validates("polygon")
+    def _encode_polygon(self, key, value):
+        self.polygon_encoded = encode_variants(value)
+        return value
+
+
+class TerrenoTag(Base):
+    """One row per (terreno, tag), kept in sync with Terreno.tags: tag filters are index lookups."""
+
+    __tablename__ = "terreno_tags"
+    __table_args__ = (Index("ix_terreno_tags_tag", "tag", "terreno_id"),)
+
+    terreno_id: Mapped[int] = mapped_column(ForeignKey("terreni.id", ondelete="CASCADE"), primary_key=True)
+    tag: Mapped[str] = mapped_column(primary_key=True)
 
 
 class Prenotazione(Base):
     __tablename__ = "prenotazioni"
+    __table_args__ = (
+        # Overlap probes for one terreno: terreno_id = ? AND start_time < ? AND end_time > ?
+        Index("ix_prenotazioni_terreno_window", "terreno_id", "start_time", "end_time"),
+        # Window scans across all terreni (availability map)
+        Index("ix_prenotazioni_window", "start_time", "end_time"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     terreno_id: Mapped[int] = mapped_column(ForeignKey("terreni.id"))
@@ -126,3 +185,22 @@ class Prenotazione(Base):
 
     terreno: Mapped["Terreno"] = relationship(back_populates="prenotazioni")
     unita: Mapped["Unita"] = relationship()
+
+
+class Preferenza(Base):
+    """A ranked booking wish of a unit, consumed by the batch allocation (app/allocation.py)."""
+
+    __tablename__ = "preferenze"
+    __table_args__ = (UniqueConstraint("unita_id", "rank", name="uq_preferenze_unita_rank"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    unita_id: Mapped[int] = mapped_column(ForeignKey("unita.id"), index=True)
+    rank: Mapped[int] = mapped_column()  # 1 = most wanted
+    tag: Mapped[str] = mapped_column()  # TerrenoCategoria value
+    day: Mapped[date] = mapped_column()
+    earliest_hour: Mapped[int] = mapped_column()  # Window [earliest_hour, latest_hour) on that day
+    latest_hour: Mapped[int] = mapped_column()
+    duration: Mapped[int] = mapped_column()  # Hours (1-4)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+    unita: Mapped["Unita"] = relationship()
@@ -0,0 +1,150 @@
+"""
+Cache of rendered page fragments, re-rendered after every write.
+
+Pages polled by every camp screen (ranking, timeline) are rendered once per data
+change instead of once per viewer. Entries are tagged with a data version that is
+bumped by every committed write. The bump wakes a background thread that
+re-renders the outdated pages, one at a time and on its own session, so usually
+no request pays for a render. A request finding its page outdated never gets the
+old copy: the redirect after a write and the reloads triggered by the live feed
+must show that write. It waits for the render already under way, or renders the
+page itself when none is, and so does the very first request for a page.
+"""
+
+import threading
+from collections.abc import Callable, Hashable
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import ORMExecuteState, Session
+
+_DIRTY_KEY = "page_cache_dirty"
+
+Render = Callable[[Session], str]
+
+
+class PageCache:
+    def __init__(self, bind: Engine):
+        self._bind = bind  # For the background renders: the requests' sessions are closed by then
+        self._changed = threading.Condition()
+        self._version = 0
+        self._entries: dict[Hashable, tuple[int, str]] = {}
+        self._renders: dict[Hashable, Render] = {}  # How each entry was last rendered
+        self._rendering: set[Hashable] = set()
+        self._worker: threading.Thread | None = None
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def bump(self):
+        """Invalidate every entry and start re-rendering them in the background."""
+        with self._changed:
+            self._version += 1
+            if self._worker is None and self._entries:
+                self._worker = threading.Thread(target=self._refresh_outdated, daemon=True)
+                self._worker.start()
+
+    def get_or_render(self, db: Session, key: Hashable, render: Render) -> str:
+        """The entry for key as of the last write; render(session) builds it when it has to be done here, on db."""
+        with self._changed:
+            version = self._version
+            self._renders[key] = render
+            while True:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] >= version:
+                    return entry[1]
+                if key not in self._rendering:
+                    break
+                # Already being rendered: wait for it rather than render it twice
+                self._changed.wait()
+            self._rendering.add(key)
+        return self._render(db, key, version, render)
+
+    def join(self):
+        """Wait until the background renders are done."""
+        while (worker := self._worker) is not None:
+            worker.join()
+
+    def _render(self, db: Session, key: Hashable, version: int, render: Render) -> str:
+        # Call with key added to _rendering
+        try:
+            html = render(db)
+        except BaseException:
+            with self._changed:
+                self._rendering.discard(key)
+                self._changed.notify_all()
+            raise
+        with self._changed:
+            self._rendering.discard(key)
+            current = self._entries.get(key)
+            # Tag with the version seen before rendering: a write that lands mid-render invalidates it again
+            if current is None or current[0] <= version:
+                self._entries[key] = (version, html)
+            self._changed.notify_all()
+        return html
+
+    def _refresh_outdated(self):
+        while True:
+            with self._changed:
+                version = self._version
+                key = next((k for k, (v, _) in self._entries.items() if v < version and k not in self._rendering), None)
+                if key is None:
+                    self._worker = None
+                    return
+                self._rendering.add(key)
+                render = self._renders[key]
+            try:
+                with Session(bind=self._bind) as db:
+                    self._render(db, key, version, render)
+            except Exception:
+                # Dropped: the next request renders it and gets the error itself
+                with self._changed:
+                    self._entries.pop(key, None)
+
+
+# --- Registry (one cache per database engine) ---
+
+_caches: WeakKeyDictionary[Engine, PageCache] = WeakKeyDictionary()
+_registry_lock = threading.Lock()
+
+
+def get_page_cache(db: Session) -> PageCache:
+    engine = db.get_bind().engine
+    with _registry_lock:
+        cache = _caches.get(engine)
+        if cache is None:
+            cache = PageCache(engine)
+            _caches[engine] = cache
+        return cache
+
+
+# --- Session event hooks ---
+
+
+@event.listens_for(Session, "after_flush")
+def _mark_flush(session: Session, flush_context):
+    session.info[_DIRTY_KEY] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_bulk_write(orm_execute_state: ORMExecuteState):
+    # Bulk query.update()/delete() and Core-style inserts bypass the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info[_DIRTY_KEY] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_version(session: Session):
+    if not session.info.pop(_DIRTY_KEY, False):
+        return
+    with _registry_lock:
+        cache = _caches.get(session.get_bind().engine)
+    if cache is not None:
+        cache.bump()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_mark(session: Session):
+    session.info.pop(_DIRTY_KEY, None)
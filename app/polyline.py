@@ -0,0 +1,124 @@
+"""
+Compact polygon encoding for the terreni map.
+
+Polygons are stored as JSON lists of [lat, lon] floats with ~15 significant
+digits. For the map they are quantized to 1e-5 degrees (about a metre) and
+written as zig-zag varint deltas in the Google encoded-polyline alphabet, which
+takes 4-6 characters per vertex instead of ~40. Each polygon also gets
+Douglas-Peucker simplified variants for a few zoom levels, with a tolerance of
+one screen pixel at that zoom, so zoomed-out views ship fewer vertices.
+"""
+
+import json
+import math
+
+PRECISION = 5
+
+# Leaflet zoom levels with a precomputed variant; deeper zooms get the full polygon
+ZOOM_LEVELS = (12, 14, 16)
+FULL = "full"
+
+
+def encode(points: list[list[float]], precision: int = PRECISION) -> str:
+    """Encode [lat, lon] points as a polyline string."""
+    factor = 10**precision
+    chunks = []
+    prev_lat = prev_lon = 0
+    for lat, lon in points:
+        qlat, qlon = round(lat * factor), round(lon * factor)
+        for delta in (qlat - prev_lat, qlon - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        prev_lat, prev_lon = qlat, qlon
+    return "".join(chunks)
+
+
+def decode(encoded: str, precision: int = PRECISION) -> list[list[float]]:
+    """Inverse of `encode` (up to the quantization)."""
+    factor = 10**precision
+    points = []
+    coords = [0, 0]
+    i = 0
+    while i < len(encoded):
+        for axis in (0, 1):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[i]) - 63
+                i += 1
+                result |= (byte & 0x1F) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            coords[axis] += ~(result >> 1) if result & 1 else result >> 1
+        points.append([coords[0] / factor, coords[1] / factor])
+    return points
+
+
+def pixel_degrees(zoom: int) -> float:
+    """Degrees of longitude covered by one 256px-tile pixel at the given zoom."""
+    return 360 / (256 * 2**zoom)
+
+
+def _distance(p: tuple[float, float], a: tuple[float, float], b: tuple[float, float]) -> float:
+    """Distance from p to segment ab (planar)."""
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def simplify(points: list[list[float]], tolerance: float) -> list[list[float]]:
+    """
+    Douglas-Peucker simplification; tolerance is in degrees of longitude.
+
+    Latitudes are stretched by 1 / cos(lat) first so the tolerance means the same
+    on-screen distance in both directions (Web Mercator). Closed rings keep
+    their first and last vertex, and the result never drops below a triangle.
+    """
+    if len(points) <= 4 or tolerance <= 0:
+        return points
+    stretch = 1 / math.cos(math.radians(points[0][0]))
+    projected = [(lat * stretch, lon) for lat, lon in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, max_distance = -1, tolerance
+        for i in range(first + 1, last):
+            d = _distance(projected[i], projected[first], projected[last])
+            if d > max_distance:
+                farthest, max_distance = i, d
+        if farthest != -1:
+            keep[farthest] = True
+            stack.extend([(first, farthest), (farthest, last)])
+
+    simplified = [p for p, kept in zip(points, keep, strict=True) if kept]
+    return simplified if len(simplified) >= 4 else points
+
+
+def encode_variants(polygon_json: str) -> str | None:
+    """
+    JSON object with the encoded polygon per zoom level plus "full", or None if
+    the stored polygon is not a list of [lat, lon] pairs.
+    """
+    try:
+        points = [[float(lat), float(lon)] for lat, lon in json.loads(polygon_json)]
+    except (TypeError, ValueError):
+        return None
+    variants = {str(zoom): encode(simplify(points, pixel_degrees(zoom))) for zoom in ZOOM_LEVELS}
+    variants[FULL] = encode(points)
+    return json.dumps(variants, separators=(",", ":"))
+
+
+def level_for_zoom(zoom: int | None) -> str:
+    """Variant key serving the given map zoom: the finest precomputed level not above it."""
+    if zoom is None or zoom > ZOOM_LEVELS[-1]:
+        return FULL
+    eligible = [level for level in ZOOM_LEVELS if level <= zoom]
+    return str(eligible[-1] if eligible else ZOOM_LEVELS[0])
@@ -0,0 +1,86 @@
+"""
+Bulk provisioning of the unit user accounts (init_db.py --bulk-users).
+
+Every unità without an account gets one, with its own random password. The
+existing usernames and provisioned units are read in a single query, so a re-run
+only creates the accounts of units added since. The argon2 hashes, the slow part,
+are computed in parallel on a process pool. As each hash completes, its
+credentials are streamed to the sheet, then all rows are inserted with one
+executemany. The sheet is written before the commit: if the run dies in between,
+the sheet lists accounts that don't exist yet and a re-run creates them with new
+passwords. The other way round, accounts would exist that nobody can log in to.
+"""
+
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import TextIO
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from app.auth import pwd_context
+from app.models import Unita, User
+
+# No look-alikes (0/o, 1/l/i): the sheet is printed and typed on phones
+PASSWORD_ALPHABET = "abcdefghjkmnpqrstuvwxyz23456789"
+PASSWORD_LENGTH = 10
+HASH_CHUNK_SIZE = 8
+
+
+@dataclass
+class ProvisioningResult:
+    created: list[str] = field(default_factory=list)  # Usernames
+    skipped: list[str] = field(default_factory=list)  # Units whose username is empty or already taken
+
+
+def unit_username(unit_name: str) -> str:
+    """Lowercase alphanumerics of the unit name, as init_db.py has always derived them."""
+    return "".join(c for c in unit_name if c.isalnum()).lower()
+
+
+def generate_password(length: int = PASSWORD_LENGTH) -> str:
+    return "".join(secrets.choice(PASSWORD_ALPHABET) for _ in range(length))
+
+
+def _hash(password: str) -> str:
+    # Module level so the process pool can pickle it
+    return pwd_context.hash(password)
+
+
+def write_credentials(sheet: TextIO, unit_name: str, username: str, password: str):
+    sheet.write(f"Unità: {unit_name}\nUsername: {username}\nPassword: {password}\n{'-' * 20}\n")
+
+
+def provision_unit_users(db: Session, sheet: TextIO, workers: int | None = None) -> ProvisioningResult:
+    """Create the missing unit accounts, streaming their credentials to sheet. workers=None: one per CPU."""
+    result = ProvisioningResult()
+    existing = db.execute(select(User.username, User.unita_id)).all()
+    taken = {row.username for row in existing}
+    provisioned = {row.unita_id for row in existing if row.unita_id is not None}
+
+    planned = []
+    for unit in db.execute(select(Unita.id, Unita.name).order_by(Unita.name)):
+        if unit.id in provisioned:
+            continue
+        username = unit_username(unit.name)
+        if not username or username in taken:
+            result.skipped.append(unit.name)
+            continue
+        taken.add(username)
+        planned.append((unit, username, generate_password()))
+    if not planned:
+        return result
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        hashes = pool.map(_hash, [password for _, _, password in planned], chunksize=HASH_CHUNK_SIZE)
+        for (unit, username, password), password_hash in zip(planned, hashes, strict=True):
+            write_credentials(sheet, unit.name, username, password)
+            rows.append({"username": username, "password_hash": password_hash, "role": "unit", "unita_id": unit.id})
+            result.created.append(username)
+    sheet.flush()
+
+    db.execute(insert(User), rows)
+    db.commit()
+    return result
@@ -0,0 +1,273 @@
+"""
+Process-local ranking index.
+
+Keeps every pattuglia sorted by score, both globally and per sottocampo, so the
+ranking page can be served without querying SQLite. The index is built from the
+database the first time it is requested for an engine (at startup for the main
+engine) and is then kept in sync by SQLAlchemy session events: every committed
+flush that touches a Pattuglia or an Unita is replayed into it.
+"""
+
+import bisect
+import threading
+from dataclasses import dataclass, replace
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.models import Pattuglia, Unita
+
+_PENDING_KEY = "ranking_pending"
+
+
+@dataclass(frozen=True)
+class UnitaEntry:
+    id: int
+    name: str
+    sottocampo: str
+
+
+@dataclass(frozen=True)
+class RankedPattuglia:
+    """Read-only view of a pattuglia with its position, shaped like the ORM object used by the templates."""
+
+    id: int
+    name: str
+    capo_pattuglia: str
+    current_score: int
+    unita: UnitaEntry
+    rank: int
+
+
+@dataclass(frozen=True)
+class _PattugliaRow:
+    name: str
+    capo_pattuglia: str
+    unita_id: int
+    current_score: int
+    sottocampo: str | None  # Partition the row currently lives in
+
+
+def _key(pattuglia_id: int, score: int) -> tuple[int, int]:
+    # Highest score first, ties broken by id so the order is stable
+    return (-score, pattuglia_id)
+
+
+class RankingIndex:
+    """
+    Sorted score index with one partition per sottocampo.
+
+    Lookups use bisect (O(log n)); inserting into the backing lists is a memmove,
+    which is negligible at the size of a camp.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._units: dict[int, UnitaEntry] = {}
+        self._rows: dict[int, _PattugliaRow] = {}
+        self._order: list[tuple[int, int]] = []
+        self._partitions: dict[str, list[tuple[int, int]]] = {}
+
+    @classmethod
+    def from_session(cls, db: Session) -> "RankingIndex":
+        index = cls()
+        for u in db.query(Unita).all():
+            index.upsert_unita(u.id, u.name, u.sottocampo)
+        for p in db.query(Pattuglia).all():
+            index.upsert_pattuglia(p.id, p.name, p.capo_pattuglia, p.unita_id, p.current_score)
+        return index
+
+    # --- Writes ---
+
+    def upsert_unita(self, unita_id: int, name: str, sottocampo: str):
+        with self._lock:
+            self._units[unita_id] = UnitaEntry(id=unita_id, name=name, sottocampo=sottocampo)
+            # Move the unit's pattuglie if its sottocampo changed (or was unknown until now)
+            for pid, row in list(self._rows.items()):
+                if row.unita_id == unita_id and row.sottocampo != sottocampo:
+                    self._unlink(pid, row)
+                    self._link(pid, replace(row, sottocampo=sottocampo))
+
+    def remove_unita(self, unita_id: int):
+        with self._lock:
+            self._units.pop(unita_id, None)
+
+    def upsert_pattuglia(
+        self, pattuglia_id: int, name: str, capo_pattuglia: str, unita_id: int, current_score: int | None
+    ):
+        """current_score=None keeps the score in the index: it may be newer than the caller's copy."""
+        with self._lock:
+            old = self._rows.get(pattuglia_id)
+            if old is not None:
+                self._unlink(pattuglia_id, old)
+                if current_score is None:
+                    current_score = old.current_score
+            if current_score is None:
+                current_score = 0
+            unita = self._units.get(unita_id)
+            row = _PattugliaRow(name, capo_pattuglia, unita_id, current_score, unita.sottocampo if unita else None)
+            self._link(pattuglia_id, row)
+
+    def set_score(self, pattuglia_id: int, current_score: int):
+        """Score written with a SQL-side increment, which the flush hooks never see."""
+        with self._lock:
+            old = self._rows.get(pattuglia_id)
+            if old is not None and old.current_score != current_score:
+                self._unlink(pattuglia_id, old)
+                self._link(pattuglia_id, replace(old, current_score=current_score))
+
+    def remove_pattuglia(self, pattuglia_id: int):
+        with self._lock:
+            old = self._rows.get(pattuglia_id)
+            if old is not None:
+                self._unlink(pattuglia_id, old)
+
+    def _link(self, pattuglia_id: int, row: _PattugliaRow):
+        self._rows[pattuglia_id] = row
+        key = _key(pattuglia_id, row.current_score)
+        bisect.insort(self._order, key)
+        if row.sottocampo is not None:
+            bisect.insort(self._partitions.setdefault(row.sottocampo, []), key)
+
+    def _unlink(self, pattuglia_id: int, row: _PattugliaRow):
+        del self._rows[pattuglia_id]
+        key = _key(pattuglia_id, row.current_score)
+        _discard(self._order, key)
+        if row.sottocampo is not None:
+            partition = self._partitions.get(row.sottocampo, [])
+            _discard(partition, key)
+            if not partition:
+                self._partitions.pop(row.sottocampo, None)
+
+    # --- Reads ---
+
+    def ranking(self, sottocampo: str | None = None) -> list[RankedPattuglia]:
+        """
+        Pattuglie ordered by score, optionally restricted to one sottocampo.
+        Ranks are tie-aware: equal scores share a position (1, 1, 3, ...).
+        """
+        with self._lock:
+            keys = self._order if sottocampo is None else self._partitions.get(sottocampo, [])
+            result = []
+            rank = 0
+            previous_score = None
+            for neg_score, pid in keys:
+                row = self._rows[pid]
+                unita = self._units.get(row.unita_id)
+                if unita is None:
+                    continue  # Neither listed nor counted in the positions
+                if neg_score != previous_score:
+                    rank = len(result) + 1
+                    previous_score = neg_score
+                result.append(
+                    RankedPattuglia(
+                        id=pid,
+                        name=row.name,
+                        capo_pattuglia=row.capo_pattuglia,
+                        current_score=row.current_score,
+                        unita=unita,
+                        rank=rank,
+                    )
+                )
+            return result
+
+    def rank_of(self, pattuglia_id: int, sottocampo: str | None = None) -> int | None:
+        """Tie-aware rank of a single pattuglia, in O(log n)."""
+        with self._lock:
+            row = self._rows.get(pattuglia_id)
+            if row is None:
+                return None
+            keys = self._order if sottocampo is None else self._partitions.get(sottocampo, [])
+            return bisect.bisect_left(keys, (-row.current_score,)) + 1
+
+    def unita(self) -> list[UnitaEntry]:
+        with self._lock:
+            return sorted(self._units.values(), key=lambda u: u.name)
+
+    def sottocampi(self) -> list[str]:
+        with self._lock:
+            return sorted({u.sottocampo for u in self._units.values()})
+
+
+def _discard(keys: list[tuple[int, int]], key: tuple[int, int]):
+    i = bisect.bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key:
+        del keys[i]
+
+
+# --- Registry (one index per database engine) ---
+
+_indexes: WeakKeyDictionary[Engine, RankingIndex] = WeakKeyDictionary()
+_registry_lock = threading.Lock()
+
+
+def get_ranking_index(db: Session) -> RankingIndex:
+    """Return the ranking index for the session's database, building it on first use."""
+    engine = db.get_bind().engine
+    with _registry_lock:
+        index = _indexes.get(engine)
+        if index is None:
+            index = RankingIndex.from_session(db)
+            _indexes[engine] = index
+        return index
+
+
+def apply_scores(session: Session, scores: dict[int, int]):
+    """Scores committed with SQL-side increments (app/completions.py), which the flush hooks never see."""
+    with _registry_lock:
+        index = _indexes.get(session.get_bind().engine)
+        if index is None:
+            # Not built yet: it will read the committed state when first requested
+            return
+        for pattuglia_id, score in scores.items():
+            index.set_score(pattuglia_id, score)
+
+
+# --- Session event hooks ---
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_ranking_changes(session: Session, flush_context):
+    pending = session.info.setdefault(_PENDING_KEY, {})
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Unita):
+            pending[(Unita, obj.id)] = (obj.name, obj.sottocampo)
+        elif isinstance(obj, Pattuglia):
+            # Scores also move with SQL-side increments (app/completions.py): an object loaded before one
+            # of them holds an old score, only pushed if this flush wrote it
+            score_written = obj in session.new or inspect(obj).attrs.current_score.history.has_changes()
+            score = obj.current_score if score_written else None
+            pending[(Pattuglia, obj.id)] = (obj.name, obj.capo_pattuglia, obj.unita_id, score)
+    for obj in session.deleted:
+        if isinstance(obj, Unita | Pattuglia):
+            pending[(type(obj), obj.id)] = None
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_ranking_changes(session: Session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    with _registry_lock:
+        index = _indexes.get(session.get_bind().engine)
+        if index is None:
+            # Not built yet: it will read the committed state when first requested
+            return
+        # Units first so new pattuglie land in the right partition
+        for (model, obj_id), values in sorted(pending.items(), key=lambda item: item[0][0] is Pattuglia):
+            if model is Unita:
+                if values is None:
+                    index.remove_unita(obj_id)
+                else:
+                    index.upsert_unita(obj_id, *values)
+            elif values is None:
+                index.remove_pattuglia(obj_id)
+            else:
+                index.upsert_pattuglia(obj_id, *values)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_ranking_changes(session: Session):
+    session.info.pop(_PENDING_KEY, None)
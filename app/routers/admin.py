@@ -1,20 +1,28 @@
+from functools import partial
+
 from fastapi import APIRouter, Depends, Form, HTTPException, Request, status
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session, joinedload
 
-from app.auth import get_admin_user
-from app.database import get_db
+from app.allocation import allocate
+from app.auth import AuthenticatedUser, get_admin_user
+from app.completions import apply_points_change, apply_rollback
+from app.database import AsyncDB, get_async_db, get_db
+from app.hashing import RETRY_AFTER_SECONDS, HashingBusy, hash_pool
 from app.models import (
     Challenge,
     Completion,
     Pattuglia,
+    Preferenza,
     Prenotazione,
     Terreno,
     TerrenoCategoria,
     Unita,
     User,
 )
+from app.tags import filter_by_tags
+from app.writer import run_mutation
 
 router = APIRouter(prefix="/admin", tags=["admin"], dependencies=[Depends(get_admin_user)])
 
@@ -23,7 +31,7 @@ templates = Jinja2Templates(directory="app/templates")
 
 # --- Dashboard ---
 @router.get("/", response_class=HTMLResponse)
-async def admin_dashboard(request: Request, db: Session = Depends(get_db), user: User = Depends(get_admin_user)):
+def admin_dashboard(request: Request, db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_admin_user)):
     completions = (
         db.query(Completion)
         .options(joinedload(Completion.pattuglia), joinedload(Completion.challenge))
@@ -41,7 +49,7 @@ async def admin_dashboard(request: Request, db: Session = Depends(get_db), user:
 
 # --- Pattuglie Management ---
 @router.get("/pattuglie", response_class=HTMLResponse)
-async def admin_pattuglie(request: Request, db: Session = Depends(get_db), user: User = Depends(get_admin_user)):
+def admin_pattuglie(request: Request, db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_admin_user)):
     pattuglie = db.query(Pattuglia).options(joinedload(Pattuglia.unita)).all()
     unita = db.query(Unita).all()
     return templates.TemplateResponse(
@@ -51,7 +59,7 @@ async def admin_pattuglie(request: Request, db: Session = Depends(get_db), user:
 
 
 @router.post("/pattuglie")
-async def create_pattuglia(
+def create_pattuglia(
     name: str = Form(...), capo_pattuglia: str = Form(...), unita_id: int = Form(...), db: Session = Depends(get_db)
 ):
     new_pattuglia = Pattuglia(name=name, capo_pattuglia=capo_pattuglia, unita_id=unita_id)
@@ -61,8 +69,11 @@ async def create_pattuglia(
 
 
 @router.get("/pattuglie/{pattuglia_id}", response_class=HTMLResponse)
-async def edit_pattuglia_form(
-    pattuglia_id: int, request: Request, db: Session = Depends(get_db), user: User = Depends(get_admin_user)
+def edit_pattuglia_form(
+    pattuglia_id: int,
+    request: Request,
+    db: Session = Depends(get_db),
+    user: AuthenticatedUser = Depends(get_admin_user),
 ):
     pattuglia = db.query(Pattuglia).filter(Pattuglia.id == pattuglia_id).first()
     unita = db.query(Unita).all()
@@ -85,7 +96,7 @@ async def edit_pattuglia_form(
 
 
 @router.post("/pattuglie/{pattuglia_id}/edit")
-async def edit_pattuglia(
+def edit_pattuglia(
     pattuglia_id: int,
     name: str = Form(...),
     capo_pattuglia: str = Form(...),
@@ -102,7 +113,7 @@ async def edit_pattuglia(
 
 
 @router.post("/pattuglie/{pattuglia_id}/delete")
-async def delete_pattuglia(pattuglia_id: int, db: Session = Depends(get_db)):
+def delete_pattuglia(pattuglia_id: int, db: Session = Depends(get_db)):
     pattuglia = db.query(Pattuglia).filter(Pattuglia.id == pattuglia_id).first()
     if pattuglia:
         db.query(Completion).filter(Completion.pattuglia_id == pattuglia_id).delete()
@@ -113,7 +124,9 @@ async def delete_pattuglia(pattuglia_id: int, db: Session = Depends(get_db)):
 
 # --- Challenges Management ---
 @router.get("/challenges", response_class=HTMLResponse)
-async def admin_challenges(request: Request, db: Session = Depends(get_db), user: User = Depends(get_admin_user)):
+def admin_challenges(
+    request: Request, db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_admin_user)
+):
     challenges = db.query(Challenge).all()
     return templates.TemplateResponse(
         "admin_challenges.html",
@@ -122,7 +135,7 @@ async def admin_challenges(request: Request, db: Session = Depends(get_db), user
 
 
 @router.post("/challenges")
-async def create_challenge(
+def create_challenge(
     name: str = Form(...),
     description: str = Form(...),
     points: int = Form(...),
@@ -139,8 +152,11 @@ async def create_challenge(
 
 
 @router.get("/challenges/{challenge_id}", response_class=HTMLResponse)
-async def edit_challenge_form(
-    challenge_id: int, request: Request, db: Session = Depends(get_db), user: User = Depends(get_admin_user)
+def edit_challenge_form(
+    challenge_id: int,
+    request: Request,
+    db: Session = Depends(get_db),
+    user: AuthenticatedUser = Depends(get_admin_user),
 ):
     challenge = db.query(Challenge).filter(Challenge.id == challenge_id).first()
     if not challenge:
@@ -171,43 +187,25 @@ async def edit_challenge(
     retroactive_update: bool = Form(False),
     db: Session = Depends(get_db),
 ):
-    challenge = db.query(Challenge).filter(Challenge.id == challenge_id).first()
-    if challenge:
-        old_points = challenge.points
-
+    def apply(session: Session):
+        challenge = session.get(Challenge, challenge_id)
+        if challenge is None:
+            return
+        if retroactive_update and challenge.points != points:
+            # SQL-side increment under the writer lock, so no concurrent completion is lost
+            apply_points_change(session, challenge_id, points - challenge.points)
         challenge.name = name
         challenge.description = description
         challenge.points = points
         challenge.reward_tokens = reward_tokens
         challenge.is_fungo = is_fungo
 
-        if retroactive_update and old_points != points:
-            # Recalculate scores for all affected pattuglie
-            point_diff = points - old_points
-
-            # Find all completions for this challenge
-            completions = db.query(Completion).filter(Completion.challenge_id == challenge_id).all()
-            affected_pattuglie_ids = set(c.pattuglia_id for c in completions)
-
-            for pid in affected_pattuglie_ids:
-                pattuglia = db.query(Pattuglia).filter(Pattuglia.id == pid).first()
-                if pattuglia:
-                    # Count how many times they completed THIS challenge
-                    count = (
-                        db.query(Completion)
-                        .filter(Completion.pattuglia_id == pid, Completion.challenge_id == challenge_id)
-                        .count()
-                    )
-
-                    # Adjust score
-                    pattuglia.current_score += point_diff * count
-
-        db.commit()
+    await run_mutation(db, apply)
     return RedirectResponse(url="/admin/challenges", status_code=status.HTTP_303_SEE_OTHER)
 
 
 @router.post("/challenges/{challenge_id}/delete")
-async def delete_challenge(challenge_id: int, db: Session = Depends(get_db)):
+def delete_challenge(challenge_id: int, db: Session = Depends(get_db)):
     challenge = db.query(Challenge).filter(Challenge.id == challenge_id).first()
     if challenge:
         db.query(Completion).filter(Completion.challenge_id == challenge_id).delete()
@@ -218,21 +216,32 @@ async def delete_challenge(challenge_id: int, db: Session = Depends(get_db)):
 
 # --- Users Management ---
 @router.get("/users", response_class=HTMLResponse)
-async def admin_users(request: Request, db: Session = Depends(get_db), user: User = Depends(get_admin_user)):
+def admin_users(request: Request, db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_admin_user)):
     users = db.query(User).options(joinedload(User.unita)).all()
     return templates.TemplateResponse(
         "admin_users.html", {"request": request, "users": users, "user": user, "active_tab": "users"}
     )
 
 
-@router.post("/users/{user_id}/password")
-async def reset_user_password(user_id: int, password: str = Form(...), db: Session = Depends(get_db)):
+def _set_password_hash(db: Session, user_id: int, password_hash: str):
     user = db.query(User).filter(User.id == user_id).first()
     if user:
-        from app.auth import pwd_context
-
-        user.password_hash = pwd_context.hash(password)
+        # Bumps user.token_version on flush: the tokens issued with the old password stop working
+        user.password_hash = password_hash
         db.commit()
+
+
+@router.post("/users/{user_id}/password")
+async def reset_user_password(user_id: int, password: str = Form(...), db: AsyncDB = Depends(get_async_db)):
+    try:
+        password_hash = await hash_pool.hash(password)
+    except HashingBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server occupato, riprova tra qualche secondo",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        ) from None
+    await db.run(_set_password_hash, user_id, password_hash)
     return RedirectResponse(url="/admin/users", status_code=status.HTTP_303_SEE_OTHER)
 
 
@@ -240,15 +249,44 @@ async def reset_user_password(user_id: int, password: str = Form(...), db: Sessi
 
 
 @router.get("/terreni", response_class=HTMLResponse)
-async def admin_terreni(request: Request, db: Session = Depends(get_db), user: User = Depends(get_admin_user)):
-    terreni = db.query(Terreno).all()
+def admin_terreni(
+    request: Request,
+    tag: str | None = None,
+    allocati: int | None = None,
+    non_allocati: int | None = None,
+    db: Session = Depends(get_db),
+    user: AuthenticatedUser = Depends(get_admin_user),
+):
+    terreni = filter_by_tags(db.query(Terreno), TerrenoCategoria.split(tag)).order_by(Terreno.name).all()
+    unita_in_attesa = db.query(Preferenza.unita_id).distinct().count()
     return templates.TemplateResponse(
-        "admin_terreni.html", {"request": request, "user": user, "terreni": terreni, "active_tab": "terreni"}
+        "admin_terreni.html",
+        {
+            "request": request,
+            "user": user,
+            "terreni": terreni,
+            "categorie": TerrenoCategoria.all_values(),
+            "tag_filter": tag.strip().upper() if tag else None,
+            "unita_in_attesa": unita_in_attesa,
+            "allocati": allocati,
+            "non_allocati": non_allocati,
+            "active_tab": "terreni",
+        },
+    )
+
+
+@router.post("/allocazione")
+def run_allocation(db: Session = Depends(get_db)):
+    """Assign terreni to every unit with pending preferences (see app/allocation.py)."""
+    result = allocate(db)
+    return RedirectResponse(
+        url=f"/admin/terreni?allocati={len(result.placements)}&non_allocati={len(result.unplaced)}",
+        status_code=status.HTTP_303_SEE_OTHER,
     )
 
 
 @router.post("/terreni")
-async def create_terreno(
+def create_terreno(
     request: Request,
     name: str = Form(...),
     tags: str = Form(...),
@@ -256,7 +294,7 @@ async def create_terreno(
     center_lon: str = Form(...),
     polygon: str = Form(...),
     db: Session = Depends(get_db),
-    user: User = Depends(get_admin_user),
+    user: AuthenticatedUser = Depends(get_admin_user),
 ):
     # Validate tags
     normalized_tags = tags.strip().upper()
@@ -276,8 +314,8 @@ async def create_terreno(
 
 
 @router.get("/terreni/{terreno_id}", response_class=HTMLResponse)
-async def edit_terreno(
-    request: Request, terreno_id: int, db: Session = Depends(get_db), user: User = Depends(get_admin_user)
+def edit_terreno(
+    request: Request, terreno_id: int, db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_admin_user)
 ):
     terreno = db.query(Terreno).filter(Terreno.id == terreno_id).first()
     if not terreno:
@@ -297,7 +335,7 @@ async def edit_terreno(
 
 
 @router.post("/terreni/{terreno_id}")
-async def update_terreno(
+def update_terreno(
     request: Request,
     terreno_id: int,
     name: str = Form(...),
@@ -306,7 +344,7 @@ async def update_terreno(
     center_lon: str = Form(...),
     polygon: str = Form(...),
     db: Session = Depends(get_db),
-    user: User = Depends(get_admin_user),
+    user: AuthenticatedUser = Depends(get_admin_user),
 ):
     terreno = db.query(Terreno).filter(Terreno.id == terreno_id).first()
     if not terreno:
@@ -332,19 +370,23 @@ async def update_terreno(
 
 
 @router.post("/terreni/{terreno_id}/delete")
-async def delete_terreno(
-    request: Request, terreno_id: int, db: Session = Depends(get_db), user: User = Depends(get_admin_user)
+def delete_terreno(
+    request: Request, terreno_id: int, db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_admin_user)
 ):
     terreno = db.query(Terreno).filter(Terreno.id == terreno_id).first()
     if terreno:
+        db.query(Prenotazione).filter(Prenotazione.terreno_id == terreno_id).delete()
         db.delete(terreno)
         db.commit()
     return RedirectResponse(url="/admin/terreni", status_code=status.HTTP_303_SEE_OTHER)
 
 
 @router.post("/prenotazioni/{prenotazione_id}/delete")
-async def delete_prenotazione(
-    prenotazione_id: int, request: Request, db: Session = Depends(get_db), user: User = Depends(get_admin_user)
+def delete_prenotazione(
+    prenotazione_id: int,
+    request: Request,
+    db: Session = Depends(get_db),
+    user: AuthenticatedUser = Depends(get_admin_user),
 ):
     prenotazione = db.query(Prenotazione).filter(Prenotazione.id == prenotazione_id).first()
     if prenotazione:
@@ -361,15 +403,8 @@ async def delete_prenotazione(
 # --- General Actions ---
 @router.post("/rollback/{completion_id}")
 async def rollback_completion(completion_id: int, request: Request, db: Session = Depends(get_db)):
-    completion = db.query(Completion).filter(Completion.id == completion_id).first()
-    if completion:
-        # Deduct points
-        pattuglia = completion.pattuglia
-        challenge = completion.challenge
-        pattuglia.current_score -= challenge.points
-
-        db.delete(completion)
-        db.commit()
+    # Deducts the points with a SQL-side decrement, like completions add them
+    await run_mutation(db, partial(apply_rollback, completion_id=completion_id))
 
     # Redirect back to where we came from if possible, or default to dashboard
     referer = request.headers.get("referer")
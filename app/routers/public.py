@@ -1,15 +1,35 @@
+import asyncio
+import base64
 import csv
 import io
-from datetime import datetime
+from datetime import UTC, date, datetime, timedelta
+from functools import partial
+from urllib.parse import urlencode
 
 from fastapi import APIRouter, Depends, Form, HTTPException, Request, status
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from pydantic import BaseModel
 from sqlalchemy.orm import Session, joinedload
-
-from app.auth import get_authenticated_user, get_tech_user
-from app.database import get_db
-from app.models import Challenge, Completion, Pattuglia, Prenotazione, Terreno, Unita, User
+from starlette.concurrency import run_in_threadpool
+
+from app.auth import AuthenticatedUser, get_authenticated_user, get_tech_user
+from app.availability import SLOT_MINUTES, Reservation, ReservationIndex, get_reservation_index
+from app.booking import MAX_DURATION_HOURS, MIN_DURATION_HOURS, BookingConflict, apply_booking, check_booking
+from app.completions import CompletionRejected, Entry, apply_completion, parse_sheet, register_batch
+from app.database import AsyncDB, get_async_db, get_db
+from app.events import KEEPALIVE_SECONDS, bus, format_sse
+from app.geometry import get_geometry_catalog
+from app.models import Challenge, Completion, Pattuglia, Preferenza, Prenotazione, Terreno, TerrenoCategoria, Unita
+from app.page_cache import get_page_cache
+from app.polyline import level_for_zoom
+from app.ranking import get_ranking_index
+from app.search import find_free_slots
+from app.spatial import BBox, Shape, get_spatial_index
+from app.tags import terreno_ids_with_tags
+from app.timeline import Cursor, TimelineFilter, TimelinePage
+from app.timeline import timeline_page as get_timeline_page
+from app.writer import run_mutation
 
 router = APIRouter(
     dependencies=[Depends(get_authenticated_user)]  # All public routes require at least being logged in
@@ -17,50 +37,48 @@ router = APIRouter(
 
 templates = Jinja2Templates(directory="app/templates")
 
+MAX_GRID_DAYS = 31
+MAX_NEAREST = 50
+MAX_PREFERENZE = 10
+MAX_FREE_SLOTS = 100
+MAX_SYNC_BATCH = 500
+MAX_KEY_LENGTH = 64
+
 
 @router.get("/", response_class=HTMLResponse)
-async def ranking_page(
+def ranking_page(
     request: Request,
     sottocampo_filter: str | None = None,
     db: Session = Depends(get_db),
-    user: User = Depends(get_authenticated_user),
+    user: AuthenticatedUser = Depends(get_authenticated_user),
 ):
-    query = db.query(Pattuglia).join(Unita).options(joinedload(Pattuglia.unita))
+    index = get_ranking_index(db)
 
     # Filter logic
-    if sottocampo_filter and sottocampo_filter.strip():
-        query = query.filter(Unita.sottocampo == sottocampo_filter)
-    else:
+    if not (sottocampo_filter and sottocampo_filter.strip()):
         sottocampo_filter = None
 
-    # Sort by score desc
-    pattuglie = query.order_by(Pattuglia.current_score.desc()).all()
-
-    # Calculate rank
-    for index, p in enumerate(pattuglie):
-        p.rank = index + 1
-
-    all_unita = db.query(Unita).order_by(Unita.name).all()
+    def render_content(db: Session):
+        # Already sorted by score desc, with tie-aware ranks
+        return templates.get_template("ranking_content.html").render(
+            pattuglie=index.ranking(sottocampo_filter),
+            sottocampi=index.sottocampi(),
+            current_sottocampo_filter=sottocampo_filter,
+            user=user,
+        )
 
-    # Get unique sottocampi
-    sottocampi = sorted(list(set(u.sottocampo for u in all_unita)))
+    # Only cache known sottocampi, arbitrary filter values would grow the cache without bound
+    if sottocampo_filter is None or sottocampo_filter in index.sottocampi():
+        content = get_page_cache(db).get_or_render(db, ("ranking", sottocampo_filter, user.role), render_content)
+    else:
+        content = render_content(db)
 
-    return templates.TemplateResponse(
-        "ranking.html",
-        {
-            "request": request,
-            "pattuglie": pattuglie,
-            "unita": all_unita,
-            "sottocampi": sottocampi,
-            "current_sottocampo_filter": sottocampo_filter,
-            "user": user,
-        },
-    )
+    return templates.TemplateResponse("ranking.html", {"request": request, "content": content, "user": user})
 
 
 @router.get("/prenotazioni", response_class=HTMLResponse)
-async def prenotazioni_page(
-    request: Request, db: Session = Depends(get_db), user: User = Depends(get_authenticated_user)
+def prenotazioni_page(
+    request: Request, db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_authenticated_user)
 ):
     user_reservations = []
     if user.role == "unit" and user.unita_id:
@@ -73,12 +91,18 @@ async def prenotazioni_page(
         )
 
     return templates.TemplateResponse(
-        "prenotazioni.html", {"request": request, "user": user, "user_reservations": user_reservations}
+        "prenotazioni.html",
+        {
+            "request": request,
+            "user": user,
+            "user_reservations": user_reservations,
+            "geometry_version": get_geometry_catalog(db).version(db),
+        },
     )
 
 
 @router.get("/input", response_class=HTMLResponse)
-async def input_page(request: Request, db: Session = Depends(get_db), user: User = Depends(get_tech_user)):
+def input_page(request: Request, db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_tech_user)):
     pattuglie = db.query(Pattuglia).order_by(Pattuglia.name).all()
     challenges = db.query(Challenge).order_by(Challenge.name).all()
     return templates.TemplateResponse(
@@ -86,176 +110,601 @@ async def input_page(request: Request, db: Session = Depends(get_db), user: User
     )
 
 
+def _bulk_page(
+    request: Request, db: Session, user: AuthenticatedUser, results: list[dict] | None = None, sheet: str = ""
+):
+    pattuglie = db.query(Pattuglia).options(joinedload(Pattuglia.unita)).order_by(Pattuglia.name).all()
+    challenges = db.query(Challenge).order_by(Challenge.name).all()
+    completed = {f"{pid}:{cid}" for pid, cid in db.query(Completion.pattuglia_id, Completion.challenge_id)}
+    return templates.TemplateResponse(
+        "input_bulk.html",
+        {
+            "request": request,
+            "pattuglie": pattuglie,
+            "challenges": challenges,
+            "completed": completed,
+            "results": results,
+            "sheet": sheet,
+            "user": user,
+        },
+    )
+
+
+@router.get("/input/bulk", response_class=HTMLResponse)
+def input_bulk_page(request: Request, db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_tech_user)):
+    return _bulk_page(request, db, user)
+
+
+@router.post("/input/bulk", response_class=HTMLResponse)
+def input_bulk(
+    request: Request,
+    pair: list[str] = Form([]),
+    sheet: str = Form(""),
+    db: Session = Depends(get_db),
+    user: AuthenticatedUser = Depends(get_tech_user),
+):
+    """
+    Register a whole score sheet at once: the ticked cells of the pattuglia x sfida
+    grid plus the pasted "pattuglia,sfida" rows, in one transaction, with the
+    outcome of every row.
+    """
+    pattuglie = {pid: name for pid, name in db.query(Pattuglia.id, Pattuglia.name)}
+    challenges = {cid: name for cid, name in db.query(Challenge.id, Challenge.name)}
+
+    rows: list[tuple[str, Entry | None, str | None]] = []  # (source, entry, parse error)
+    for value in pair:
+        pattuglia_id, _, challenge_id = value.partition(":")
+        if pattuglia_id.isdigit() and challenge_id.isdigit():
+            rows.append(("Griglia", Entry(int(pattuglia_id), int(challenge_id)), None))
+        else:
+            rows.append(("Griglia", None, "invalid_row"))
+    sheet_rows = parse_sheet(
+        sheet, {name: pid for pid, name in pattuglie.items()}, {name: cid for cid, name in challenges.items()}
+    )
+    rows += [(f"Riga {r.line}", r.entry, r.error) for r in sheet_rows]
+    if len(rows) > MAX_SYNC_BATCH:
+        raise HTTPException(status_code=400, detail=f"Al massimo {MAX_SYNC_BATCH} completamenti per invio")
+
+    entries = [entry for _, entry, _ in rows if entry is not None]
+    outcomes = iter(register_batch(db, entries) if entries else [])
+    results = []
+    for (source, entry, error), sheet_row in zip(rows, [None] * len(pair) + sheet_rows, strict=True):
+        if entry is None:
+            label = sheet_row.text if sheet_row is not None else ""
+            results.append({"source": source, "label": label, "status": error})
+        else:
+            pattuglia = pattuglie.get(entry.pattuglia_id, f"#{entry.pattuglia_id}")
+            label = f"{pattuglia} — {challenges.get(entry.challenge_id, f'#{entry.challenge_id}')}"
+            results.append({"source": source, "label": label, "status": next(outcomes).status})
+    # Rows that could not be read stay in the text area, to be fixed and resent
+    unread = "\n".join(r.text for r in sheet_rows if r.error)
+    return _bulk_page(request, db, user, results, unread)
+
+
 @router.get("/gestione-terreni", response_class=HTMLResponse)
-async def gestione_terreni_page(request: Request, user: User = Depends(get_tech_user)):
+def gestione_terreni_page(request: Request, user: AuthenticatedUser = Depends(get_tech_user)):
     return templates.TemplateResponse("gestione_terreni.html", {"request": request, "user": user})
 
 
 @router.post("/complete")
-async def register_completion(
+async def complete_challenge(
     pattuglia_id: int = Form(...),
     challenge_id: int = Form(...),
     db: Session = Depends(get_db),
-    user: User = Depends(get_tech_user),
+    user: AuthenticatedUser = Depends(get_tech_user),
 ):
-    # Check if already completed
-    existing = (
-        db.query(Completion)
-        .filter(Completion.pattuglia_id == pattuglia_id, Completion.challenge_id == challenge_id)
-        .first()
-    )
+    try:
+        await run_mutation(db, partial(apply_completion, pattuglia_id=pattuglia_id, challenge_id=challenge_id))
+    except CompletionRejected as e:
+        return RedirectResponse(url=f"/input?error={e.reason}", status_code=status.HTTP_303_SEE_OTHER)
 
-    if existing:
-        return RedirectResponse(url="/input?error=already_completed", status_code=status.HTTP_303_SEE_OTHER)
+    return RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
 
-    # Register completion
-    new_completion = Completion(pattuglia_id=pattuglia_id, challenge_id=challenge_id)
-    db.add(new_completion)
 
-    # Update score
-    pattuglia = db.query(Pattuglia).filter(Pattuglia.id == pattuglia_id).first()
-    challenge = db.query(Challenge).filter(Challenge.id == challenge_id).first()
+class CompletionIn(BaseModel):
+    key: str
+    pattuglia_id: int
+    challenge_id: int
+    timestamp: datetime
 
-    if pattuglia and challenge:
-        pattuglia.current_score += challenge.points
-        db.commit()
 
-    return RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
+@router.post("/api/completions/sync")
+def sync_completions(
+    completions: list[CompletionIn], db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_tech_user)
+):
+    """
+    Apply a batch from the offline queue of /input in one transaction. Each completion
+    carries a client idempotency key and the time it was entered; keys already synced
+    are answered with their stored outcome, so a resent batch is never applied twice.
+    """
+    if len(completions) > MAX_SYNC_BATCH:
+        raise HTTPException(status_code=400, detail=f"Al massimo {MAX_SYNC_BATCH} completamenti per invio")
+    if any(not 0 < len(c.key) <= MAX_KEY_LENGTH for c in completions):
+        raise HTTPException(status_code=400, detail="Chiave di idempotenza non valida")
+
+    entries = [
+        Entry(
+            c.pattuglia_id,
+            c.challenge_id,
+            # Stored as naive UTC, like Completion.timestamp defaults
+            c.timestamp.astimezone(UTC).replace(tzinfo=None) if c.timestamp.tzinfo else c.timestamp,
+            c.key,
+        )
+        for c in completions
+    ]
+    outcomes = register_batch(db, entries)
+    return [
+        {"key": c.key, "status": o.status, "completion_id": o.completion_id, "replayed": o.replayed}
+        for c, o in zip(completions, outcomes, strict=True)
+    ]
+
+
+def _optional_id(value: str) -> int | None:
+    return int(value) if value.isdigit() else None
+
+
+def timeline_filter(pattuglia_id: str = "", challenge_id: str = "", unita_id: str = "", sottocampo: str = ""):
+    """Timeline filters from the query string; the filter form sends empty values for "all"."""
+    return TimelineFilter(
+        pattuglia_id=_optional_id(pattuglia_id),
+        challenge_id=_optional_id(challenge_id),
+        unita_id=_optional_id(unita_id),
+        sottocampo=sottocampo.strip() or None,
+    )
+
+
+def _render_timeline_rows(page: TimelinePage, filters: TimelineFilter) -> str:
+    next_url = None
+    if page.next_cursor is not None:
+        next_url = "/timeline/rows?" + urlencode({**filters.query_params(), "cursor": page.next_cursor.encode()})
+    return templates.get_template("timeline_rows.html").render(page=page, next_url=next_url)
 
 
 @router.get("/timeline", response_class=HTMLResponse)
-async def timeline_page(request: Request, db: Session = Depends(get_db), user: User = Depends(get_authenticated_user)):
-    completions = (
-        db.query(Completion)
-        .options(joinedload(Completion.pattuglia), joinedload(Completion.challenge))
-        .order_by(Completion.timestamp.desc())
-        .limit(100)
-        .all()
+def timeline_page(
+    request: Request,
+    filters: TimelineFilter = Depends(timeline_filter),
+    db: Session = Depends(get_db),
+    user: AuthenticatedUser = Depends(get_authenticated_user),
+):
+    def render_content(db: Session):
+        return templates.get_template("timeline_content.html").render(
+            rows=_render_timeline_rows(get_timeline_page(db, filters), filters),
+            filters=filters,
+            sottocampi=get_ranking_index(db).sottocampi(),
+            unita=db.query(Unita).order_by(Unita.name).all(),
+            pattuglie=db.query(Pattuglia).order_by(Pattuglia.name).all(),
+            challenges=db.query(Challenge).order_by(Challenge.name).all(),
+            user=user,
+        )
+
+    # Only the unfiltered first page is cached, filter combinations would grow the cache without bound
+    if filters:
+        content = render_content(db)
+    else:
+        content = get_page_cache(db).get_or_render(db, ("timeline", None, user.role), render_content)
+    return templates.TemplateResponse(
+        "timeline.html", {"request": request, "content": content, "filtered": bool(filters), "user": user}
     )
 
-    # Deduplicate in case of race conditions or join artifacts
-    # We use a set of IDs to ensure we only show unique completion IDs
-    # If the user meant "same semantic completion", we might need more,
-    # but let's start by ensuring unique IDs.
-    # Actually, SQLAlchemy `.all()` on this query usually returns unique objects.
-    # Let's filter by (pattuglia, challenge) if they appear consecutively?
-    # No, let's just use `unique_completions` based on ID.
-    unique_completions = []
-    seen_ids = set()
-    for c in completions:
-        if c.id not in seen_ids:
-            unique_completions.append(c)
-            seen_ids.add(c.id)
-
-    # Also, lets explicitly handle the case where "double clicks" might have created 2 entries
-    # with diff IDs but same content
-    # by checking if (pattuglia_id, challenge_id) was just seen?
-    # No, that might hide legitimate re-completions if allowed (though /complete blocks it).
-    # Let's trust unique IDs for now unless the user confirms double database entries.
 
-    return templates.TemplateResponse(
-        "timeline.html", {"request": request, "completions": unique_completions, "user": user}
+@router.get("/timeline/rows", response_class=HTMLResponse)
+def timeline_rows(cursor: str, filters: TimelineFilter = Depends(timeline_filter), db: Session = Depends(get_db)):
+    """The page of rows below cursor, for the infinite scroll of /timeline (htmx)."""
+    try:
+        after = Cursor.decode(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from None
+    return HTMLResponse(_render_timeline_rows(get_timeline_page(db, filters, after), filters))
+
+
+@router.get("/events")
+async def live_events(request: Request, db: Session = Depends(get_db)):
+    """Server-Sent Events stream of score and completion updates for the live ranking/timeline."""
+    # Auth is done: give the pooled connection back, the stream can stay open for hours
+    db.close()
+    subscription = bus.subscribe()
+
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    live_event = await asyncio.wait_for(subscription.get(), timeout=KEEPALIVE_SECONDS)
+                except TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                if live_event is None:
+                    # Dropped as a slow consumer: end the stream, the browser reconnects
+                    break
+                yield format_sse(live_event)
+        finally:
+            bus.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 
 # --- API ---
-@router.get("/api/terreni/availability")
-async def get_terreni_availability(start_date: datetime, end_date: datetime, db: Session = Depends(get_db)):
+@router.get("/api/terreni/geometry")
+def get_terreni_geometry(
+    request: Request, v: str | None = None, zoom: int | None = None, db: Session = Depends(get_db)
+):
     """
-    Returns list of terrains with their availability status for the given range.
-    Status: FREE, PARTIAL, BOOKED
+    Static data of every terrain (polygon, center, description, images, tags).
+    Versioned by content hash: requested with the current hash as `v` it can be
+    cached forever, otherwise clients revalidate with the ETag.
+    With `zoom`, polygons come as an encoded polyline `path` simplified for that zoom.
     """
+    level = level_for_zoom(zoom) if zoom is not None else None
+    body, version = get_geometry_catalog(db).payload(db, level)
+    etag = f'"{version}"' if level is None else f'"{version}-{level}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=31536000, immutable" if v == version else "private, no-cache",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _reservation_json(index: ReservationIndex, r: Reservation) -> dict:
+    return {
+        "id": r.id,
+        "start": r.start.isoformat(),
+        "end": r.end.isoformat(),
+        "unit_name": index.unit_name(r.unita_id),
+    }
+
+
+def _naive(dt: datetime) -> datetime:
     # Ensure naive datetimes for comparison with SQLite naive storage
-    if start_date.tzinfo is not None:
-        start_date = start_date.replace(tzinfo=None)
-    if end_date.tzinfo is not None:
-        end_date = end_date.replace(tzinfo=None)
+    return dt.replace(tzinfo=None) if dt.tzinfo is not None else dt
 
-    terreni = db.query(Terreno).all()
-    results = []
 
-    for t in terreni:
-        # Find reservations overlapping with the requested range for this terrain
-        # Overlap logic: (StartA <= EndB) and (EndA >= StartB)
-        reservations = (
-            db.query(Prenotazione)
-            .filter(
-                Prenotazione.terreno_id == t.id,
-                Prenotazione.start_time < end_date,
-                Prenotazione.end_time > start_date,
+def _filtered_terreno_ids(db: Session, tags: str | None) -> list[int]:
+    terreno_ids = get_geometry_catalog(db).ids(db)
+    if tags:
+        matching = terreno_ids_with_tags(db, TerrenoCategoria.split(tags))
+        terreno_ids = [t_id for t_id in terreno_ids if t_id in matching]
+    return terreno_ids
+
+
+@router.get("/api/terreni/availability")
+def get_terreni_availability(
+    start_date: datetime,
+    end_date: datetime,
+    tags: str | None = None,
+    since: int | None = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Returns the availability status of every terrain for the given range,
+    optionally only terreni having all the given (comma-separated) tags.
+    Status: FREE, PARTIAL, BOOKED
+    Geometry and metadata are served by /api/terreni/geometry.
+
+    The reservation version is sent in the X-Reservations-Version header. With
+    `since=<version>` only the reservations of the range inserted, updated or
+    deleted after that version are returned (304 if nothing changed); `reset`
+    means the version is too old and the client must fetch everything again.
+    """
+    start_date, end_date = _naive(start_date), _naive(end_date)
+    index = get_reservation_index(db)
+    results = []
+    terreno_ids = _filtered_terreno_ids(db, tags)
+
+    if since is not None:
+        changes = index.changes_since(since)
+        if changes is None:
+            version = index.version
+            return JSONResponse(
+                {"version": version, "reset": True, "upserts": [], "deleted": []},
+                headers={"X-Reservations-Version": str(version)},
             )
-            .all()
+        version, upserts, deleted = changes
+        headers = {"X-Reservations-Version": str(version)}
+        if version == since:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        # Reservations that moved out of the range or filter are gone as far as the client is concerned
+        wanted = set(terreno_ids)
+        visible = [r for r in upserts if r.terreno_id in wanted and r.start < end_date and r.end > start_date]
+        shown = {r.id for r in visible}
+        deleted = sorted(deleted + [r.id for r in upserts if r.id not in shown])
+        return JSONResponse(
+            {
+                "version": version,
+                "reset": False,
+                "upserts": [{**_reservation_json(index, r), "terreno_id": r.terreno_id} for r in visible],
+                "deleted": deleted,
+            },
+            headers=headers,
         )
 
-        status = "FREE"
-        if reservations:
-            # Check if fully booked or partially
-            # Simplification: If any reservation covers the entire requested range (unlikely for broad range)
-            # or if reservations cover the *entirety* of the range?
-            # User requirement:
-            # "free terrain polygons in that slot should appear as green"
-            # "partially available ones should appear in yellow"
-            # "completely booked one should appear gray"
-
-            # Use total seconds logic or simple overlap check?
-            # If the requested range is small (e.g. 1 hour slot), it's binary (Free or Booked).
-            # If the requested range is large (e.g. a day), it could be Partial.
-
-            # Let's calculate covered duration
-            total_duration = (end_date - start_date).total_seconds()
-            covered_duration = 0
-
-            # This is complex because reservations might overlap each other
-            # (though DB shouldn't allow it for same terrain)
-            # Assuming non-overlapping reservations for same terrain:
-            for r in reservations:
-                # Intersect reservation [r.start, r.end] with window [start, end]
-                overlap_start = max(r.start_time, start_date)
-                overlap_end = min(r.end_time, end_date)
-                covered_duration += max(0, (overlap_end - overlap_start).total_seconds())
-
-            if covered_duration >= total_duration:
-                status = "BOOKED"
-            elif covered_duration > 0:
-                status = "PARTIAL"
+    version = index.version
+    for terreno_id in terreno_ids:
+        # Served from the in-memory interval index, no table scan
+        reservations = index.overlapping(terreno_id, start_date, end_date)
 
         results.append(
             {
-                "id": t.id,
-                "name": t.name,
-                "tags": t.tags,
-                "polygon": t.polygon,
-                "center_lat": t.center_lat,
-                "center_lon": t.center_lon,
-                "description": t.description,
-                "image_urls": t.image_urls,
-                "status": status,
-                "reservations": [
-                    {"start": r.start_time.isoformat(), "end": r.end_time.isoformat(), "unit_name": r.unita.name}
-                    for r in reservations
-                ],
+                "id": terreno_id,
+                "status": index.status(terreno_id, start_date, end_date),
+                "reservations": [_reservation_json(index, r) for r in reservations],
             }
         )
 
-    return results
+    return JSONResponse(results, headers={"X-Reservations-Version": str(version)})
+
+
+@router.get("/api/terreni/status")
+def get_terreni_status(
+    start_date: datetime, end_date: datetime, tags: str | None = None, db: Session = Depends(get_db)
+):
+    """
+    Only the FREE/PARTIAL/BOOKED status of every terreno for the window, keyed by id:
+    what the map needs to recolor its polygons when the date or hours change.
+    """
+    start_date, end_date = _naive(start_date), _naive(end_date)
+    index = get_reservation_index(db)
+    version = index.version
+    statuses = {
+        terreno_id: index.status(terreno_id, start_date, end_date) for terreno_id in _filtered_terreno_ids(db, tags)
+    }
+    return JSONResponse(statuses, headers={"X-Reservations-Version": str(version)})
+
+
+def _shape_json(shape: Shape) -> dict:
+    return {
+        "id": shape.id,
+        "name": shape.name,
+        "tags": sorted(shape.tags),
+        "bbox": [shape.bbox.min_lat, shape.bbox.min_lon, shape.bbox.max_lat, shape.bbox.max_lon],
+    }
+
+
+@router.get("/api/terreni/at")
+def get_terreni_at(lat: float, lon: float, db: Session = Depends(get_db)):
+    """Terreni whose polygon contains the GPS point."""
+    return [_shape_json(s) for s in get_spatial_index(db).containing(lat, lon)]
+
+
+@router.get("/api/terreni/in-bbox")
+def get_terreni_in_bbox(min_lat: float, min_lon: float, max_lat: float, max_lon: float, db: Session = Depends(get_db)):
+    """Terreni whose bounding box intersects the given one (e.g. the visible map area)."""
+    if min_lat > max_lat or min_lon > max_lon:
+        raise HTTPException(status_code=400, detail="Invalid bounding box")
+    box = BBox(min_lat, min_lon, max_lat, max_lon)
+    return [_shape_json(s) for s in get_spatial_index(db).intersecting(box)]
+
+
+@router.get("/api/terreni/nearest")
+def get_terreni_nearest(lat: float, lon: float, k: int = 5, tags: str = "", db: Session = Depends(get_db)):
+    """The k terreni closest to the point having all the given (comma-separated) tags."""
+    if not 1 <= k <= MAX_NEAREST:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {MAX_NEAREST}")
+    wanted = frozenset(TerrenoCategoria.split(tags))
+    return [
+        {**_shape_json(s), "distance_m": round(distance, 1)}
+        for s, distance in get_spatial_index(db).nearest(lat, lon, k, wanted)
+    ]
+
+
+@router.get("/api/terreni/free-slots")
+def search_free_slots(
+    tags: str,
+    duration: int,
+    start_date: date,
+    end_date: date,
+    earliest_hour: int = 0,
+    latest_hour: int = 24,
+    limit: int = 20,
+    db: Session = Depends(get_db),
+):
+    """
+    Ranked free windows of `duration` hours on terreni having all the given tags,
+    between start_date and end_date (inclusive) and within [earliest_hour, latest_hour).
+    """
+    wanted = set(TerrenoCategoria.split(tags))
+    invalid = sorted(wanted - set(TerrenoCategoria.all_values()))
+    if not wanted or invalid:
+        raise HTTPException(
+            status_code=400, detail=f"Tag non validi: {invalid}. Tag validi: {TerrenoCategoria.all_values()}"
+        )
+    if not MIN_DURATION_HOURS <= duration <= MAX_DURATION_HOURS:
+        raise HTTPException(status_code=400, detail="La durata deve essere tra 1 e 4 ore")
+    if not 0 <= (end_date - start_date).days < MAX_GRID_DAYS:
+        raise HTTPException(status_code=400, detail=f"Intervallo di date non valido (massimo {MAX_GRID_DAYS} giorni)")
+    if not 0 <= earliest_hour < latest_hour <= 24:
+        raise HTTPException(status_code=400, detail="Fascia oraria non valida")
+    if not 1 <= limit <= MAX_FREE_SLOTS:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_FREE_SLOTS}")
+
+    matching = terreno_ids_with_tags(db, wanted)
+    terreni = [(t_id, name) for t_id, name, _ in get_geometry_catalog(db).terreni(db) if t_id in matching]
+    slots = find_free_slots(
+        get_reservation_index(db),
+        terreni,
+        duration,
+        start_date,
+        end_date,
+        earliest_hour,
+        latest_hour,
+        limit=limit,
+    )
+    return [
+        {
+            "terreno_id": slot.terreno_id,
+            "terreno_name": slot.terreno_name,
+            "start": slot.start.isoformat(),
+            "end": (slot.start + timedelta(hours=duration)).isoformat(),
+            "latest_start": slot.latest_start.isoformat(),
+            "gap_minutes": slot.gap_minutes,
+        }
+        for slot in slots
+    ]
+
+
+@router.get("/api/terreni/{terreno_id}/grid")
+def get_terreno_grid(terreno_id: int, start_date: date, days: int = 15, db: Session = Depends(get_db)):
+    """
+    Occupancy matrix of one terreno: one row per day, one 15-minute slot per bit.
+    `occupancy` holds each day's bitmap as hex (bit i = slot i), `owners` each day's
+    slots as base64 little-endian uint16s indexing into `units` (0 = free, k = units[k - 1]).
+    """
+    if not 1 <= days <= MAX_GRID_DAYS:
+        raise HTTPException(status_code=400, detail=f"days must be between 1 and {MAX_GRID_DAYS}")
+    if db.get(Terreno, terreno_id) is None:
+        raise HTTPException(status_code=404, detail="Terreno not found")
+
+    index = get_reservation_index(db)
+    masks, owners, unit_ids = index.grid(terreno_id, start_date, days)
+    return {
+        "terreno_id": terreno_id,
+        "start_date": start_date.isoformat(),
+        "days": days,
+        "slot_minutes": SLOT_MINUTES,
+        "occupancy": [f"{mask:x}" for mask in masks],
+        "owners": [base64.b64encode(row).decode() for row in owners],
+        "units": [{"id": unita_id, "name": index.unit_name(unita_id)} for unita_id in unit_ids],
+    }
+
+
+@router.post("/api/prenotazioni", status_code=status.HTTP_201_CREATED)
+async def create_prenotazione(
+    terreno_id: int = Form(...),
+    start: datetime = Form(...),
+    duration: int = Form(...),
+    unita_id: int | None = Form(None),
+    db: AsyncDB = Depends(get_async_db),
+    user: AuthenticatedUser = Depends(get_authenticated_user),
+):
+    """
+    Book a terreno. Units book for themselves, tech/admin for the given unita_id.
+    Conflicts are answered with 409 and a `reason` code (terreno_booked, unita_busy, ...).
+    """
+    if user.role == "unit":
+        if not user.unita_id or unita_id not in (None, user.unita_id):
+            raise HTTPException(status_code=403, detail="Not authorized")
+        unita_id = user.unita_id
+    elif unita_id is None:
+        raise HTTPException(status_code=400, detail="unita_id is required")
+
+    if start.tzinfo is not None:
+        start = start.replace(tzinfo=None)
+
+    try:
+        await db.run(check_booking, terreno_id, start, duration)
+        prenotazione = await run_mutation(
+            db.session, partial(apply_booking, terreno_id=terreno_id, unita_id=unita_id, start=start, duration=duration)
+        )
+    except BookingConflict as e:
+        raise HTTPException(status_code=e.status_code, detail=e.to_dict()) from e
+
+    # Committed on the request's session its attributes are expired: reloading them is a query
+    return await run_in_threadpool(_prenotazione_json, prenotazione)
+
+
+def _prenotazione_json(prenotazione: Prenotazione) -> dict:
+    return {
+        "id": prenotazione.id,
+        "terreno_id": prenotazione.terreno_id,
+        "unita_id": prenotazione.unita_id,
+        "start": prenotazione.start_time.isoformat(),
+        "end": prenotazione.end_time.isoformat(),
+        "duration": prenotazione.duration,
+        "status": prenotazione.status,
+    }
+
+
+class PreferenzaIn(BaseModel):
+    tag: str
+    day: date
+    earliest_hour: int
+    latest_hour: int
+    duration: int
+
+
+def _preferenza_json(p: Preferenza) -> dict:
+    return {
+        "rank": p.rank,
+        "tag": p.tag,
+        "day": p.day.isoformat(),
+        "earliest_hour": p.earliest_hour,
+        "latest_hour": p.latest_hour,
+        "duration": p.duration,
+    }
+
+
+@router.get("/api/preferenze")
+def get_preferenze(db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_authenticated_user)):
+    """The unit's ranked wishes for the next batch allocation."""
+    if not user.unita_id:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    preferenze = db.query(Preferenza).filter(Preferenza.unita_id == user.unita_id).order_by(Preferenza.rank)
+    return [_preferenza_json(p) for p in preferenze]
+
+
+@router.put("/api/preferenze")
+def set_preferenze(
+    preferenze: list[PreferenzaIn],
+    db: Session = Depends(get_db),
+    user: AuthenticatedUser = Depends(get_authenticated_user),
+):
+    """Replace the unit's wishes; list order is the ranking (first = most wanted)."""
+    if not user.unita_id:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if len(preferenze) > MAX_PREFERENZE:
+        raise HTTPException(status_code=400, detail=f"Al massimo {MAX_PREFERENZE} preferenze")
+
+    rows = []
+    for rank, p in enumerate(preferenze, start=1):
+        tag = p.tag.strip().upper()
+        if tag not in TerrenoCategoria.all_values():
+            raise HTTPException(
+                status_code=400, detail=f"Tag non valido: {p.tag}. Tag validi: {TerrenoCategoria.all_values()}"
+            )
+        if not MIN_DURATION_HOURS <= p.duration <= MAX_DURATION_HOURS:
+            raise HTTPException(status_code=400, detail="La durata deve essere tra 1 e 4 ore")
+        if not 0 <= p.earliest_hour < p.latest_hour <= 24 or p.latest_hour - p.earliest_hour < p.duration:
+            raise HTTPException(status_code=400, detail="Fascia oraria non valida")
+        rows.append(
+            Preferenza(
+                unita_id=user.unita_id,
+                rank=rank,
+                tag=tag,
+                day=p.day,
+                earliest_hour=p.earliest_hour,
+                latest_hour=p.latest_hour,
+                duration=p.duration,
+            )
+        )
+
+    db.query(Preferenza).filter(Preferenza.unita_id == user.unita_id).delete()
+    db.add_all(rows)
+    db.commit()
+    return [_preferenza_json(p) for p in rows]
 
 
 @router.get("/export/ranking")
-async def export_ranking(db: Session = Depends(get_db), user: User = Depends(get_authenticated_user)):
+def export_ranking(db: Session = Depends(get_db), user: AuthenticatedUser = Depends(get_authenticated_user)):
     # Technically only tech/admin should export? Or maybe units too?
     # Requirement: "witouth the export button" for units.
     # So we should block it or just hide it. Let's block it for 'unit' role to be safe.
     if user.role == "unit":
         raise HTTPException(status_code=403, detail="Not authorized")
 
-    pattuglie = db.query(Pattuglia).options(joinedload(Pattuglia.unita)).order_by(Pattuglia.current_score.desc()).all()
+    pattuglie = get_ranking_index(db).ranking()
 
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow(["Posizione", "Pattuglia", "Capo Pattuglia", "Unità", "Sottocampo", "Punteggio"])
 
-    for index, p in enumerate(pattuglie):
-        writer.writerow([index + 1, p.name, p.capo_pattuglia, p.unita.name, p.unita.sottocampo, p.current_score])
+    for p in pattuglie:
+        writer.writerow([p.rank, p.name, p.capo_pattuglia, p.unita.name, p.unita.sottocampo, p.current_score])
 
     output.seek(0)
 
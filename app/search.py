@@ -0,0 +1,84 @@
+"""
+Free-slot search: "find me N hours on a BIVACCO terreno".
+
+Works on the per-day occupancy bitmaps of the reservation index: for every
+matching terreno and day the free slots inside the requested hours are one
+mask operation, and each maximal free run long enough for the duration becomes
+one candidate (its earliest aligned start, plus the latest start that still
+fits). Candidates are ranked by start time, then by how snugly the request fills
+the gap, so short gaps are used before long free stretches get split.
+"""
+
+import math
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+
+from app.availability import SLOT_MINUTES, ReservationIndex
+
+SLOTS_PER_HOUR = 60 // SLOT_MINUTES
+
+
+@dataclass(frozen=True)
+class FreeSlot:
+    terreno_id: int
+    terreno_name: str
+    start: datetime
+    latest_start: datetime  # The gap allows any aligned start up to this one
+    gap_minutes: int  # Length of the free run containing the slot
+
+    @property
+    def slack_minutes(self) -> int:
+        return int((self.latest_start - self.start).total_seconds() // 60)
+
+
+def free_runs(free: int):
+    """(first_slot, length) of each run of set bits, lowest first."""
+    while free:
+        first = (free & -free).bit_length() - 1
+        shifted = free >> first
+        length = (~shifted & (shifted + 1)).bit_length() - 1
+        yield first, length
+        free &= ~(((1 << length) - 1) << first)
+
+
+def find_free_slots(
+    index: ReservationIndex,
+    terreni: list[tuple[int, str]],
+    duration_hours: int,
+    first_day: date,
+    last_day: date,
+    earliest_hour: int = 0,
+    latest_hour: int = 24,
+    step_minutes: int = 60,
+    limit: int = 20,
+) -> list[FreeSlot]:
+    """
+    Free windows of `duration_hours` between earliest_hour and latest_hour on
+    first_day..last_day, on the given (id, name) terreni (already filtered by tag).
+    """
+    need = duration_hours * SLOTS_PER_HOUR
+    step = max(1, step_minutes // SLOT_MINUTES)
+    window = ((1 << latest_hour * SLOTS_PER_HOUR) - 1) ^ ((1 << earliest_hour * SLOTS_PER_HOUR) - 1)
+    days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+
+    candidates = []
+    for terreno_id, name in terreni:
+        for day, occupied in zip(days, index.day_masks(terreno_id, days), strict=True):
+            midnight = datetime.combine(day, time())
+            for first, length in free_runs(window & ~occupied):
+                start = math.ceil(first / step) * step
+                last_start = (first + length - need) // step * step
+                if start > last_start:
+                    continue
+                candidates.append(
+                    FreeSlot(
+                        terreno_id,
+                        name,
+                        midnight + timedelta(minutes=start * SLOT_MINUTES),
+                        midnight + timedelta(minutes=last_start * SLOT_MINUTES),
+                        length * SLOT_MINUTES,
+                    )
+                )
+
+    candidates.sort(key=lambda c: (c.start, c.gap_minutes, c.terreno_name))
+    return candidates[:limit]
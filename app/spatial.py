@@ -0,0 +1,251 @@
+"""
+Spatial index over terreno polygons.
+
+Polygons are parsed once into rings with precomputed bounding boxes and packed
+into an STR (sort-tile-recursive) R-tree, so "which terreno am I in", "what is
+in this map view" and "closest terreni with these tags" only test the few
+polygons whose boxes are relevant. Like the geometry catalog it is built per
+database engine and dropped whenever a terreno change is committed; the next
+query rebuilds it.
+"""
+
+import heapq
+import json
+import math
+import threading
+from dataclasses import dataclass
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.models import Terreno, TerrenoCategoria
+
+_DIRTY_KEY = "spatial_dirty"
+
+NODE_CAPACITY = 8
+
+# Metres per degree, good enough at the camp's scale (equirectangular approximation)
+_METRES_PER_DEGREE_LAT = 110_574
+_METRES_PER_DEGREE_LON_EQUATOR = 111_320
+
+
+@dataclass(frozen=True)
+class BBox:
+    min_lat: float
+    min_lon: float
+    max_lat: float
+    max_lon: float
+
+    @classmethod
+    def around(cls, points: list[tuple[float, float]]) -> "BBox":
+        lats = [lat for lat, _ in points]
+        lons = [lon for _, lon in points]
+        return cls(min(lats), min(lons), max(lats), max(lons))
+
+    @classmethod
+    def union(cls, boxes: list["BBox"]) -> "BBox":
+        return cls(
+            min(b.min_lat for b in boxes),
+            min(b.min_lon for b in boxes),
+            max(b.max_lat for b in boxes),
+            max(b.max_lon for b in boxes),
+        )
+
+    def intersects(self, other: "BBox") -> bool:
+        return not (
+            other.min_lat > self.max_lat
+            or other.max_lat < self.min_lat
+            or other.min_lon > self.max_lon
+            or other.max_lon < self.min_lon
+        )
+
+    def contains_point(self, lat: float, lon: float) -> bool:
+        return self.min_lat <= lat <= self.max_lat and self.min_lon <= lon <= self.max_lon
+
+    def distance_m(self, lat: float, lon: float) -> float:
+        """Distance in metres from the point to the box (0 inside)."""
+        dlat = max(self.min_lat - lat, 0, lat - self.max_lat)
+        dlon = max(self.min_lon - lon, 0, lon - self.max_lon)
+        return math.hypot(dlat * _METRES_PER_DEGREE_LAT, dlon * _lon_scale(lat))
+
+    @property
+    def center(self) -> tuple[float, float]:
+        return (self.min_lat + self.max_lat) / 2, (self.min_lon + self.max_lon) / 2
+
+
+def _lon_scale(lat: float) -> float:
+    return _METRES_PER_DEGREE_LON_EQUATOR * math.cos(math.radians(lat))
+
+
+@dataclass(frozen=True)
+class Shape:
+    id: int
+    name: str
+    tags: frozenset[str]
+    ring: tuple[tuple[float, float], ...]
+    bbox: BBox
+
+    def contains(self, lat: float, lon: float) -> bool:
+        """Ray casting point-in-polygon test."""
+        if not self.bbox.contains_point(lat, lon):
+            return False
+        inside = False
+        ring = self.ring
+        j = len(ring) - 1
+        for i in range(len(ring)):
+            (lat_i, lon_i), (lat_j, lon_j) = ring[i], ring[j]
+            if (lat_i > lat) != (lat_j > lat):
+                crossing = lon_i + (lat - lat_i) * (lon_j - lon_i) / (lat_j - lat_i)
+                if lon < crossing:
+                    inside = not inside
+            j = i
+        return inside
+
+    def distance_m(self, lat: float, lon: float) -> float:
+        """Distance in metres from the point to the polygon (0 inside)."""
+        if self.contains(lat, lon):
+            return 0.0
+        scale = _lon_scale(lat)
+        px, py = lon * scale, lat * _METRES_PER_DEGREE_LAT
+        best = math.inf
+        for (lat_a, lon_a), (lat_b, lon_b) in zip(self.ring, self.ring[1:] + self.ring[:1], strict=True):
+            ax, ay = lon_a * scale, lat_a * _METRES_PER_DEGREE_LAT
+            bx, by = lon_b * scale, lat_b * _METRES_PER_DEGREE_LAT
+            dx, dy = bx - ax, by - ay
+            length = dx * dx + dy * dy
+            t = 0.0 if length == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length))
+            best = min(best, math.hypot(px - ax - t * dx, py - ay - t * dy))
+        return best
+
+
+def shape_from_terreno(t: Terreno) -> Shape | None:
+    """Shape of a terreno, or None if its polygon is not a list of at least 3 [lat, lon] pairs."""
+    try:
+        ring = tuple((float(lat), float(lon)) for lat, lon in json.loads(t.polygon))
+    except (TypeError, ValueError):
+        return None
+    if len(ring) > 1 and ring[0] == ring[-1]:
+        ring = ring[:-1]  # Closed rings repeat the first vertex
+    if len(ring) < 3:
+        return None
+    return Shape(t.id, t.name, frozenset(TerrenoCategoria.split(t.tags)), ring, BBox.around(list(ring)))
+
+
+@dataclass(frozen=True)
+class _Node:
+    bbox: BBox
+    children: tuple["_Node", ...] = ()
+    shape: Shape | None = None  # Set on leaf entries
+
+
+class SpatialIndex:
+    """STR-packed R-tree over terreno shapes (static: rebuilt rather than updated)."""
+
+    def __init__(self, shapes: list[Shape], node_capacity: int = NODE_CAPACITY):
+        self.shapes = {s.id: s for s in shapes}
+        self._root = self._pack([_Node(s.bbox, shape=s) for s in shapes], node_capacity)
+
+    @classmethod
+    def from_session(cls, db: Session) -> "SpatialIndex":
+        shapes = [shape_from_terreno(t) for t in db.query(Terreno).order_by(Terreno.id)]
+        return cls([s for s in shapes if s is not None])
+
+    @staticmethod
+    def _pack(nodes: list[_Node], capacity: int) -> _Node | None:
+        if not nodes:
+            return None
+        while len(nodes) > 1:
+            # Sort-tile-recursive: vertical slices by longitude, then runs by latitude within each slice
+            groups = math.ceil(len(nodes) / capacity)
+            per_slice = math.ceil(math.sqrt(groups)) * capacity
+            nodes = sorted(nodes, key=lambda n: n.bbox.center[1])
+            parents = []
+            for s in range(0, len(nodes), per_slice):
+                tile = sorted(nodes[s : s + per_slice], key=lambda n: n.bbox.center[0])
+                for g in range(0, len(tile), capacity):
+                    children = tuple(tile[g : g + capacity])
+                    parents.append(_Node(BBox.union([c.bbox for c in children]), children))
+            nodes = parents
+        return nodes[0]
+
+    def _search(self, box: BBox):
+        stack = [self._root] if self._root is not None and self._root.bbox.intersects(box) else []
+        while stack:
+            node = stack.pop()
+            if node.shape is not None:
+                yield node.shape
+            else:
+                stack.extend(c for c in node.children if c.bbox.intersects(box))
+
+    def intersecting(self, box: BBox) -> list[Shape]:
+        """Shapes whose bounding box intersects the box, by id."""
+        return sorted(self._search(box), key=lambda s: s.id)
+
+    def containing(self, lat: float, lon: float) -> list[Shape]:
+        """Shapes containing the point, by id."""
+        point = BBox(lat, lon, lat, lon)
+        return sorted((s for s in self._search(point) if s.contains(lat, lon)), key=lambda s: s.id)
+
+    def nearest(self, lat: float, lon: float, k: int, tags: frozenset[str] = frozenset()) -> list[tuple[Shape, float]]:
+        """Up to k shapes having all the tags, closest first, with their distance in metres."""
+        if self._root is None:
+            return []
+        # Best-first search: boxes are lower bounds of everything below them
+        heap: list[tuple[float, int, _Node | Shape]] = [(0.0, 0, self._root)]
+        counter = 1
+        results: list[tuple[Shape, float]] = []
+        while heap and len(results) < k:
+            distance, _, item = heapq.heappop(heap)
+            if isinstance(item, Shape):
+                results.append((item, distance))
+                continue
+            if item.shape is not None:
+                if tags <= item.shape.tags:
+                    heapq.heappush(heap, (item.shape.distance_m(lat, lon), counter, item.shape))
+                    counter += 1
+                continue
+            for child in item.children:
+                heapq.heappush(heap, (child.bbox.distance_m(lat, lon), counter, child))
+                counter += 1
+        return results
+
+
+# --- Registry (one index per database engine) ---
+
+_indexes: WeakKeyDictionary[Engine, SpatialIndex] = WeakKeyDictionary()
+_registry_lock = threading.Lock()
+
+
+def get_spatial_index(db: Session) -> SpatialIndex:
+    """Return the spatial index for the session's database, building it on first use."""
+    engine = db.get_bind().engine
+    with _registry_lock:
+        index = _indexes.get(engine)
+        if index is None:
+            index = SpatialIndex.from_session(db)
+            _indexes[engine] = index
+        return index
+
+
+# --- Session event hooks ---
+
+
+@event.listens_for(Session, "after_flush")
+def _mark_terreno_changes(session: Session, flush_context):
+    if any(isinstance(obj, Terreno) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info[_DIRTY_KEY] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _drop_index(session: Session):
+    if not session.info.pop(_DIRTY_KEY, False):
+        return
+    with _registry_lock:
+        _indexes.pop(session.get_bind().engine, None)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_mark(session: Session):
+    session.info.pop(_DIRTY_KEY, None)
@@ -0,0 +1,37 @@
+"""
+Tag filtering through the terreno_tags association table.
+
+`Terreno.tags` stays the display copy; every write also maintains one
+terreno_tags row per tag, so "terreni having all these tags" is a lookup on
+ix_terreno_tags_tag instead of parsing every terreno's string.
+"""
+
+from collections.abc import Iterable
+
+from sqlalchemy import Select, func, select
+from sqlalchemy.orm import Query, Session
+
+from app.models import Terreno, TerrenoTag
+
+
+def _matching_ids(tags: list[str]) -> Select:
+    return (
+        select(TerrenoTag.terreno_id)
+        .where(TerrenoTag.tag.in_(tags))
+        .group_by(TerrenoTag.terreno_id)
+        .having(func.count(TerrenoTag.tag) == len(tags))
+    )
+
+
+def terreno_ids_with_tags(db: Session, tags: Iterable[str]) -> set[int]:
+    """Ids of the terreni having all the tags."""
+    wanted = sorted(set(tags))
+    return set(db.scalars(_matching_ids(wanted)))
+
+
+def filter_by_tags(query: Query, tags: Iterable[str]) -> Query:
+    """Restrict a Terreno query to terreni having all the tags (no-op without tags)."""
+    wanted = sorted(set(tags))
+    if not wanted:
+        return query
+    return query.filter(Terreno.id.in_(_matching_ids(wanted)))
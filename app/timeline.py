@@ -0,0 +1,91 @@
+"""
+Keyset pagination of the completion timeline.
+
+Pages are ordered newest first on (timestamp, id) and each one ends with a
+cursor, the key of its last row: the next page is the rows strictly below it.
+Unlike an OFFSET, a deep page starts by seeking the (timestamp, id) index to the
+cursor, so it costs the same as the first one, and completions registered while
+scrolling don't shift rows between pages. Filters only narrow the rows below the
+cursor: pattuglia and challenge have their own (column, timestamp, id) index,
+unità and sottocampo select the pattuglie of the matching units.
+"""
+
+from dataclasses import asdict, dataclass
+from datetime import datetime
+
+from sqlalchemy import literal, select, tuple_
+from sqlalchemy.orm import Session, joinedload
+
+from app.models import Completion, Pattuglia, Unita
+
+PAGE_SIZE = 50
+
+
+@dataclass(frozen=True)
+class Cursor:
+    timestamp: datetime
+    id: int
+
+    def encode(self) -> str:
+        return f"{self.timestamp.isoformat()}_{self.id}"
+
+    @classmethod
+    def decode(cls, value: str) -> "Cursor":
+        """Inverse of encode; raises ValueError on anything else."""
+        timestamp, sep, completion_id = value.rpartition("_")
+        if not sep:
+            raise ValueError(f"Invalid cursor: {value!r}")
+        return cls(datetime.fromisoformat(timestamp), int(completion_id))
+
+
+@dataclass(frozen=True)
+class TimelineFilter:
+    pattuglia_id: int | None = None
+    challenge_id: int | None = None
+    unita_id: int | None = None
+    sottocampo: str | None = None
+
+    def __bool__(self) -> bool:
+        return any(value is not None for value in asdict(self).values())
+
+    def query_params(self) -> dict[str, int | str]:
+        """The filters set, as query parameters for the next-page links."""
+        return {name: value for name, value in asdict(self).items() if value is not None}
+
+
+@dataclass
+class TimelinePage:
+    completions: list[Completion]
+    next_cursor: Cursor | None  # None on the last page
+
+
+def timeline_page(
+    db: Session, filters: TimelineFilter = TimelineFilter(), cursor: Cursor | None = None, limit: int = PAGE_SIZE
+) -> TimelinePage:
+    query = db.query(Completion).options(
+        joinedload(Completion.pattuglia).joinedload(Pattuglia.unita), joinedload(Completion.challenge)
+    )
+
+    if filters.pattuglia_id is not None:
+        query = query.filter(Completion.pattuglia_id == filters.pattuglia_id)
+    if filters.challenge_id is not None:
+        query = query.filter(Completion.challenge_id == filters.challenge_id)
+    if filters.unita_id is not None or filters.sottocampo is not None:
+        pattuglie = select(Pattuglia.id).join(Unita)
+        if filters.unita_id is not None:
+            pattuglie = pattuglie.where(Unita.id == filters.unita_id)
+        if filters.sottocampo is not None:
+            pattuglie = pattuglie.where(Unita.sottocampo == filters.sottocampo)
+        query = query.filter(Completion.pattuglia_id.in_(pattuglie))
+
+    if cursor is not None:
+        query = query.filter(
+            tuple_(Completion.timestamp, Completion.id) < tuple_(literal(cursor.timestamp), literal(cursor.id))
+        )
+
+    # One row past the page tells whether there is a next one
+    rows = query.order_by(Completion.timestamp.desc(), Completion.id.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return TimelinePage(rows, None)
+    rows = rows[:limit]
+    return TimelinePage(rows, Cursor(rows[-1].timestamp, rows[-1].id))
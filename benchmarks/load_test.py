@@ -0,0 +1,137 @@
+"""
+Throughput of the read routes versus the number of concurrent clients.
+
+    uv run python benchmarks/load_test.py --requests 400 --concurrency 1 4 16 32
+
+The real app is driven in-process over httpx's ASGI transport, logged in as a
+tech user. It runs against a throwaway SQLite database seeded with a camp's
+worth of units, pattuglie and completions. The requests rotate over filtered
+timeline pages, which are never cached, timeline deep pages, the ranking, and
+the CSV export. For each concurrency the script reports requests/s and the
+p50/p95 latency. The longest event-loop stall is reported too. The loop only
+dispatches now, so it should stay in the milliseconds, and requests/s should
+grow with concurrency until the worker pool (DB_THREADS) or the CPUs are
+saturated. It should not stay flat, as it would if every query ran on the loop.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# Before the app is imported: the engine binds to DATABASE_URL on import
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/load_test.db"
+
+import httpx  # noqa: E402
+
+from app import main  # noqa: E402
+from app.auth import pwd_context  # noqa: E402
+from app.database import SessionLocal, configure_thread_pool, engine  # noqa: E402
+from app.migrations import upgrade_schema  # noqa: E402
+from app.models import Challenge, Completion, Pattuglia, Unita, User  # noqa: E402
+from app.timeline import Cursor  # noqa: E402
+
+SOTTOCAMPI = ["Alpino", "Prealpino", "Montano", "Collinare"]
+
+
+def seed(units: int, pattuglie_per_unit: int, challenges: int) -> list[str]:
+    """The URLs to hit, built from the seeded rows."""
+    rng = random.Random(1)
+    upgrade_schema(engine)  # The ASGI transport skips the lifespan that would create the tables
+    with SessionLocal() as db:
+        db.add(User(username="load", password_hash=pwd_context.hash("load"), role="tech"))
+        unita = [Unita(name=f"Unità {i}", sottocampo=SOTTOCAMPI[i % len(SOTTOCAMPI)]) for i in range(units)]
+        db.add_all(unita)
+        db.flush()
+        pattuglie = [
+            Pattuglia(name=f"Pattuglia {u.id}.{j}", capo_pattuglia="Capo", unita_id=u.id)
+            for u in unita
+            for j in range(pattuglie_per_unit)
+        ]
+        sfide = [Challenge(name=f"Sfida {i}", description="", points=rng.randint(1, 20)) for i in range(challenges)]
+        db.add_all([*pattuglie, *sfide])
+        db.flush()
+
+        start = datetime(2026, 7, 25, 8, 0)
+        completions = [
+            Completion(pattuglia_id=p.id, challenge_id=c.id, timestamp=start + timedelta(seconds=rng.randint(0, 86400)))
+            for p in pattuglie
+            for c in sfide
+            if rng.random() < 0.5
+        ]
+        db.add_all(completions)
+        db.commit()
+        middle = sorted(completions, key=lambda c: (c.timestamp, c.id))[len(completions) // 2]
+        cursor = Cursor(middle.timestamp, middle.id).encode()
+        return [
+            *(f"/timeline?sottocampo={s}" for s in SOTTOCAMPI),
+            *(f"/timeline?unita_id={u.id}" for u in unita[:8]),
+            f"/timeline/rows?cursor={cursor}",
+            f"/timeline/rows?cursor={cursor}&sottocampo=Alpino",
+            "/",
+            "/export/ranking",
+        ]
+
+
+async def watch_loop(stop: asyncio.Event) -> float:
+    longest = 0.0
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(0.01)
+        now = time.perf_counter()
+        longest = max(longest, now - last - 0.01)
+        last = now
+    return longest
+
+
+async def run(urls: list[str], requests: int, concurrency: int) -> tuple[float, list[float], float]:
+    configure_thread_pool()
+    transport = httpx.ASGITransport(app=main.app)
+    latencies: list[float] = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://load") as client:
+        await client.post("/login", data={"username": "load", "password": "load"})
+        queue = iter(range(requests))
+
+        async def worker():
+            for i in queue:
+                started = time.perf_counter()
+                response = await client.get(urls[i % len(urls)])
+                if response.status_code != 200:
+                    raise RuntimeError(f"{urls[i % len(urls)]} answered {response.status_code}")
+                latencies.append(time.perf_counter() - started)
+
+        stop = asyncio.Event()
+        watcher = asyncio.create_task(watch_loop(stop))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        return elapsed, latencies, await watcher
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--units", type=int, default=40)
+    args = parser.parse_args()
+
+    urls = seed(args.units, pattuglie_per_unit=4, challenges=40)
+    print(f"{args.requests} requests per run, {os.cpu_count()} CPUs")
+    print(f"{'clients':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'max loop stall':>15}")
+    for concurrency in args.concurrency:
+        elapsed, latencies, stall = asyncio.run(run(urls, args.requests, concurrency))
+        p50 = statistics.median(latencies) * 1000
+        p95 = statistics.quantiles(latencies, n=20)[-1] * 1000
+        print(f"{concurrency:>8} {args.requests / elapsed:>8.1f} {p50:>8.1f} {p95:>8.1f} {stall * 1000:>12.1f} ms")
+
+
+if __name__ == "__main__":
+    main_cli()
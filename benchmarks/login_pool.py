@@ -0,0 +1,101 @@
+"""
+Logins per second through /login versus the size of the password hashing pool.
+
+    uv run python benchmarks/login_pool.py --logins 64 --concurrency 32 --workers 1 2 4 8
+
+The real app is driven in-process over httpx's ASGI transport. It runs against a
+throwaway SQLite database seeded with one unit user per login. For each pool
+size the script reports the logins per second, the 503 answers given by
+admission control, and the longest stall of the event loop during the storm.
+The stall is how long a ranking poll would have waited.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# Before the app is imported: the engine binds to DATABASE_URL on import
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/login_bench.db"
+
+import httpx  # noqa: E402
+
+from app import main  # noqa: E402
+from app.auth import pwd_context  # noqa: E402
+from app.database import SessionLocal, engine  # noqa: E402
+from app.hashing import HashPool  # noqa: E402
+from app.migrations import upgrade_schema  # noqa: E402
+from app.models import User  # noqa: E402
+
+
+def seed(count: int):
+    password_hash = pwd_context.hash("scout")
+    upgrade_schema(engine)  # The ASGI transport skips the lifespan that would create the tables
+    with SessionLocal() as db:
+        db.query(User).delete()
+        db.add_all(User(username=f"unit{i}", password_hash=password_hash, role="unit") for i in range(count))
+        db.commit()
+
+
+async def watch_loop(stop: asyncio.Event) -> float:
+    """Longest gap between two 10 ms ticks, minus the tick itself."""
+    longest = 0.0
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(0.01)
+        now = time.perf_counter()
+        longest = max(longest, now - last - 0.01)
+        last = now
+    return longest
+
+
+async def storm(logins: int, concurrency: int) -> tuple[float, int, float]:
+    transport = httpx.ASGITransport(app=main.app)
+    limit = asyncio.Semaphore(concurrency)
+    busy = 0
+
+    async def login(client: httpx.AsyncClient, i: int):
+        nonlocal busy
+        async with limit:
+            response = await client.post("/login", data={"username": f"unit{i}", "password": "scout"})
+            if response.status_code == 503:
+                busy += 1
+            elif response.status_code != 303:
+                raise RuntimeError(f"Login of unit{i} answered {response.status_code}")
+
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_loop(stop))
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(login(client, i) for i in range(logins)))
+        elapsed = time.perf_counter() - start
+    stop.set()
+    return elapsed, busy, await watcher
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=32, help="Logins in flight at once")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="Pool sizes to compare")
+    parser.add_argument("--max-pending", type=int, default=None, help="Admission limit (default: no 503s)")
+    args = parser.parse_args()
+
+    seed(args.logins)
+    print(f"{args.logins} logins, {args.concurrency} concurrent, {os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'logins/s':>9} {'503s':>5} {'max loop stall':>15}")
+    for workers in args.workers:
+        pool = HashPool(workers=workers, max_pending=args.max_pending or args.logins)
+        main.hash_pool = pool
+        elapsed, busy, stall = asyncio.run(storm(args.logins, args.concurrency))
+        pool.shutdown()
+        done = args.logins - busy
+        print(f"{workers:>8} {done / elapsed:>9.1f} {busy:>5} {stall * 1000:>12.1f} ms")
+
+
+if __name__ == "__main__":
+    main_cli()
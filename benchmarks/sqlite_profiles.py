@@ -0,0 +1,138 @@
+"""
+Read and write throughput of the SQLite profiles (SQLITE_PROFILE) under a mixed load.
+
+    uv run python benchmarks/sqlite_profiles.py --seconds 5 --writers 2 --readers 4
+
+Each profile gets a fresh database file in a temporary directory. Place it on
+the disk you care about with --dir, e.g. the Fly volume. The profile's database
+is seeded with a camp's worth of pattuglie and challenges. Writer threads then
+each register completions in their own transaction: an insert plus the score
+increment. They use one pooled connection each and no application lock, so
+they contend on the SQLite lock itself. Reader threads meanwhile page through
+the timeline and read the ranking. The script reports reads/s, writes/s, the
+p95 write latency and the "database is locked" errors for each profile.
+"""
+
+import argparse
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import update  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app.database import SQLITE_PROFILES, Base, create_app_engine  # noqa: E402
+from app.models import Challenge, Completion, Pattuglia, Unita  # noqa: E402
+from app.timeline import TimelineFilter, timeline_page  # noqa: E402
+
+
+def seed(sessions: sessionmaker, pattuglie: int, challenges: int) -> tuple[list[int], list[tuple[int, int]]]:
+    with sessions() as db:
+        unita = [Unita(name=f"Unità {i}", sottocampo=f"S{i % 4}") for i in range(pattuglie // 4)]
+        db.add_all(unita)
+        db.flush()
+        rows = [
+            Pattuglia(name=f"P{i}", capo_pattuglia="C", unita_id=unita[i % len(unita)].id) for i in range(pattuglie)
+        ]
+        sfide = [Challenge(name=f"Sfida {i}", description="", points=10) for i in range(challenges)]
+        db.add_all([*rows, *sfide])
+        db.commit()
+        unita_ids = [u.id for u in unita]
+        return unita_ids, [(p.id, c.id) for c in sfide for p in rows]
+
+
+def run_profile(profile: str, directory: str, args) -> dict:
+    engine = create_app_engine(f"sqlite:///{directory}/{profile}.db", profile=profile)
+    Base.metadata.create_all(engine)
+    sessions = sessionmaker(bind=engine, autoflush=False)
+    unita_ids, pairs = seed(sessions, args.pattuglie, args.challenges)
+
+    deadline = time.perf_counter() + args.seconds
+    stats = {"reads": 0, "writes": 0, "locked": 0}
+    write_latencies: list[float] = []
+    lock = threading.Lock()
+
+    def writer(todo: list[tuple[int, int]]):
+        with sessions() as db:
+            for pattuglia_id, challenge_id in todo:
+                if time.perf_counter() > deadline:
+                    return
+                started = time.perf_counter()
+                try:
+                    db.add(Completion(pattuglia_id=pattuglia_id, challenge_id=challenge_id))
+                    db.execute(
+                        update(Pattuglia)
+                        .where(Pattuglia.id == pattuglia_id)
+                        .values(current_score=Pattuglia.current_score + 10)
+                    )
+                    db.commit()
+                except OperationalError:
+                    db.rollback()
+                    with lock:
+                        stats["locked"] += 1
+                    continue
+                with lock:
+                    stats["writes"] += 1
+                    write_latencies.append(time.perf_counter() - started)
+
+    def reader(n: int):
+        with sessions() as db:
+            i = n
+            while time.perf_counter() < deadline:
+                i += 1
+                page = timeline_page(db, TimelineFilter(unita_id=unita_ids[i % len(unita_ids)]))
+                timeline_page(db, cursor=page.next_cursor)
+                db.query(Pattuglia).order_by(Pattuglia.current_score.desc()).limit(50).all()
+                db.rollback()  # End the read transaction, as a request would
+                with lock:
+                    stats["reads"] += 1
+
+    threads = [threading.Thread(target=writer, args=(pairs[w :: args.writers],)) for w in range(args.writers)]
+    threads += [threading.Thread(target=reader, args=(r,)) for r in range(args.readers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+
+    p95 = statistics.quantiles(write_latencies, n=20)[-1] if len(write_latencies) > 1 else 0.0
+    return {
+        "reads/s": stats["reads"] / elapsed,
+        "writes/s": stats["writes"] / elapsed,
+        "write p95 ms": p95 * 1000,
+        "locked": stats["locked"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", default=list(SQLITE_PROFILES), choices=list(SQLITE_PROFILES))
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--pattuglie", type=int, default=200)
+    parser.add_argument("--challenges", type=int, default=100)
+    parser.add_argument("--dir", default=None, help="Where to create the databases (default: a temporary directory)")
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp()
+    print(f"{args.writers} writers, {args.readers} readers, {args.seconds:g}s per profile, in {directory}")
+    print(f"{'profile':>12} {'reads/s':>9} {'writes/s':>9} {'write p95 ms':>13} {'locked':>7}")
+    for profile in args.profiles:
+        result = run_profile(profile, directory, args)
+        print(
+            f"{profile:>12} {result['reads/s']:>9.1f} {result['writes/s']:>9.1f} "
+            f"{result['write p95 ms']:>13.1f} {result['locked']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,9 @@ from datetime import datetime, timedelta
 from passlib.context import CryptContext
 
 from app.database import Base, SessionLocal, engine
+from app.migrations import upgrade_schema
 from app.models import Challenge, Completion, Pattuglia, Prenotazione, Terreno, Unita, User
+from app.provisioning import provision_unit_users, unit_username
 
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 
@@ -12,9 +14,9 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
-def init_db():
+def init_db(bulk_users: bool = False, workers: int | None = None):
     print("Creating database tables...")
-    Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
     print("Tables created successfully.")
 
     db = SessionLocal()
@@ -90,6 +92,8 @@ def init_db():
     # --- Completions Population from CSV ---
     if os.path.exists("completions.csv"):
         print("Reading completions from completions.csv...")
+        # (pattuglia, challenge) is unique: repeated rows of the sheet are skipped
+        completed = {(pid, cid) for pid, cid in db.query(Completion.pattuglia_id, Completion.challenge_id)}
         with open("completions.csv", encoding="utf-8") as f:
             reader = csv.DictReader(f)
             for row in reader:
@@ -101,6 +105,9 @@ def init_db():
                 challenge = db.query(Challenge).filter(Challenge.name == c_name).first()
 
                 if pattuglia and challenge:
+                    if (pattuglia.id, challenge.id) in completed:
+                        continue
+                    completed.add((pattuglia.id, challenge.id))
                     timestamp = datetime.fromisoformat(timestamp_str)
 
                     # Check if already exists (optional, but good for idempotency
@@ -214,48 +221,64 @@ def init_db():
         print("Tech user created.")
 
     # 3. Unit Users
-    # Create a user for each unit. Username = simplified name (lowercase, no spaces/special chars)
-    all_units = db.query(Unita).all()
-    for unit in all_units:
-        # Simple username generation
-        safe_username = "".join(c for c in unit.name if c.isalnum()).lower()
-
-        if not db.query(User).filter(User.username == safe_username).first():
-            unit_user = User(
-                username=safe_username, password_hash=get_password_hash("scout"), role="unit", unita_id=unit.id
-            )
-            db.add(unit_user)
-            print(f"User created for unit: {unit.name} ({safe_username})")
-
-    # --- Credentials Export ---
-    db.commit()  # Ensure all users are committed before querying
-    credentials = []
-    credentials.append("--- CREDENZIALI DI ACCESSO ---")
-    credentials.append("")
-    credentials.append("ADMIN (Accesso completo):")
-    credentials.append("Username: admin")
-    credentials.append("Password: admin")
-    credentials.append("")
-    credentials.append("TECNICO (Inserimento Punti + Gestione Terreni):")
-    credentials.append("Username: prog")
-    credentials.append("Password: esplo")
-    credentials.append("")
-    credentials.append("UNITA (Classifica + Prenotazioni):")
-
-    # Re-query to get all users including newly created ones
-    all_unit_users = db.query(User).filter(User.role == "unit").all()
-    for u in all_unit_users:
-        if u.unita:
-            # We know the default password is 'scout'
-            credentials.append(f"Unità: {u.unita.name}")
-            credentials.append(f"Username: {u.username}")
-            credentials.append("Password: scout")
-            credentials.append("-" * 20)
-
-    with open("credentials.txt", "w", encoding="utf-8") as f:
-        f.write("\n".join(credentials))
-
-    print("Credentials exported to credentials.txt")
+    if bulk_users:
+        # Random password per unit, hashed in parallel; only units without an account are touched
+        db.commit()
+        new_sheet = not os.path.exists("credentials.txt")
+        with open("credentials.txt", "a", encoding="utf-8") as sheet:
+            if new_sheet:
+                sheet.write(
+                    "--- CREDENZIALI DI ACCESSO ---\n\n"
+                    "ADMIN (Accesso completo):\nUsername: admin\nPassword: admin\n\n"
+                    "TECNICO (Inserimento Punti + Gestione Terreni):\nUsername: prog\nPassword: esplo\n\n"
+                    "UNITA (Classifica + Prenotazioni):\n"
+                )
+            result = provision_unit_users(db, sheet, workers=workers)
+        for unit_name in result.skipped:
+            print(f"Warning: no user for unit '{unit_name}', its username is empty or already taken")
+        print(f"{len(result.created)} unit users created, credentials appended to credentials.txt")
+    else:
+        # Create a user for each unit. Username = simplified name (lowercase, no spaces/special chars)
+        all_units = db.query(Unita).all()
+        for unit in all_units:
+            safe_username = unit_username(unit.name)
+
+            if not db.query(User).filter(User.username == safe_username).first():
+                unit_user = User(
+                    username=safe_username, password_hash=get_password_hash("scout"), role="unit", unita_id=unit.id
+                )
+                db.add(unit_user)
+                print(f"User created for unit: {unit.name} ({safe_username})")
+
+        # --- Credentials Export ---
+        db.commit()  # Ensure all users are committed before querying
+        credentials = []
+        credentials.append("--- CREDENZIALI DI ACCESSO ---")
+        credentials.append("")
+        credentials.append("ADMIN (Accesso completo):")
+        credentials.append("Username: admin")
+        credentials.append("Password: admin")
+        credentials.append("")
+        credentials.append("TECNICO (Inserimento Punti + Gestione Terreni):")
+        credentials.append("Username: prog")
+        credentials.append("Password: esplo")
+        credentials.append("")
+        credentials.append("UNITA (Classifica + Prenotazioni):")
+
+        # Re-query to get all users including newly created ones
+        all_unit_users = db.query(User).filter(User.role == "unit").all()
+        for u in all_unit_users:
+            if u.unita:
+                # We know the default password is 'scout'
+                credentials.append(f"Unità: {u.unita.name}")
+                credentials.append(f"Username: {u.username}")
+                credentials.append("Password: scout")
+                credentials.append("-" * 20)
+
+        with open("credentials.txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(credentials))
+
+        print("Credentials exported to credentials.txt")
 
     db.commit()
     db.close()
@@ -268,6 +291,13 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Initialize the database.")
     parser.add_argument("--reset", action="store_true", help="Drop all tables before initializing.")
+    parser.add_argument(
+        "--bulk-users",
+        action="store_true",
+        help="Create the missing unit users with random passwords, hashed in parallel; "
+        "their credentials are appended to credentials.txt.",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="Hashing processes for --bulk-users (default: CPUs).")
     args = parser.parse_args()
 
     if args.reset:
@@ -275,4 +305,4 @@ if __name__ == "__main__":
         Base.metadata.drop_all(bind=engine)
         print("Tables dropped.")
 
-    init_db()
+    init_db(bulk_users=args.bulk_users, workers=args.workers)
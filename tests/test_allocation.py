@@ -0,0 +1,118 @@
+import random
+from collections import defaultdict
+from datetime import date, datetime
+
+from passlib.context import CryptContext
+
+from app.allocation import Allocator, Wish
+from app.availability import get_reservation_index
+from app.models import Preferenza, Prenotazione, Terreno, Unita, User
+
+pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+
+DAY = date(2026, 7, 25)
+
+
+def test_rounds_give_first_choices_before_second_choices():
+    terreni = {1: frozenset({"SPORT"}), 2: frozenset({"SPORT"}), 3: frozenset({"BIVACCO"})}
+    wishes = []
+    for unita_id in (1, 2, 3):
+        wishes.append(Wish(unita_id, 1, "SPORT", DAY, 14, 16, 2))
+        wishes.append(Wish(unita_id, 2, "BIVACCO", DAY, 14, 16, 2))
+
+    result = Allocator(terreni, seed=1).solve(wishes)
+    assert result.unplaced == []
+    assert sorted(p.choice for p in result.placements) == [0, 0, 1]
+    assert {p.terreno_id for p in result.placements} == {1, 2, 3}
+
+
+def test_unplaced_units_displace_flexible_ones():
+    terreni = {1: frozenset({"SPORT"})}
+    wishes = [
+        Wish(1, 1, "SPORT", DAY, 14, 16, 2),
+        Wish(1, 2, "SPORT", DAY, 18, 20, 2),
+        Wish(2, 1, "SPORT", DAY, 14, 16, 2),
+    ]
+    for seed in range(10):
+        result = Allocator(terreni, seed=seed).solve(wishes)
+        assert result.unplaced == []
+        assert {p.unita_id: p.choice for p in result.placements} == {1: 1, 2: 0}
+
+
+def test_local_improvement_makes_room_for_rigid_wishes():
+    terreni = {1: frozenset({"SPORT"})}
+    flexible = Wish(1, 1, "SPORT", DAY, 14, 18, 2)
+    rigid = Wish(2, 1, "SPORT", DAY, 14, 16, 2)
+
+    for seed in range(10):  # Whoever goes first, both end up placed
+        result = Allocator(terreni, seed=seed).solve([flexible, rigid])
+        by_unit = {p.unita_id: p for p in result.placements}
+        assert result.unplaced == []
+        assert by_unit[2].start == datetime(2026, 7, 25, 14)
+        assert by_unit[1].start == datetime(2026, 7, 25, 16)
+
+
+def test_existing_reservations_are_respected():
+    terreni = {1: frozenset({"SPORT"})}
+    booked = ((1 << 8) - 1) << (14 * 4)  # 14:00-16:00
+    result = Allocator(terreni, fixed={(1, DAY): booked}, busy={(2, DAY): booked}).solve(
+        [Wish(1, 1, "SPORT", DAY, 14, 16, 2), Wish(2, 1, "SPORT", DAY, 15, 17, 2)]
+    )
+    assert result.unplaced == [1, 2]  # Unit 2 is already busy elsewhere until 16:00
+
+
+def test_large_batch_produces_no_overlaps():
+    rng = random.Random(3)
+    tags = ["SPORT", "BIVACCO", "NOTTURNO"]
+    terreni = {i: frozenset({tags[i % 3]}) for i in range(12)}
+    wishes = [
+        Wish(u, rank, rng.choice(tags), date(2026, 7, 25 + rng.randrange(5)), start, start + 4, rng.randint(1, 4))
+        for u in range(300)
+        for rank in range(1, 4)
+        for start in [rng.randrange(8, 20)]
+    ]
+
+    result = Allocator(terreni, seed=0).solve(wishes)
+    assert len(result.placements) + len(result.unplaced) == 300
+    occupied = defaultdict(int)
+    for p in result.placements:
+        assert occupied[(p.terreno_id, p.day)] & p.mask == 0
+        occupied[(p.terreno_id, p.day)] |= p.mask
+
+
+def test_allocation_endpoints(client, session):
+    t = Terreno(name="Campo", tags="SPORT", center_lat="0", center_lon="0", polygon="[]")
+    u1, u2 = Unita(name="U1", sottocampo="S"), Unita(name="U2", sottocampo="S")
+    session.add_all([t, u1, u2])
+    session.commit()
+    session.add_all(
+        [
+            User(username="unit1", password_hash=pwd_context.hash("unit1"), role="unit", unita_id=u1.id),
+            User(username="admin", password_hash=pwd_context.hash("admin"), role="admin"),
+            Preferenza(unita_id=u2.id, rank=1, tag="SPORT", day=DAY, earliest_hour=14, latest_hour=16, duration=2),
+        ]
+    )
+    session.commit()
+
+    client.post("/login", data={"username": "unit1", "password": "unit1"})
+    wishes = [
+        {"tag": "sport", "day": "2026-07-25", "earliest_hour": 14, "latest_hour": 16, "duration": 2},
+        {"tag": "SPORT", "day": "2026-07-26", "earliest_hour": 9, "latest_hour": 12, "duration": 3},
+    ]
+    response = client.put("/api/preferenze", json=wishes)
+    assert response.status_code == 200
+    assert [p["rank"] for p in client.get("/api/preferenze").json()] == [1, 2]
+    bad = [{**wishes[0], "latest_hour": 15}]
+    assert client.put("/api/preferenze", json=bad).status_code == 400
+
+    client.post("/login", data={"username": "admin", "password": "admin"})
+    index = get_reservation_index(session)
+    response = client.post("/admin/allocazione", follow_redirects=False)
+    assert response.status_code == 303
+    assert "allocati=2" in response.headers["location"]
+
+    assert session.query(Prenotazione).count() == 2
+    assert session.query(Preferenza).count() == 0
+    # Both units wanted 25/07 14-16: unit 2 has no alternative, so unit 1 gets its second choice
+    days = sorted(r.start.date() for r in index.overlapping(t.id, datetime(2026, 7, 25), datetime(2026, 7, 27)))
+    assert days == [date(2026, 7, 25), date(2026, 7, 26)]
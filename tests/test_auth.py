@@ -5,8 +5,9 @@ from jose import jwt
 # Since get_password_hash is in init_db usually, check where it is.
 # Checking app/auth.py... it has verify_password but likely uses pwd_context directly.
 from passlib.context import CryptContext
+from sqlalchemy import event
 
-from app.auth import ALGORITHM, SECRET_KEY, create_access_token, verify_password
+from app.auth import ALGORITHM, SECRET_KEY, TokenCache, create_access_token, verify_password
 from app.models import User
 
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
@@ -72,3 +73,74 @@ def test_invalid_token(client):
     # Should fail auth -> 401 -> Redirect to login (200)
     assert response.status_code == 200
     assert "Login" in response.text
+
+
+def test_authenticated_reads_cost_no_user_query(client, session):
+    session.add(User(username="fast", password_hash=pwd_context.hash("pass"), role="tech"))
+    session.commit()
+    client.post("/login", data={"username": "fast", "password": "pass"})
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        for _ in range(3):
+            assert client.get("/").status_code == 200
+            assert client.get("/timeline").status_code == 200
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    # The first request reads the user's token version, then nothing
+    assert sum("FROM users" in sql for sql in statements) <= 1
+
+
+def test_password_and_role_changes_revoke_tokens(client, session):
+    user = User(username="revoked", password_hash=pwd_context.hash("old"), role="tech")
+    session.add(user)
+    session.commit()
+    client.post("/login", data={"username": "revoked", "password": "old"})
+    assert client.get("/export/ranking").headers["content-type"].startswith("text/csv")
+
+    user.password_hash = pwd_context.hash("new")
+    session.commit()
+    assert user.token_version == 1
+    assert "Login" in client.get("/export/ranking").text
+
+    client.post("/login", data={"username": "revoked", "password": "new"})
+    assert client.get("/export/ranking").headers["content-type"].startswith("text/csv")
+
+    user.role = "unit"
+    session.commit()
+    assert "Login" in client.get("/export/ranking").text
+
+    # Changes that don't touch the credentials or the claims keep the token valid
+    client.post("/login", data={"username": "revoked", "password": "new"})
+    user.username = "renamed"
+    session.commit()
+    assert "Timeline Eventi" in client.get("/timeline").text
+
+
+def test_token_cache_is_bounded():
+    cache = TokenCache(size=2)
+    tokens = [
+        create_access_token(
+            {"sub": f"u{i}", "uid": i, "role": "unit", "unita_id": None, "ver": 0}, expires_delta=timedelta(minutes=5)
+        )
+        for i in range(3)
+    ]
+    for i, token in enumerate(tokens):
+        decoded = cache.decode(token)
+        assert decoded is not None and decoded.user.id == i
+    assert cache.get(tokens[0]) is None
+    cached = cache.get(tokens[2])
+    assert cached is not None and cached.user.username == "u2"
+
+    # Tokens without the claims (issued before they existed) are refused
+    assert cache.decode(create_access_token({"sub": "legacy"})) is None
+
+    short = TokenCache(ttl=0)
+    short.decode(tokens[0])
+    assert short.get(tokens[0]) is None
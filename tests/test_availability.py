@@ -0,0 +1,241 @@
+import base64
+from array import array
+from datetime import datetime, timedelta
+
+from passlib.context import CryptContext
+
+from app.availability import (
+    SLOTS_PER_DAY,
+    Reservation,
+    ReservationIndex,
+    TerrenoIntervals,
+    get_reservation_index,
+    slot_mask,
+)
+from app.models import Prenotazione, Terreno, Unita, User
+
+pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+
+DAY = datetime(2026, 7, 25)
+
+
+def at(hour: int, minute: int = 0) -> datetime:
+    return DAY + timedelta(hours=hour, minutes=minute)
+
+
+def reservation(rid: int, start: datetime, end: datetime, terreno_id: int = 1) -> Reservation:
+    return Reservation(rid, terreno_id, 1, start, end, "APPROVED")
+
+
+def test_overlap_and_coverage():
+    intervals = TerrenoIntervals()
+    intervals.add(reservation(1, at(10), at(12)))
+    intervals.add(reservation(2, at(14), at(18)))
+    intervals.add(reservation(3, at(15), at(16)))  # Overlaps reservation 2
+
+    assert [r.id for r in intervals.overlapping(at(11), at(15))] == [1, 2]
+    assert intervals.overlapping(at(12), at(14)) == []
+    # Touching boundaries do not overlap
+    assert [r.id for r in intervals.overlapping(at(17, 59), at(19))] == [2]
+
+    assert intervals.covered_seconds(at(10), at(12)) == 2 * 3600
+    # Overlapping reservations are only counted once
+    assert intervals.covered_seconds(at(14), at(18)) == 4 * 3600
+    assert intervals.covered_seconds(at(11), at(15)) == 2 * 3600
+
+    intervals.remove(reservation(2, at(14), at(18)))
+    assert [r.id for r in intervals.overlapping(at(14), at(18))] == [3]
+
+
+def test_next_free_gap():
+    intervals = TerrenoIntervals()
+    intervals.add(reservation(1, at(10), at(12)))
+    intervals.add(reservation(2, at(13), at(15)))
+
+    assert intervals.next_free_gap(at(8), timedelta(hours=2)) == at(8)
+    assert intervals.next_free_gap(at(9), timedelta(hours=2)) == at(15)
+    assert intervals.next_free_gap(at(11), timedelta(hours=1)) == at(12)
+    assert intervals.next_free_gap(at(11), timedelta(hours=2), until=at(16)) is None
+
+
+def test_status():
+    index = ReservationIndex()
+    index.upsert(reservation(1, at(14), at(16)))
+
+    assert index.status(1, at(14), at(16)) == "BOOKED"
+    assert index.status(1, at(12), at(18)) == "PARTIAL"
+    assert index.status(1, at(16), at(18)) == "FREE"
+    assert index.status(2, at(14), at(16)) == "FREE"
+
+    # Moving a reservation to another terreno
+    index.upsert(reservation(1, at(14), at(16), terreno_id=2))
+    assert index.status(1, at(14), at(16)) == "FREE"
+    assert index.status(2, at(14), at(16)) == "BOOKED"
+
+
+def test_index_follows_committed_changes(client, session):
+    admin = User(username="admin", password_hash=pwd_context.hash("admin"), role="admin")
+    t = Terreno(name="Prato", tags="SPORT", center_lat="0", center_lon="0", polygon="[]")
+    u = Unita(name="Scouts", sottocampo="S")
+    session.add_all([admin, t, u])
+    session.commit()
+    client.post("/login", data={"username": "admin", "password": "admin"})
+
+    index = get_reservation_index(session)
+    p = Prenotazione(terreno_id=t.id, unita_id=u.id, start_time=at(10), end_time=at(12), duration=2)
+    session.add(p)
+    session.commit()
+    assert [r.id for r in index.overlapping(t.id, at(9), at(11))] == [p.id]
+    assert index.unit_name(u.id) == "Scouts"
+
+    # Admin deletes the reservation
+    client.post(f"/admin/prenotazioni/{p.id}/delete", follow_redirects=False)
+    assert index.overlapping(t.id, at(9), at(11)) == []
+
+    # Deleting a terreno drops its reservations too
+    p2 = Prenotazione(terreno_id=t.id, unita_id=u.id, start_time=at(14), end_time=at(15), duration=1)
+    session.add(p2)
+    session.commit()
+    response = client.post(f"/admin/terreni/{t.id}/delete", follow_redirects=False)
+    assert response.status_code == 303
+    assert session.query(Prenotazione).count() == 0
+    assert index.overlapping(t.id, at(0), at(23)) == []
+
+
+def test_occupancy_bitmaps():
+    intervals = TerrenoIntervals()
+    intervals.add(reservation(1, at(10), at(11)))
+    intervals.add(reservation(2, at(10, 30), at(12)))
+    assert slot_mask(DAY.date(), at(10), at(11)) == 0b1111 << 40
+    assert intervals.days[DAY.date()] == 0b11111111 << 40
+
+    assert intervals.bitmap_status(at(10), at(12)) == "BOOKED"
+    assert intervals.bitmap_status(at(9), at(12)) == "PARTIAL"
+    assert intervals.bitmap_status(at(12), at(13)) == "FREE"
+
+    # Removing a reservation keeps the slots still held by the other one
+    intervals.remove(reservation(1, at(10), at(11)))
+    assert intervals.days[DAY.date()] == 0b111111 << 42
+    intervals.remove(reservation(2, at(10, 30), at(12)))
+    assert intervals.days == {}
+
+
+def test_bitmaps_span_midnight():
+    intervals = TerrenoIntervals()
+    intervals.add(reservation(1, at(22), at(26)))
+    next_day = DAY.date() + timedelta(days=1)
+    assert intervals.days[DAY.date()] == 0b11111111 << 88
+    assert intervals.days[next_day] == 0b11111111
+    assert intervals.bitmap_status(at(23), at(25)) == "BOOKED"
+
+
+def test_status_falls_back_for_unaligned_windows():
+    index = ReservationIndex()
+    index.upsert(reservation(1, at(14), at(14, 5)))
+    # The 14:00 slot is marked, but 14:07-15:00 does not actually overlap the booking
+    assert index.status(1, at(14, 7), at(15)) == "FREE"
+    assert index.status(1, at(14), at(14, 5)) == "BOOKED"
+
+
+def test_grid_endpoint(client, session):
+    t = Terreno(name="Prato", tags="SPORT", center_lat="0", center_lon="0", polygon="[]")
+    u = Unita(name="Scouts", sottocampo="S")
+    user = User(username="unit", password_hash=pwd_context.hash("unit"), role="unit")
+    session.add_all([t, u, user])
+    session.commit()
+    session.add(Prenotazione(terreno_id=t.id, unita_id=u.id, start_time=at(10), end_time=at(12), duration=2))
+    session.commit()
+    client.post("/login", data={"username": "unit", "password": "unit"})
+
+    response = client.get(f"/api/terreni/{t.id}/grid", params={"start_date": "2026-07-24", "days": 3})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["slot_minutes"] == 15
+    assert data["units"] == [{"id": u.id, "name": "Scouts"}]
+    assert [int(h, 16) for h in data["occupancy"]] == [0, 0b11111111 << 40, 0]
+    owners = array("H", base64.b64decode(data["owners"][1]))
+    assert len(owners) == SLOTS_PER_DAY
+    assert owners[39:49].tolist() == [0] + [1] * 8 + [0]
+
+    assert client.get("/api/terreni/999/grid", params={"start_date": "2026-07-24"}).status_code == 404
+    assert client.get(f"/api/terreni/{t.id}/grid", params={"start_date": "2026-07-24", "days": 0}).status_code == 400
+
+
+def test_changes_since():
+    index = ReservationIndex()
+    start = index.version
+    index.upsert(reservation(1, at(10), at(12)))
+    index.upsert(reservation(2, at(14), at(16)))
+    after_insert = index.version
+    index.upsert(reservation(1, at(10), at(13)))  # Moved
+    index.upsert(reservation(1, at(10), at(13)))  # Unchanged: no new version
+    index.remove(2)
+
+    changes = index.changes_since(start)
+    assert changes is not None
+    version, upserts, deleted = changes
+    assert version == after_insert + 2
+    assert [(r.id, r.end) for r in upserts] == [(1, at(13))]
+    assert deleted == [2]
+    assert index.changes_since(after_insert) == (version, [reservation(1, at(10), at(13))], [2])
+    assert index.changes_since(version) == (version, [], [])
+
+    # Unknown versions (a restart, or older than the retained log) ask for a resync
+    assert index.changes_since(version + 1) is None
+    assert index.changes_since(start - 1) is None
+
+
+def test_availability_since(client, session):
+    user = User(username="feed", password_hash="hash", role="unit")
+    t = Terreno(name="Bosco", tags="SPORT", center_lat="0", center_lon="0", polygon="[]")
+    u = Unita(name="Scouts", sottocampo="S")
+    session.add_all([user, t, u])
+    session.commit()
+
+    from app.auth import get_authenticated_user
+    from app.main import app
+
+    app.dependency_overrides[get_authenticated_user] = lambda: user
+    params = {"start_date": "2026-07-25T00:00:00", "end_date": "2026-07-26T00:00:00"}
+    response = client.get("/api/terreni/availability", params=params)
+    version = response.headers["x-reservations-version"]
+    assert client.get("/api/terreni/availability", params={**params, "since": version}).status_code == 304
+
+    inside = Prenotazione(terreno_id=t.id, unita_id=u.id, start_time=at(10), end_time=at(12), duration=2)
+    outside = Prenotazione(terreno_id=t.id, unita_id=u.id, start_time=at(34), end_time=at(36), duration=2)
+    session.add_all([inside, outside])
+    session.commit()
+    delta = client.get("/api/terreni/availability", params={**params, "since": version}).json()
+    assert delta["upserts"] == [
+        {
+            "id": inside.id,
+            "start": "2026-07-25T10:00:00",
+            "end": "2026-07-25T12:00:00",
+            "unit_name": "Scouts",
+            "terreno_id": t.id,
+        }
+    ]
+    assert delta["deleted"] == [outside.id] and delta["reset"] is False
+
+    version = delta["version"]
+    session.delete(inside)
+    session.commit()
+    delta = client.get("/api/terreni/availability", params={**params, "since": version}).json()
+    assert (delta["upserts"], delta["deleted"]) == ([], [inside.id])
+
+    assert client.get("/api/terreni/availability", params={**params, "since": 0}).json()["reset"] is True
+    app.dependency_overrides = {}
+
+
+def test_grid_with_more_units_than_a_byte():
+    index = ReservationIndex()
+    # One unit per 15-minute slot over four days
+    for i in range(300):
+        start = DAY + timedelta(minutes=15 * i)
+        index.upsert(Reservation(i + 1, 1, 1000 + i, start, start + timedelta(minutes=15), "APPROVED"))
+
+    masks, owners, unit_ids = index.grid(1, DAY.date(), 4)
+    assert len(unit_ids) == 300
+    last_day = array("H", owners[3])
+    position = 299 - 3 * SLOTS_PER_DAY
+    assert unit_ids[last_day[position] - 1] == 1299
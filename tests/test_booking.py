@@ -0,0 +1,125 @@
+import threading
+from datetime import datetime
+from functools import partial
+
+import pytest
+from passlib.context import CryptContext
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.booking import BookingConflict, apply_booking, check_booking
+from app.database import Base
+from app.models import Prenotazione, Terreno, Unita, User
+from app.writer import commit_alone
+
+pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+
+START = datetime(2026, 7, 25, 14)
+
+
+def setup_booking_data(session):
+    t = Terreno(name="Campo Sport", tags="SPORT", center_lat="0", center_lon="0", polygon="[]")
+    u1 = Unita(name="Unit 1", sottocampo="S1")
+    u2 = Unita(name="Unit 2", sottocampo="S1")
+    session.add_all([t, u1, u2])
+    session.commit()
+    return t, u1, u2
+
+
+def book(db, terreno_id: int, unita_id: int, start: datetime, duration: int) -> Prenotazione:
+    """What POST /api/prenotazioni does, without GROUP_COMMIT."""
+    check_booking(db, terreno_id, start, duration)
+    return commit_alone(
+        db, partial(apply_booking, terreno_id=terreno_id, unita_id=unita_id, start=start, duration=duration)
+    )
+
+
+def test_book_and_conflict_reasons(session):
+    t, u1, u2 = setup_booking_data(session)
+
+    p = book(session, t.id, u1.id, START, 2)
+    assert (p.start_time, p.end_time, p.status) == (START, datetime(2026, 7, 25, 16), "PENDING")
+
+    with pytest.raises(BookingConflict) as exc:
+        book(session, t.id, u2.id, datetime(2026, 7, 25, 15), 2)
+    assert exc.value.reason == "terreno_booked"
+    assert exc.value.conflict is not None and exc.value.conflict["id"] == p.id
+
+    # Touching windows do not overlap
+    book(session, t.id, u2.id, datetime(2026, 7, 25, 16), 1)
+
+    other = Terreno(name="Prato", tags="SPORT", center_lat="0", center_lon="0", polygon="[]")
+    session.add(other)
+    session.commit()
+    with pytest.raises(BookingConflict) as exc:
+        book(session, other.id, u1.id, datetime(2026, 7, 25, 15), 1)
+    assert exc.value.reason == "unita_busy"
+
+    for kwargs, reason in [
+        ({"duration": 5}, "invalid_duration"),
+        ({"start": datetime(2026, 7, 25, 14, 10)}, "invalid_start"),
+        ({"terreno_id": 999}, "terreno_not_found"),
+    ]:
+        args = {"terreno_id": t.id, "start": datetime(2026, 7, 26, 10), "duration": 1, **kwargs}
+        with pytest.raises(BookingConflict) as exc:
+            book(session, unita_id=u1.id, **args)
+        assert exc.value.reason == reason
+
+    assert session.query(Prenotazione).count() == 2
+
+
+def test_concurrent_bookings_only_one_wins(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'rush.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with SessionLocal() as session:
+        t, *_ = setup_booking_data(session)
+        units = [Unita(name=f"Rush {i}", sottocampo="S") for i in range(12)]
+        session.add_all(units)
+        session.commit()
+        terreno_id, unit_ids = t.id, [u.id for u in units]
+
+    outcomes = []
+    barrier = threading.Barrier(len(unit_ids))
+
+    def attempt(unita_id):
+        with SessionLocal() as db:
+            barrier.wait()
+            try:
+                book(db, terreno_id, unita_id, START, 2)
+                outcomes.append("ok")
+            except BookingConflict as e:
+                outcomes.append(e.reason)
+
+    threads = [threading.Thread(target=attempt, args=(u,)) for u in unit_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert outcomes.count("ok") == 1
+    assert outcomes.count("terreno_booked") == len(unit_ids) - 1
+    with SessionLocal() as session:
+        assert session.query(Prenotazione).count() == 1
+    engine.dispose()
+
+
+def test_booking_endpoint(client, session):
+    t, u1, u2 = setup_booking_data(session)
+    session.add(User(username="unit1", password_hash=pwd_context.hash("unit1"), role="unit", unita_id=u1.id))
+    session.commit()
+    client.post("/login", data={"username": "unit1", "password": "unit1"})
+
+    data = {"terreno_id": t.id, "start": "2026-07-25T14:00:00", "duration": 2}
+    response = client.post("/api/prenotazioni", data=data)
+    assert response.status_code == 201
+    assert response.json()["unita_id"] == u1.id
+
+    response = client.post("/api/prenotazioni", data=data)
+    assert response.status_code == 409
+    assert response.json()["detail"]["reason"] == "terreno_booked"
+    assert response.json()["detail"]["conflict"]["start"] == "2026-07-25T14:00:00"
+
+    # Units cannot book for someone else
+    assert client.post("/api/prenotazioni", data={**data, "unita_id": u2.id}).status_code == 403
+    assert client.post("/api/prenotazioni", data={**data, "duration": 6}).status_code == 400
@@ -0,0 +1,178 @@
+import threading
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.completions import CompletionRejected, Entry, Outcome, parse_sheet, register_batch, register_completion
+from app.database import Base
+from app.models import Challenge, Completion, Pattuglia, Unita
+from app.ranking import get_ranking_index
+from tests.test_public import setup_basic_game_data, setup_tech_user
+
+
+def test_register_completion(session):
+    p, c = setup_basic_game_data(session)
+
+    registered = register_completion(session, p.id, c.id)
+    assert registered.score == 100
+    assert get_ranking_index(session).ranking()[0].current_score == 100
+
+    with pytest.raises(CompletionRejected) as e:
+        register_completion(session, p.id, c.id)
+    assert e.value.reason == "already_completed"
+    with pytest.raises(CompletionRejected) as e:
+        register_completion(session, p.id, c.id + 1)
+    assert e.value.reason == "not_found"
+
+    session.refresh(p)
+    assert p.current_score == 100
+    assert session.query(Completion).count() == 1
+
+
+def test_concurrent_completions_lose_no_updates(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'stress.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with SessionLocal() as session:
+        u = Unita(name="U", sottocampo="S")
+        session.add(u)
+        session.flush()
+        p = Pattuglia(name="P", capo_pattuglia="C", unita_id=u.id, current_score=0)
+        challenges = [Challenge(name=f"C{i}", description="", points=i + 1) for i in range(8)]
+        session.add_all([p, *challenges])
+        session.commit()
+        pattuglia_id, challenge_ids = p.id, [c.id for c in challenges]
+
+    # Every challenge entered by three tech users at once
+    attempts = [cid for cid in challenge_ids for _ in range(3)]
+    outcomes = []
+    barrier = threading.Barrier(len(attempts))
+
+    def attempt(challenge_id):
+        with SessionLocal() as db:
+            barrier.wait()
+            try:
+                register_completion(db, pattuglia_id, challenge_id)
+                outcomes.append("ok")
+            except CompletionRejected as e:
+                outcomes.append(e.reason)
+
+    threads = [threading.Thread(target=attempt, args=(cid,)) for cid in attempts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert outcomes.count("ok") == len(challenge_ids)
+    assert outcomes.count("already_completed") == len(attempts) - len(challenge_ids)
+    with SessionLocal() as session:
+        assert session.query(Completion).count() == len(challenge_ids)
+        pattuglia = session.get(Pattuglia, pattuglia_id)
+        assert pattuglia is not None and pattuglia.current_score == sum(range(1, 9))
+    engine.dispose()
+
+
+def test_register_batch(session):
+    p, c1 = setup_basic_game_data(session)
+    c2 = Challenge(name="C2", description="D2", points=30)
+    session.add(c2)
+    session.commit()
+    register_completion(session, p.id, c1.id)
+
+    entered = datetime(2026, 7, 25, 9, 30)
+    entries = [
+        Entry(p.id, c2.id, entered, "k1"),
+        Entry(p.id, c2.id, entered, "k2"),  # Same pair, entered twice on the device
+        Entry(p.id, c1.id, entered, "k3"),  # Registered before
+        Entry(p.id, 999, entered, "k4"),
+        Entry(p.id, c2.id, entered, "k1"),  # Same key twice in the batch
+    ]
+    outcomes = register_batch(session, entries)
+    assert [o.status for o in outcomes] == ["ok", "already_completed", "already_completed", "not_found", "ok"]
+    assert outcomes[4] == Outcome("ok", outcomes[0].completion_id, replayed=True)
+
+    session.refresh(p)
+    assert p.current_score == 130
+    completion = session.get(Completion, outcomes[0].completion_id)
+    assert completion.timestamp == entered  # The time it was entered, not synced
+
+    # The response got lost: the device sends the same batch again
+    again = register_batch(session, entries)
+    assert [(o.status, o.completion_id) for o in again] == [(o.status, o.completion_id) for o in outcomes]
+    assert all(o.replayed for o in again)
+    session.refresh(p)
+    assert p.current_score == 130
+    assert session.query(Completion).count() == 2
+
+
+def test_register_batch_commits_once(session):
+    p, c1 = setup_basic_game_data(session)
+    c2 = Challenge(name="C2", description="D2", points=30)
+    session.add(c2)
+    session.commit()
+    get_ranking_index(session)
+
+    commits = []
+
+    def count(db):
+        commits.append(db)
+
+    event.listen(session, "after_commit", count)
+    try:
+        register_batch(session, [Entry(p.id, c1.id, datetime(2026, 7, 25, 9), "a"), Entry(p.id, c2.id, None, "b")])
+    finally:
+        event.remove(session, "after_commit", count)
+    assert len(commits) == 1
+    assert get_ranking_index(session).ranking()[0].current_score == 130  # Published by that one commit
+
+
+def test_sync_endpoint(client, session):
+    setup_tech_user(session)
+    client.post("/login", data={"username": "prog", "password": "tech"})
+    p, c = setup_basic_game_data(session)
+
+    batch = [{"key": "abc", "pattuglia_id": p.id, "challenge_id": c.id, "timestamp": "2026-07-25T10:15:00+02:00"}]
+    response = client.post("/api/completions/sync", json=batch)
+    assert response.status_code == 200
+    [result] = response.json()
+    assert result["status"] == "ok" and not result["replayed"]
+    assert session.get(Completion, result["completion_id"]).timestamp == datetime(2026, 7, 25, 8, 15)
+
+    assert client.post("/api/completions/sync", json=batch).json()[0]["replayed"]
+    assert client.post("/api/completions/sync", json=[{**batch[0], "key": ""}]).status_code == 400
+
+
+def test_parse_sheet():
+    pattuglie, challenges = {"Aquile": 1, "Lupi": 2}, {"Nodi": 5, "Fuoco": 6}
+    rows = parse_sheet("Pattuglia;Sfida\naquile; Nodi\n\nLupi;Tenda\nsolo\n", pattuglie, challenges)
+    assert [(r.line, r.entry, r.error) for r in rows] == [
+        (2, Entry(1, 5), None),
+        (4, None, "unknown_challenge"),
+        (5, None, "invalid_row"),
+    ]
+    assert [r.entry for r in parse_sheet("Lupi\tFuoco", pattuglie, challenges)] == [Entry(2, 6)]
+
+
+def test_bulk_entry(client, session):
+    setup_tech_user(session)
+    client.post("/login", data={"username": "prog", "password": "tech"})
+    p, c1 = setup_basic_game_data(session)
+    c2 = Challenge(name="Fuoco", description="", points=7)
+    session.add(c2)
+    session.commit()
+
+    assert client.get("/input/bulk").status_code == 200
+    response = client.post(
+        "/input/bulk",
+        data={"pair": [f"{p.id}:{c1.id}"], "sheet": f"P1,Fuoco\nP1,{c1.name}\nP9,Fuoco"},
+    )
+    assert response.status_code == 200
+    assert "Registrati 2 su 4" in response.text
+    assert "Già completata" in response.text and "Pattuglia sconosciuta" in response.text
+    assert "P9, Fuoco</textarea>" in response.text  # Unread rows are kept for fixing
+
+    session.refresh(p)
+    assert p.current_score == 107
+    assert session.query(Completion).count() == 2
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+
+import pytest
+from sqlalchemy import event, text
+from sqlalchemy.pool import QueuePool
+
+from app.database import DB_POOL_SIZE, AsyncDB, create_app_engine, sqlite_pragmas
+from tests.test_public import setup_basic_game_data, setup_tech_user
+
+
+def test_async_db_runs_on_a_worker_thread(session):
+    async def scenario():
+        return await AsyncDB(session).run(
+            lambda db, x: (threading.get_ident(), db.execute(text("SELECT :x"), {"x": x}).scalar()), 7
+        )
+
+    thread, value = asyncio.run(scenario())
+    assert value == 7
+    assert thread != threading.get_ident()
+
+
+def test_routes_never_query_on_the_event_loop(client, session):
+    setup_tech_user(session)
+    p, c = setup_basic_game_data(session)
+
+    on_loop = []
+
+    def check(conn, cursor, statement, *args):
+        try:
+            asyncio.get_running_loop()
+            on_loop.append(statement)
+        except RuntimeError:
+            pass  # A worker thread
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", check)
+    try:
+        client.post("/login", data={"username": "prog", "password": "tech"})
+        for url in ("/", "/timeline", "/input", "/prenotazioni", "/export/ranking"):
+            assert client.get(url).status_code == 200
+        client.post("/complete", data={"pattuglia_id": p.id, "challenge_id": c.id})
+    finally:
+        event.remove(engine, "before_cursor_execute", check)
+    assert on_loop == []
+
+
+def _pragmas(engine):
+    with engine.connect() as conn:
+        return {
+            name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+            for name in ("journal_mode", "synchronous", "busy_timeout", "temp_store")
+        }
+
+
+def test_sqlite_profiles(tmp_path, monkeypatch):
+    engine = create_app_engine(f"sqlite:///{tmp_path / 'durable.db'}")
+    assert _pragmas(engine) == {"journal_mode": "wal", "synchronous": 2, "busy_timeout": 5000, "temp_store": 2}
+    assert isinstance(engine.pool, QueuePool) and engine.pool.size() == DB_POOL_SIZE
+    engine.dispose()
+
+    engine = create_app_engine(f"sqlite:///{tmp_path / 'wal.db'}", profile="wal")
+    assert _pragmas(engine)["synchronous"] == 1
+    engine.dispose()
+
+    engine = create_app_engine(f"sqlite:///{tmp_path / 'plain.db'}", profile="default")
+    assert _pragmas(engine)["journal_mode"] == "delete"
+    engine.dispose()
+
+    monkeypatch.setenv("SQLITE_SYNCHRONOUS", "FULL")
+    engine = create_app_engine(f"sqlite:///{tmp_path / 'overridden.db'}", profile="wal")
+    assert _pragmas(engine)["synchronous"] == 2
+    engine.dispose()
+
+    with pytest.raises(ValueError):
+        sqlite_pragmas("turbo")
@@ -0,0 +1,94 @@
+import asyncio
+
+from app.events import EventBus, bus, format_sse
+from app.models import Completion, Pattuglia
+from tests.test_public import setup_basic_game_data, setup_tech_user
+
+
+def drain(subscription):
+    events = []
+    while not subscription.queue.empty():
+        events.append(subscription.queue.get_nowait())
+    return events
+
+
+def test_publish_fans_out_to_subscribers():
+    async def scenario():
+        local_bus = EventBus(queue_size=4)
+        first = local_bus.subscribe()
+        second = local_bus.subscribe()
+        local_bus.publish({"type": "score", "id": 1, "score": 10, "delta": 10})
+        assert await first.get() == {"type": "score", "id": 1, "score": 10, "delta": 10}
+        assert await second.get() == {"type": "score", "id": 1, "score": 10, "delta": 10}
+
+        local_bus.unsubscribe(second)
+        local_bus.publish({"type": "ranking_changed"})
+        assert drain(first) == [{"type": "ranking_changed"}]
+        assert drain(second) == []
+
+    asyncio.run(scenario())
+
+
+def test_slow_consumer_is_dropped():
+    async def scenario():
+        local_bus = EventBus(queue_size=2)
+        slow = local_bus.subscribe()
+        fast = local_bus.subscribe()
+        for i in range(3):
+            local_bus.publish({"type": "score", "id": i, "score": i, "delta": 1})
+            drain(fast)
+
+        # The slow subscriber is cut off with an end-of-stream marker, the others keep going
+        assert slow.dropped
+        assert drain(slow) == [None]
+        assert local_bus.subscriber_count == 1
+        local_bus.publish({"type": "ranking_changed"})
+        assert drain(fast) == [{"type": "ranking_changed"}]
+
+    asyncio.run(scenario())
+
+
+def test_publish_from_worker_thread():
+    async def scenario():
+        local_bus = EventBus()
+        subscription = local_bus.subscribe()
+        await asyncio.to_thread(local_bus.publish, {"type": "ranking_changed"})
+        assert await asyncio.wait_for(subscription.get(), timeout=1) == {"type": "ranking_changed"}
+
+    asyncio.run(scenario())
+
+
+def test_completion_and_rollback_publish_events(client, session):
+    async def scenario():
+        setup_tech_user(session)
+        p, c = setup_basic_game_data(session)
+        subscription = bus.subscribe()
+        try:
+            client.post("/login", data={"username": "prog", "password": "tech"})
+            client.post("/complete", data={"pattuglia_id": str(p.id), "challenge_id": str(c.id)})
+            await asyncio.sleep(0.05)
+            events = drain(subscription)
+
+            assert {"type": "score", "id": p.id, "score": 100, "delta": 100} in events
+            completion = next(e for e in events if e["type"] == "completion")
+            assert completion["pattuglia"] == "P1"
+            assert completion["points"] == 100
+
+            # Direct rollback through the session (admin route does the same)
+            comp = session.query(Completion).one()
+            pattuglia = session.get(Pattuglia, p.id)
+            pattuglia.current_score -= 100
+            session.delete(comp)
+            session.commit()
+            await asyncio.sleep(0)
+            events = drain(subscription)
+            assert {"type": "score", "id": p.id, "score": 0, "delta": -100} in events
+            assert {"type": "completion_removed", "id": completion["id"]} in events
+        finally:
+            bus.unsubscribe(subscription)
+
+    asyncio.run(scenario())
+
+
+def test_format_sse():
+    assert format_sse({"type": "score", "id": 1}) == 'event: score\ndata: {"type":"score","id":1}\n\n'
@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+import pytest
+from passlib.context import CryptContext
+
+from app.auth import pwd_context
+from app.hashing import HashingBusy, HashPool, hash_pool
+from app.models import User
+
+
+def test_pool_refuses_calls_beyond_its_limit():
+    pool = HashPool(workers=1, max_pending=2)
+    release = threading.Event()
+
+    async def scenario():
+        blocked = [asyncio.create_task(pool.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        assert pool.pending == 2
+        with pytest.raises(HashingBusy):
+            await pool.run(release.wait)
+        release.set()
+        await asyncio.gather(*blocked)
+        assert pool.pending == 0
+        assert pwd_context.verify("secret", await pool.hash("secret"))
+
+    asyncio.run(scenario())
+    pool.shutdown()
+
+
+def test_login_rehashes_outdated_parameters(client, session):
+    weak = CryptContext(schemes=["argon2"], argon2__time_cost=1, argon2__memory_cost=1024)
+    user = User(username="old", password_hash=weak.hash("pass"), role="unit")
+    session.add(user)
+    session.commit()
+    assert pwd_context.needs_update(user.password_hash)
+
+    response = client.post("/login", data={"username": "old", "password": "pass"}, follow_redirects=False)
+    assert response.status_code == 303
+
+    session.refresh(user)
+    assert not pwd_context.needs_update(user.password_hash)
+    assert pwd_context.verify("pass", user.password_hash)
+    assert user.token_version == 0  # Same password: the user's other sessions stay valid
+
+
+def test_login_answers_503_when_saturated(client, session, monkeypatch):
+    session.add(User(username="storm", password_hash=pwd_context.hash("pass"), role="unit"))
+    session.commit()
+
+    monkeypatch.setattr(hash_pool, "max_pending", 0)
+    response = client.post("/login", data={"username": "storm", "password": "pass"}, follow_redirects=False)
+    assert response.status_code == 503
+    assert response.headers["retry-after"]
+    assert "riprova" in response.text
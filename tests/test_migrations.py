@@ -0,0 +1,136 @@
+import json
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.database import Base, get_db
+from app.main import app
+from app.migrations import upgrade_schema
+from app.polyline import encode
+
+
+def legacy_engine():
+    """In-memory database with the prenotazioni table as created before the overlap indexes existed."""
+    engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE prenotazioni (id INTEGER PRIMARY KEY, terreno_id INTEGER, unita_id INTEGER, "
+                "start_time DATETIME, end_time DATETIME, duration INTEGER, status VARCHAR)"
+            )
+        )
+    return engine
+
+
+def test_upgrade_adds_missing_indexes():
+    engine = legacy_engine()
+    assert inspect(engine).get_indexes("prenotazioni") == []
+
+    upgrade_schema(engine)
+    indexes = {ix["name"]: ix["column_names"] for ix in inspect(engine).get_indexes("prenotazioni")}
+    assert indexes["ix_prenotazioni_terreno_window"] == ["terreno_id", "start_time", "end_time"]
+    assert indexes["ix_prenotazioni_window"] == ["start_time", "end_time"]
+
+    # Idempotent
+    upgrade_schema(engine)
+    engine.dispose()
+
+
+def test_upgrade_adds_and_backfills_polygon_encoding():
+    engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE terreni (id INTEGER PRIMARY KEY, name VARCHAR, tags VARCHAR, center_lat VARCHAR, "
+                "center_lon VARCHAR, polygon VARCHAR, description VARCHAR, image_urls VARCHAR)"
+            )
+        )
+        conn.execute(text("INSERT INTO terreni VALUES (1, 'Prato', 'SPORT', '0', '0', '[[46.0, 8.0]]', '', '[]')"))
+
+    upgrade_schema(engine)
+    with engine.connect() as conn:
+        encoded = conn.execute(text("SELECT polygon_encoded FROM terreni")).scalar_one()
+    assert json.loads(encoded)["full"] == encode([[46.0, 8.0]])
+    engine.dispose()
+
+
+def test_upgrade_backfills_terreno_tags():
+    engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE terreni (id INTEGER PRIMARY KEY, name VARCHAR, tags VARCHAR, center_lat VARCHAR, "
+                "center_lon VARCHAR, polygon VARCHAR, description VARCHAR, image_urls VARCHAR)"
+            )
+        )
+        conn.execute(text("INSERT INTO terreni VALUES (1, 'Prato', 'SPORT, bivacco', '0', '0', '[]', '', '[]')"))
+
+    upgrade_schema(engine)
+    upgrade_schema(engine)  # Idempotent
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT terreno_id, tag FROM terreno_tags ORDER BY tag")).all()
+    assert [tuple(r) for r in rows] == [(1, "BIVACCO"), (1, "SPORT")]
+    engine.dispose()
+
+
+def test_upgrade_dedupes_completions():
+    engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        # As created before completions were unique
+        conn.execute(text("DROP INDEX uq_completions_pattuglia_challenge"))
+        conn.execute(text("INSERT INTO challenges VALUES (1, 'Nodi', '', 10, 0, 0), (2, 'Fuoco', '', 5, 0, 0)"))
+        # A double click counted Nodi twice
+        conn.execute(text("INSERT INTO pattuglie VALUES (1, 'Aquile', 'Capo', 1, 25)"))
+        conn.execute(
+            text(
+                "INSERT INTO completions VALUES "
+                "(1, 1, 1, '2026-07-25'), (2, 1, 1, '2026-07-25'), (3, 1, 2, '2026-07-25')"
+            )
+        )
+
+    upgrade_schema(engine)
+    upgrade_schema(engine)  # Idempotent
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT id FROM completions ORDER BY id")).scalars().all() == [1, 3]
+        assert conn.execute(text("SELECT current_score FROM pattuglie")).scalar_one() == 15
+    indexes = {ix["name"]: ix for ix in inspect(engine).get_indexes("completions")}
+    assert indexes["uq_completions_pattuglia_challenge"]["unique"]
+    engine.dispose()
+
+
+def test_upgrade_adds_token_version_to_existing_users():
+    engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR NOT NULL, "
+                "password_hash VARCHAR NOT NULL, role VARCHAR NOT NULL, unita_id INTEGER)"
+            )
+        )
+        conn.execute(text("INSERT INTO users (username, password_hash, role) VALUES ('admin', 'x', 'admin')"))
+
+    upgrade_schema(engine)
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT token_version FROM users")).scalar() == 0
+    engine.dispose()
+
+
+def test_startup_upgrades_the_served_database():
+    engine = legacy_engine()
+    session = sessionmaker(bind=engine)()
+
+    def override_get_db():
+        yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        with TestClient(app):
+            indexes = {ix["name"] for ix in inspect(engine).get_indexes("prenotazioni")}
+            assert "ix_prenotazioni_terreno_window" in indexes
+    finally:
+        app.dependency_overrides.clear()
+        session.close()
+        engine.dispose()
@@ -0,0 +1,101 @@
+import threading
+
+from passlib.context import CryptContext
+
+from app.models import Pattuglia, Unita, User
+from app.page_cache import PageCache, get_page_cache
+from tests.test_public import setup_basic_game_data, setup_tech_user
+
+pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+
+
+def test_rerendered_in_the_background_after_a_write(session):
+    cache = PageCache(session.get_bind())
+    renders = []
+
+    def render(db):
+        renders.append(db)
+        return f"v{len(renders)}"
+
+    assert cache.get_or_render(session, "k", render) == "v1"
+    assert cache.get_or_render(session, "k", render) == "v1"
+    assert renders == [session]
+
+    cache.bump()
+    cache.join()
+    assert len(renders) == 2
+    assert renders[1] is not session  # The request's session may be closed by then
+    assert cache.get_or_render(session, "k", render) == "v2"
+    assert len(renders) == 2
+
+
+def test_outdated_page_waits_for_the_render_in_flight(session):
+    cache = PageCache(session.get_bind())
+    started, release = threading.Event(), threading.Event()
+    renders = []
+
+    def render(db):
+        renders.append(db)
+        if len(renders) > 1:
+            started.set()
+            release.wait(5)
+        return f"v{len(renders)}"
+
+    assert cache.get_or_render(session, "k", render) == "v1"
+    cache.bump()
+    assert started.wait(5)
+
+    # A viewer arriving mid-render gets neither the old copy nor a second render
+    seen = []
+    viewer = threading.Thread(target=lambda: seen.append(cache.get_or_render(session, "k", render)))
+    viewer.start()
+    viewer.join(0.1)
+    assert viewer.is_alive()
+    release.set()
+    viewer.join(5)
+    assert seen == ["v2"]
+    assert len(renders) == 2
+
+
+def test_commit_invalidates_rendered_ranking(client, session):
+    session.add(User(username="prog", password_hash=pwd_context.hash("tech"), role="tech"))
+    u = Unita(name="U1", sottocampo="S1")
+    session.add(u)
+    session.commit()
+    client.post("/login", data={"username": "prog", "password": "tech"})
+
+    cache = get_page_cache(session)
+    version = cache.version
+    assert "Newcomers" not in client.get("/").text
+
+    session.add(Pattuglia(name="Newcomers", capo_pattuglia="C", unita_id=u.id))
+    session.commit()
+    assert cache.version > version
+    assert "Newcomers" in client.get("/").text
+
+
+def test_cache_is_keyed_by_role(client, session):
+    session.add(User(username="prog", password_hash=pwd_context.hash("tech"), role="tech"))
+    session.add(User(username="unituser", password_hash=pwd_context.hash("unit"), role="unit"))
+    session.commit()
+
+    client.post("/login", data={"username": "prog", "password": "tech"})
+    assert "/export/ranking" in client.get("/").text
+
+    client.post("/login", data={"username": "unituser", "password": "unit"})
+    response = client.get("/")
+    assert "/export/ranking" not in response.text
+    assert "unituser" in response.text
+
+
+def test_redirect_after_a_completion_shows_it(client, session):
+    setup_tech_user(session)
+    p, c = setup_basic_game_data(session)
+    c.points = 137
+    session.commit()
+    client.post("/login", data={"username": "prog", "password": "tech"})
+    assert "137" not in client.get("/").text
+
+    response = client.post("/complete", data={"pattuglia_id": str(p.id), "challenge_id": str(c.id)})
+    assert response.url.path == "/"
+    assert "137" in response.text
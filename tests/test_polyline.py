@@ -0,0 +1,50 @@
+import json
+
+from app.models import Terreno
+from app.polyline import FULL, decode, encode, encode_variants, level_for_zoom, pixel_degrees, simplify
+
+
+def test_encode_round_trip():
+    # Reference example from the encoded polyline format documentation
+    points = [[38.5, -120.2], [40.7, -120.95], [43.252, -126.453]]
+    assert encode(points) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    assert decode(encode(points)) == points
+
+    ring = [[46.564844468086285, 8.942601489805266], [46.564534901281135, 8.942637294918349]]
+    for original, decoded in zip(ring, decode(encode(ring)), strict=True):
+        assert abs(original[0] - decoded[0]) <= 1e-5
+        assert abs(original[1] - decoded[1]) <= 1e-5
+
+
+def test_simplify_drops_collinear_points():
+    square = [[46.0, 8.0], [46.0, 8.0005], [46.0, 8.001], [46.001, 8.001], [46.001, 8.0], [46.0, 8.0]]
+    assert simplify(square, pixel_degrees(14)) == [square[0], square[2], square[3], square[4], square[5]]
+    # A tolerance larger than the polygon never collapses it below a ring
+    assert len(simplify(square, 1.0)) >= 4
+    assert simplify(square, 0) == square
+
+
+def test_variants_and_zoom_levels():
+    encoded = encode_variants("[[46.0, 8.0], [46.0, 8.001], [46.001, 8.001], [46.0, 8.0]]")
+    assert encoded is not None
+    assert set(json.loads(encoded)) == {"12", "14", "16", FULL}
+    assert encode_variants("not json") is None
+
+    assert level_for_zoom(None) == FULL
+    assert level_for_zoom(18) == FULL
+    assert level_for_zoom(16) == "16"
+    assert level_for_zoom(15) == "14"
+    assert level_for_zoom(3) == "12"
+
+
+def test_terreno_keeps_encoding_in_sync(session):
+    t = Terreno(name="Prato", tags="SPORT", center_lat="0", center_lon="0", polygon="[[46.0, 8.0], [46.1, 8.1]]")
+    session.add(t)
+    session.commit()
+    assert t.polygon_encoded is not None
+    assert decode(json.loads(t.polygon_encoded)[FULL]) == [[46.0, 8.0], [46.1, 8.1]]
+
+    t.polygon = "[[45.0, 7.0], [45.1, 7.1]]"
+    session.commit()
+    assert t.polygon_encoded is not None
+    assert decode(json.loads(t.polygon_encoded)[FULL]) == [[45.0, 7.0], [45.1, 7.1]]
@@ -0,0 +1,46 @@
+import io
+
+from app.auth import pwd_context
+from app.models import Unita, User
+from app.provisioning import PASSWORD_ALPHABET, provision_unit_users
+
+
+def _credentials(sheet: str) -> dict[str, str]:
+    lines = sheet.splitlines()
+    return {
+        line.removeprefix("Username: "): lines[i + 1].removeprefix("Password: ")
+        for i, line in enumerate(lines)
+        if line.startswith("Username: ")
+    }
+
+
+def test_provision_unit_users(session):
+    session.add_all([Unita(name="Reparto Aquile", sottocampo="Alpino"), Unita(name="Lupi 1", sottocampo="Montano")])
+    session.add(User(username="admin", password_hash="x", role="admin"))
+    session.commit()
+
+    sheet = io.StringIO()
+    result = provision_unit_users(session, sheet, workers=2)
+    assert sorted(result.created) == ["lupi1", "repartoaquile"]
+    assert result.skipped == []
+
+    credentials = _credentials(sheet.getvalue())
+    assert credentials.keys() == {"lupi1", "repartoaquile"}
+    assert credentials["lupi1"] != credentials["repartoaquile"]
+    for username, password in credentials.items():
+        assert set(password) <= set(PASSWORD_ALPHABET)
+        user = session.query(User).filter(User.username == username).one()
+        assert user.role == "unit" and user.unita is not None
+        assert pwd_context.verify(password, user.password_hash)
+
+    # A re-run only touches the units added since; a username clash is reported, not overwritten
+    session.add_all([Unita(name="Volpi", sottocampo="Alpino"), Unita(name="LUPI-1", sottocampo="Alpino")])
+    session.commit()
+    sheet = io.StringIO()
+    result = provision_unit_users(session, sheet, workers=1)
+    assert result.created == ["volpi"]
+    assert result.skipped == ["LUPI-1"]
+    assert _credentials(sheet.getvalue()).keys() == {"volpi"}
+    assert session.query(User).filter(User.role == "unit").count() == 3
+
+    assert provision_unit_users(session, io.StringIO()).created == []
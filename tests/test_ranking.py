@@ -0,0 +1,123 @@
+from sqlalchemy.orm import sessionmaker
+
+from app.completions import register_completion
+from app.models import Challenge, Pattuglia, Unita
+from app.ranking import RankingIndex, get_ranking_index
+
+
+def setup_units(session):
+    nord = Unita(name="U_Nord", sottocampo="Nord")
+    sud = Unita(name="U_Sud", sottocampo="Sud")
+    session.add_all([nord, sud])
+    session.commit()
+    return nord, sud
+
+
+def test_tie_aware_ranks():
+    index = RankingIndex()
+    index.upsert_unita(1, "U1", "Nord")
+    index.upsert_pattuglia(1, "A", "CA", 1, 50)
+    index.upsert_pattuglia(2, "B", "CB", 1, 80)
+    index.upsert_pattuglia(3, "C", "CC", 1, 50)
+    index.upsert_pattuglia(4, "D", "CD", 1, 10)
+
+    ranking = index.ranking()
+    assert [p.name for p in ranking] == ["B", "A", "C", "D"]
+    assert [p.rank for p in ranking] == [1, 2, 2, 4]
+    assert index.rank_of(3) == 2
+    assert index.rank_of(4) == 4
+
+    # A pattuglia whose unit is not known is neither listed nor counted
+    index.upsert_pattuglia(5, "E", "CE", 99, 90)
+    ranking = index.ranking()
+    assert [p.name for p in ranking] == ["B", "A", "C", "D"]
+    assert [p.rank for p in ranking] == [1, 2, 2, 4]
+
+
+def test_partitions_follow_unit_changes():
+    index = RankingIndex()
+    index.upsert_unita(1, "U1", "Nord")
+    index.upsert_unita(2, "U2", "Sud")
+    index.upsert_pattuglia(1, "A", "CA", 1, 10)
+    index.upsert_pattuglia(2, "B", "CB", 2, 20)
+
+    assert [p.name for p in index.ranking("Nord")] == ["A"]
+    assert index.rank_of(2, "Sud") == 1
+
+    # Moving the pattuglia to another unit moves it to the other partition
+    index.upsert_pattuglia(1, "A", "CA", 2, 10)
+    assert index.ranking("Nord") == []
+    assert [p.name for p in index.ranking("Sud")] == ["B", "A"]
+
+    # Changing a unit's sottocampo repartitions its pattuglie
+    index.upsert_unita(2, "U2", "Nord")
+    assert [p.name for p in index.ranking("Nord")] == ["B", "A"]
+    assert index.sottocampi() == ["Nord"]
+
+    index.remove_pattuglia(2)
+    assert [p.name for p in index.ranking()] == ["A"]
+
+
+def test_index_follows_committed_changes(session):
+    nord, sud = setup_units(session)
+    p1 = Pattuglia(name="P1", capo_pattuglia="C1", unita_id=nord.id, current_score=10)
+    session.add(p1)
+    session.commit()
+
+    index = get_ranking_index(session)
+    assert [p.name for p in index.ranking()] == ["P1"]
+
+    # New pattuglia and score change in the same commit
+    p2 = Pattuglia(name="P2", capo_pattuglia="C2", unita_id=sud.id, current_score=5)
+    session.add(p2)
+    p1.current_score = 1
+    session.commit()
+    assert [(p.name, p.current_score) for p in index.ranking()] == [("P2", 5), ("P1", 1)]
+    assert [p.name for p in index.ranking("Sud")] == ["P2"]
+
+    # Rolled back changes never reach the index
+    p2.current_score = 100
+    session.flush()
+    session.rollback()
+    assert index.ranking()[0].current_score == 5
+
+    session.delete(p2)
+    session.commit()
+    assert [p.name for p in index.ranking()] == ["P1"]
+    assert index.ranking("Sud") == []
+
+
+def test_ranking_page_served_from_index(client, session):
+    from tests.test_public import setup_basic_game_data, setup_tech_user
+
+    setup_tech_user(session)
+    client.post("/login", data={"username": "prog", "password": "tech"})
+    p, c = setup_basic_game_data(session)
+
+    client.post("/complete", data={"pattuglia_id": str(p.id), "challenge_id": str(c.id)})
+
+    ranking = get_ranking_index(session).ranking()
+    assert ranking[0].current_score == 100
+    response = client.get("/")
+    assert response.status_code == 200
+    assert "P1" in response.text
+
+
+def test_stale_orm_score_does_not_overwrite_an_increment(session):
+    nord, _ = setup_units(session)
+    p = Pattuglia(name="P1", capo_pattuglia="C1", unita_id=nord.id, current_score=0)
+    c = Challenge(name="Sfida", description="", points=100)
+    session.add_all([p, c])
+    session.commit()
+    index = get_ranking_index(session)
+
+    # An admin edit loads the pattuglia, a completion lands, then the edit commits other fields
+    admin_session = sessionmaker(bind=session.get_bind())()
+    edited = admin_session.get(Pattuglia, p.id)
+    assert edited is not None
+    register_completion(session, p.id, c.id)
+    edited.name = "Renamed"
+    admin_session.commit()
+    admin_session.close()
+
+    assert [(r.name, r.current_score) for r in index.ranking()] == [("Renamed", 100)]
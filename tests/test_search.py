@@ -0,0 +1,78 @@
+from datetime import date, datetime
+
+from app.availability import Reservation, ReservationIndex
+from app.models import Prenotazione, Terreno, Unita, User
+from app.search import find_free_slots, free_runs
+
+DAY = date(2026, 7, 25)
+TERRENI = [(1, "Bosco"), (2, "Radura"), (3, "Campo")]
+
+
+def test_free_runs():
+    assert list(free_runs(0b0111_0011_1000)) == [(3, 3), (8, 3)]
+    assert list(free_runs(0)) == []
+
+
+def test_find_free_slots_ranks_by_start_then_snug_fit():
+    index = ReservationIndex()
+    # Bosco is busy 8:00-12:00 and 14:00-24:00 (2h gap from 12:00); Radura 8:00-11:00 and 16:00-24:00
+    index.upsert(Reservation(1, 1, 1, datetime(2026, 7, 25, 8), datetime(2026, 7, 25, 12), "APPROVED"))
+    index.upsert(Reservation(2, 1, 1, datetime(2026, 7, 25, 14), datetime(2026, 7, 26), "APPROVED"))
+    index.upsert(Reservation(3, 2, 1, datetime(2026, 7, 25, 8), datetime(2026, 7, 25, 11), "APPROVED"))
+    index.upsert(Reservation(4, 2, 1, datetime(2026, 7, 25, 16), datetime(2026, 7, 26), "APPROVED"))
+
+    slots = find_free_slots(index, TERRENI[:2], 2, DAY, DAY, earliest_hour=8)
+    assert [(s.terreno_name, s.start.hour, s.latest_start.hour) for s in slots] == [
+        ("Radura", 11, 14),
+        ("Bosco", 12, 12),
+    ]
+
+    # Multi-day range and hour window
+    slots = find_free_slots(index, TERRENI[1:2], 4, DAY, date(2026, 7, 26), 20, 24)
+    assert [(s.terreno_name, s.start) for s in slots] == [("Radura", datetime(2026, 7, 26, 20))]
+    assert find_free_slots(index, TERRENI, 4, DAY, DAY, 22, 24) == []
+
+
+def test_free_slots_endpoint(client, session):
+    user = User(username="unit", password_hash="hash", role="unit")
+    t = Terreno(name="Bosco", tags="BIVACCO", center_lat="0", center_lon="0", polygon="[]")
+    u = Unita(name="U", sottocampo="S")
+    session.add_all([user, t, u])
+    session.commit()
+    session.add(
+        Prenotazione(
+            terreno_id=t.id,
+            unita_id=u.id,
+            start_time=datetime(2026, 7, 25, 9),
+            end_time=datetime(2026, 7, 25, 20),
+            duration=4,
+        )
+    )
+    session.commit()
+
+    from app.auth import get_authenticated_user
+    from app.main import app
+
+    app.dependency_overrides[get_authenticated_user] = lambda: user
+    params = {
+        "tags": "bivacco",
+        "duration": 3,
+        "start_date": "2026-07-25",
+        "end_date": "2026-07-25",
+        "earliest_hour": 8,
+    }
+    response = client.get("/api/terreni/free-slots", params=params)
+    assert response.status_code == 200
+    assert response.json() == [
+        {
+            "terreno_id": t.id,
+            "terreno_name": "Bosco",
+            "start": "2026-07-25T20:00:00",
+            "end": "2026-07-25T23:00:00",
+            "latest_start": "2026-07-25T21:00:00",
+            "gap_minutes": 240,
+        }
+    ]
+    assert client.get("/api/terreni/free-slots", params={**params, "tags": "PISCINA"}).status_code == 400
+    assert client.get("/api/terreni/free-slots", params={**params, "duration": 5}).status_code == 400
+    app.dependency_overrides = {}
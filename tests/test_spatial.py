@@ -0,0 +1,87 @@
+import json
+import random
+
+from app.models import Terreno, TerrenoCategoria, User
+from app.spatial import BBox, Shape, SpatialIndex, get_spatial_index
+
+
+def square(shape_id: int, lat: float, lon: float, size: float = 0.001, tags: str = "SPORT") -> Shape:
+    ring = ((lat, lon), (lat, lon + size), (lat + size, lon + size), (lat + size, lon))
+    return Shape(shape_id, f"T{shape_id}", frozenset(TerrenoCategoria.split(tags)), ring, BBox.around(list(ring)))
+
+
+def grid_index() -> SpatialIndex:
+    # 10 x 10 squares, 0.002 degrees apart, every third one tagged NOTTURNO
+    shapes = [
+        square(
+            i * 10 + j, 46.0 + i * 0.002, 8.0 + j * 0.002, tags="SPORT,NOTTURNO" if (i * 10 + j) % 3 == 0 else "SPORT"
+        )
+        for i in range(10)
+        for j in range(10)
+    ]
+    return SpatialIndex(shapes, node_capacity=4)
+
+
+def test_point_lookup():
+    index = grid_index()
+    assert [s.id for s in index.containing(46.0105, 8.0045)] == [52]
+    assert index.containing(46.0115, 8.0045) == []  # In the gap between squares
+    assert index.containing(47.0, 9.0) == []
+
+
+def test_bbox_matches_brute_force():
+    index = grid_index()
+    rng = random.Random(1)
+    for _ in range(50):
+        lat, lon = 46.0 + rng.random() * 0.02, 8.0 + rng.random() * 0.02
+        box = BBox(lat, lon, lat + rng.random() * 0.005, lon + rng.random() * 0.005)
+        expected = sorted(s.id for s in index.shapes.values() if s.bbox.intersects(box))
+        assert [s.id for s in index.intersecting(box)] == expected
+
+
+def test_nearest_with_tags():
+    index = grid_index()
+    rng = random.Random(2)
+    wanted = frozenset({"NOTTURNO"})
+    for _ in range(20):
+        lat, lon = 46.0 + rng.random() * 0.02, 8.0 + rng.random() * 0.02
+        found = index.nearest(lat, lon, 3, wanted)
+        expected = sorted(s.distance_m(lat, lon) for s in index.shapes.values() if wanted <= s.tags)[:3]
+        assert [round(d, 6) for _, d in found] == [round(d, 6) for d in expected]
+        assert all("NOTTURNO" in s.tags for s, _ in found)
+
+    assert SpatialIndex([]).nearest(46.0, 8.0, 3) == []
+
+
+def test_spatial_endpoints(client, session):
+    user = User(username="staff", password_hash="hash", role="unit")
+    polygon = json.dumps([[46.0, 8.0], [46.0, 8.001], [46.001, 8.001], [46.001, 8.0], [46.0, 8.0]])
+    t = Terreno(name="Prato", tags="SPORT", center_lat="46.0005", center_lon="8.0005", polygon=polygon)
+    session.add_all([user, t])
+    session.commit()
+
+    from app.auth import get_authenticated_user
+    from app.main import app
+
+    app.dependency_overrides[get_authenticated_user] = lambda: user
+
+    assert [r["name"] for r in client.get("/api/terreni/at", params={"lat": 46.0005, "lon": 8.0005}).json()] == [
+        "Prato"
+    ]
+    box = {"min_lat": 45.9, "min_lon": 7.9, "max_lat": 46.0001, "max_lon": 8.0001}
+    assert client.get("/api/terreni/in-bbox", params=box).json()[0]["bbox"] == [46.0, 8.0, 46.001, 8.001]
+    assert client.get("/api/terreni/in-bbox", params={**box, "min_lat": 47}).status_code == 400
+
+    nearest = client.get("/api/terreni/nearest", params={"lat": 46.002, "lon": 8.0005, "tags": "sport"}).json()
+    assert nearest[0]["id"] == t.id
+    assert 100 < nearest[0]["distance_m"] < 120
+    assert client.get("/api/terreni/nearest", params={"lat": 46, "lon": 8, "tags": "BIVACCO"}).json() == []
+
+    # Moving the polygon rebuilds the index
+    index = get_spatial_index(session)
+    t.polygon = json.dumps([[45.0, 7.0], [45.0, 7.001], [45.001, 7.001]])
+    session.commit()
+    assert get_spatial_index(session) is not index
+    assert client.get("/api/terreni/at", params={"lat": 46.0005, "lon": 8.0005}).json() == []
+
+    app.dependency_overrides = {}
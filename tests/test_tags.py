@@ -0,0 +1,54 @@
+from passlib.context import CryptContext
+
+from app.models import Terreno, TerrenoTag, User
+from app.tags import filter_by_tags, terreno_ids_with_tags
+
+pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+
+
+def terreno(name: str, tags: str) -> Terreno:
+    return Terreno(name=name, tags=tags, center_lat="0", center_lon="0", polygon="[]")
+
+
+def test_tag_rows_follow_terreno_tags(session):
+    t = terreno("Prato", " sport, Bivacco,SPORT ")
+    session.add(t)
+    session.commit()
+    assert t.tags == "SPORT,BIVACCO"
+    assert sorted(link.tag for link in session.query(TerrenoTag)) == ["BIVACCO", "SPORT"]
+
+    t.tags = "BIVACCO,NOTTURNO"
+    session.commit()
+    assert sorted(link.tag for link in session.query(TerrenoTag)) == ["BIVACCO", "NOTTURNO"]
+
+    session.delete(t)
+    session.commit()
+    assert session.query(TerrenoTag).count() == 0
+
+
+def test_filter_by_tags(session):
+    a, b, c = terreno("A", "SPORT"), terreno("B", "SPORT,NOTTURNO"), terreno("C", "BIVACCO")
+    session.add_all([a, b, c])
+    session.commit()
+
+    assert terreno_ids_with_tags(session, ["SPORT"]) == {a.id, b.id}
+    assert terreno_ids_with_tags(session, ["SPORT", "NOTTURNO"]) == {b.id}
+    assert terreno_ids_with_tags(session, ["CERIMONIA"]) == set()
+    assert [t.name for t in filter_by_tags(session.query(Terreno), ["BIVACCO"])] == ["C"]
+    assert filter_by_tags(session.query(Terreno), []).count() == 3
+
+
+def test_endpoints_filter_by_tag(client, session):
+    session.add_all([terreno("Campo", "SPORT"), terreno("Bosco", "BIVACCO,NOTTURNO")])
+    session.add(User(username="admin", password_hash=pwd_context.hash("admin"), role="admin"))
+    session.commit()
+    client.post("/login", data={"username": "admin", "password": "admin"})
+
+    params = {"start_date": "2026-07-25T00:00:00", "end_date": "2026-07-26T00:00:00", "tags": "notturno"}
+    bosco = session.query(Terreno).filter(Terreno.name == "Bosco").one()
+    assert [t["id"] for t in client.get("/api/terreni/availability", params=params).json()] == [bosco.id]
+
+    response = client.get("/admin/terreni", params={"tag": "SPORT"})
+    assert response.status_code == 200
+    assert "Campo" in response.text
+    assert "Bosco" not in response.text
@@ -1,9 +1,11 @@
 from datetime import datetime, timedelta
 
+from sqlalchemy import event
 from sqlalchemy.orm import Session
 
 from app.main import app
 from app.models import Prenotazione, Terreno, Unita, User
+from app.polyline import encode
 
 # Note: completion_status might not be in models, just checking imports.
 # Actually completion_status is not a model.
@@ -102,3 +104,151 @@ def test_api_availability(client, session: Session):
 
     # Cleanup
     app.dependency_overrides = {}
+
+
+def count_queries(session: Session):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(session.get_bind(), "before_cursor_execute", before_cursor_execute)
+    return statements
+
+
+def test_geometry_endpoint(client, session: Session):
+    user = User(username="geouser", password_hash="hash", role="unit")
+    t = Terreno(name="Bosco", tags="A", center_lat="1", center_lon="2", polygon="[[1, 2]]", description="Ombra")
+    session.add_all([user, t])
+    session.commit()
+
+    from app.auth import get_authenticated_user
+
+    app.dependency_overrides[get_authenticated_user] = lambda: user
+
+    response = client.get("/api/terreni/geometry")
+    assert response.status_code == 200
+    assert response.json() == [
+        {
+            "id": t.id,
+            "name": "Bosco",
+            "tags": "A",
+            "polygon": "[[1, 2]]",
+            "center_lat": "1",
+            "center_lon": "2",
+            "description": "Ombra",
+            "image_urls": "[]",
+        }
+    ]
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "private, no-cache"
+
+    # The hash in the URL makes it cacheable for good
+    version = etag.strip('"')
+    response = client.get("/api/terreni/geometry", params={"v": version})
+    assert "immutable" in response.headers["cache-control"]
+
+    assert client.get("/api/terreni/geometry", headers={"If-None-Match": etag}).status_code == 304
+
+    # Availability no longer carries the static data
+    params = {"start_date": "2026-07-25T00:00:00", "end_date": "2026-07-26T00:00:00"}
+    assert client.get("/api/terreni/availability", params=params).json() == [
+        {"id": t.id, "status": "FREE", "reservations": []}
+    ]
+
+    # Encoded polylines for a zoom level, versioned separately
+    response = client.get("/api/terreni/geometry", params={"zoom": 13})
+    assert response.json()[0]["path"] == encode([[1, 2]])
+    assert "polygon" not in response.json()[0]
+    assert response.headers["etag"] == f'"{version}-12"'
+
+    # Editing a terreno changes the version
+    t.description = "Sole"
+    session.commit()
+    response = client.get("/api/terreni/geometry", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.json()[0]["description"] == "Sole"
+
+    app.dependency_overrides = {}
+
+
+def test_api_availability_query_count(client, session: Session):
+    u = Unita(name="QueryUnit", sottocampo="Test")
+    user = User(username="queryuser", password_hash="hash", role="unit")
+    session.add_all([u, user])
+    session.commit()
+    unit_id = u.id
+
+    from app.auth import get_authenticated_user
+
+    app.dependency_overrides[get_authenticated_user] = lambda: user
+    params = {"start_date": "2026-07-25T00:00:00", "end_date": "2026-07-26T00:00:00"}
+
+    def add_terreni(count):
+        for _ in range(count):
+            t = Terreno(
+                name=f"T{session.query(Terreno).count()}", tags="SPORT", center_lat="0", center_lon="0", polygon="[]"
+            )
+            session.add(t)
+            session.flush()
+            session.add(
+                Prenotazione(
+                    terreno_id=t.id,
+                    unita_id=unit_id,
+                    start_time=datetime(2026, 7, 25, 10),
+                    end_time=datetime(2026, 7, 25, 12),
+                    duration=2,
+                )
+            )
+        session.commit()
+        session.expunge_all()  # Force the endpoint to load units itself
+
+    add_terreni(1)
+    client.get("/api/terreni/availability", params=params)  # Builds the reservation index
+    statements = count_queries(session)
+    response = client.get("/api/terreni/availability", params=params)
+    few = len(statements)
+    assert response.status_code == 200
+    assert all(t["reservations"][0]["unit_name"] == "QueryUnit" for t in response.json())
+
+    add_terreni(9)
+    statements.clear()
+    response = client.get("/api/terreni/availability", params=params)
+    assert len(response.json()) == 10
+    # Only the geometry catalog is reloaded after the terreni changed, whatever their number
+    assert len(statements) == few + 1
+
+    app.dependency_overrides = {}
+
+
+def test_status_endpoint(client, session: Session):
+    user = User(username="statususer", password_hash="hash", role="unit")
+    u = Unita(name="StatusUnit", sottocampo="Test")
+    busy = Terreno(name="Busy", tags="SPORT", center_lat="0", center_lon="0", polygon="[]")
+    free = Terreno(name="Free", tags="BIVACCO", center_lat="0", center_lon="0", polygon="[]")
+    session.add_all([user, u, busy, free])
+    session.commit()
+    session.add(
+        Prenotazione(
+            terreno_id=busy.id,
+            unita_id=u.id,
+            start_time=datetime(2026, 7, 25, 14),
+            end_time=datetime(2026, 7, 25, 16),
+            duration=2,
+        )
+    )
+    session.commit()
+
+    from app.auth import get_authenticated_user
+
+    app.dependency_overrides[get_authenticated_user] = lambda: user
+    params = {"start_date": "2026-07-25T14:00:00", "end_date": "2026-07-25T18:00:00"}
+    response = client.get("/api/terreni/status", params=params)
+    assert response.json() == {str(busy.id): "PARTIAL", str(free.id): "FREE"}
+    assert "x-reservations-version" in response.headers
+
+    params = {"start_date": "2026-07-25T14:00:00", "end_date": "2026-07-25T16:00:00", "tags": "SPORT"}
+    assert client.get("/api/terreni/status", params=params).json() == {str(busy.id): "BOOKED"}
+
+    app.dependency_overrides = {}
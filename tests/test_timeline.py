@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+from app.models import Challenge, Completion, Pattuglia, Unita
+from app.timeline import Cursor, TimelineFilter, timeline_page
+from tests.test_public import setup_tech_user
+
+
+def setup_timeline(session):
+    """Two units in different sottocampi, 3 pattuglie x 4 challenges, some completions sharing a timestamp."""
+    alpha = Unita(name="Alpha", sottocampo="Alpino")
+    beta = Unita(name="Beta", sottocampo="Montano")
+    session.add_all([alpha, beta])
+    session.flush()
+    pattuglie = [
+        Pattuglia(name="Aquile", capo_pattuglia="C", unita_id=alpha.id),
+        Pattuglia(name="Lupi", capo_pattuglia="C", unita_id=alpha.id),
+        Pattuglia(name="Orsi", capo_pattuglia="C", unita_id=beta.id),
+    ]
+    challenges = [Challenge(name=f"Sfida {i}", description="", points=10) for i in range(4)]
+    session.add_all([*pattuglie, *challenges])
+    session.flush()
+
+    start = datetime(2026, 7, 25, 10, 0)
+    for i, (p, c) in enumerate((p, c) for p in pattuglie for c in challenges):
+        session.add(Completion(pattuglia_id=p.id, challenge_id=c.id, timestamp=start + timedelta(minutes=i // 2)))
+    session.commit()
+    return alpha, pattuglie, challenges
+
+
+def _walk(session, filters=TimelineFilter(), limit=5):
+    """Every completion id, following the cursors page after page."""
+    ids, cursor = [], None
+    while True:
+        page = timeline_page(session, filters, cursor, limit=limit)
+        assert len(page.completions) <= limit
+        ids += [c.id for c in page.completions]
+        if page.next_cursor is None:
+            return ids
+        cursor = Cursor.decode(page.next_cursor.encode())
+
+
+def test_pages_cover_every_completion_once(session):
+    setup_timeline(session)
+    expected = [c.id for c in session.query(Completion).order_by(Completion.timestamp.desc(), Completion.id.desc())]
+    assert len(expected) == 12
+
+    for limit in (1, 5, 12, 50):
+        assert _walk(session, limit=limit) == expected
+
+    # A completion registered while scrolling doesn't shift the rows of the next pages
+    first = timeline_page(session, limit=5)
+    session.add(Completion(pattuglia_id=1, challenge_id=1, timestamp=datetime(2026, 7, 25, 12, 0)))
+    second = timeline_page(session, cursor=first.next_cursor, limit=5)
+    assert [c.id for c in first.completions + second.completions] == expected[:10]
+
+
+def test_filters(session):
+    alpha, pattuglie, challenges = setup_timeline(session)
+
+    def pairs(filters):
+        by_id = {c.id: c for c in session.query(Completion)}
+        return {(by_id[i].pattuglia_id, by_id[i].challenge_id) for i in _walk(session, filters, limit=2)}
+
+    assert pairs(TimelineFilter(pattuglia_id=pattuglie[0].id)) == {(pattuglie[0].id, c.id) for c in challenges}
+    assert pairs(TimelineFilter(challenge_id=challenges[1].id)) == {(p.id, challenges[1].id) for p in pattuglie}
+    assert pairs(TimelineFilter(unita_id=alpha.id)) == {(p.id, c.id) for p in pattuglie[:2] for c in challenges}
+    assert pairs(TimelineFilter(sottocampo="Montano")) == {(pattuglie[2].id, c.id) for c in challenges}
+    assert pairs(TimelineFilter(unita_id=alpha.id, challenge_id=challenges[0].id)) == {
+        (p.id, challenges[0].id) for p in pattuglie[:2]
+    }
+    assert pairs(TimelineFilter(sottocampo="Collinare")) == set()
+
+
+def test_timeline_routes(client, session):
+    setup_tech_user(session)
+    alpha, _, _ = setup_timeline(session)
+    client.post("/login", data={"username": "prog", "password": "tech"})
+
+    response = client.get("/timeline")
+    assert response.status_code == 200
+    assert response.text.count("<li data-completion-id=") == 12
+    assert 'hx-trigger="revealed"' not in response.text
+
+    response = client.get("/timeline", params={"unita_id": alpha.id, "sottocampo": "", "pattuglia_id": ""})
+    assert response.status_code == 200
+    assert response.text.count("<li data-completion-id=") == 8
+
+    last = session.query(Completion).order_by(Completion.timestamp, Completion.id).first()
+    cursor = Cursor(last.timestamp, last.id + 1).encode()
+    response = client.get("/timeline/rows", params={"cursor": cursor})
+    assert response.status_code == 200
+    assert response.text.count("<li data-completion-id=") == 1
+
+    response = client.get("/timeline/rows", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
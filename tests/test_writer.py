@@ -0,0 +1,109 @@
+import asyncio
+from datetime import datetime
+from functools import partial
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import writer
+from app.availability import get_reservation_index
+from app.booking import BookingConflict, apply_booking
+from app.completions import CompletionRejected, Registered, apply_completion
+from app.database import Base
+from app.models import Challenge, Completion, Pattuglia, Prenotazione, Terreno, Unita, User
+from app.writer import GroupCommitWriter
+from tests.test_public import pwd_context, setup_basic_game_data
+
+
+@pytest.fixture(name="file_sessions")
+def file_sessions_fixture(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'group.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+def test_group_commit_answers_each_caller(file_sessions):
+    with file_sessions() as session:
+        u = Unita(name="U", sottocampo="S")
+        session.add(u)
+        session.flush()
+        p = Pattuglia(name="P", capo_pattuglia="C", unita_id=u.id, current_score=0)
+        challenges = [Challenge(name=f"C{i}", description="", points=10) for i in range(5)]
+        t = Terreno(name="Bosco", tags="SPORT", center_lat="0", center_lon="0", polygon="[]")
+        session.add_all([p, t, *challenges])
+        session.commit()
+        pattuglia_id, unita_id, terreno_id = p.id, u.id, t.id
+        challenge_ids = [c.id for c in challenges]
+        get_reservation_index(session)
+
+    async def scenario():
+        group_writer = GroupCommitWriter(file_sessions.kw["bind"], window_ms=50)
+        mutations = [partial(apply_completion, pattuglia_id=pattuglia_id, challenge_id=cid) for cid in challenge_ids]
+        mutations.append(partial(apply_completion, pattuglia_id=pattuglia_id, challenge_id=challenge_ids[0]))
+        start = datetime(2026, 7, 25, 14)
+        mutations += [
+            partial(apply_booking, terreno_id=terreno_id, unita_id=unita_id, start=start, duration=2),
+            partial(apply_booking, terreno_id=terreno_id, unita_id=unita_id, start=start, duration=1),
+        ]
+        results = await asyncio.gather(*(group_writer.submit(m) for m in mutations), return_exceptions=True)
+        groups = group_writer.groups
+        await group_writer.stop()
+        return results, groups
+
+    results, groups = asyncio.run(scenario())
+    assert groups == 1  # One transaction, one fsync for the whole burst
+    assert [r.score for r in results[:5] if isinstance(r, Registered)] == [10, 20, 30, 40, 50]
+    assert isinstance(results[5], CompletionRejected) and results[5].reason == "already_completed"
+    assert isinstance(results[6], Prenotazione)
+    assert isinstance(results[7], BookingConflict) and results[7].reason == "terreno_booked"
+
+    with file_sessions() as session:
+        assert session.get(Pattuglia, pattuglia_id).current_score == 50
+        assert session.query(Completion).count() == 5
+        assert session.query(Prenotazione).count() == 1
+        # Index updates of the group were applied on commit
+        booked = get_reservation_index(session).overlapping(terreno_id, datetime(2026, 7, 25), datetime(2026, 7, 26))
+        assert [r.id for r in booked] == [results[6].id]
+
+
+def test_failing_mutation_does_not_fail_the_group(file_sessions):
+    with file_sessions() as session:
+        p, c = setup_basic_game_data(session)
+        pattuglia_id, challenge_id = p.id, c.id
+
+    def broken(db):
+        raise RuntimeError("boom")
+
+    async def scenario():
+        group_writer = GroupCommitWriter(file_sessions.kw["bind"], window_ms=50)
+        ok = partial(apply_completion, pattuglia_id=pattuglia_id, challenge_id=challenge_id)
+        results = await asyncio.gather(group_writer.submit(ok), group_writer.submit(broken), return_exceptions=True)
+        await group_writer.stop()
+        return results
+
+    registered, error = asyncio.run(scenario())
+    assert isinstance(registered, Registered) and registered.score == 100
+    assert isinstance(error, RuntimeError)
+    with file_sessions() as session:
+        assert session.get(Pattuglia, pattuglia_id).current_score == 100
+
+
+def test_routes_through_group_writer(client, session, monkeypatch):
+    monkeypatch.setattr(writer, "GROUP_COMMIT", True)
+    session.add(User(username="admin", password_hash=pwd_context.hash("admin"), role="admin"))
+    session.commit()
+    client.post("/login", data={"username": "admin", "password": "admin"})
+    p, c = setup_basic_game_data(session)
+
+    response = client.post("/complete", data={"pattuglia_id": p.id, "challenge_id": c.id}, follow_redirects=False)
+    assert response.headers["location"] == "/"
+    response = client.post("/complete", data={"pattuglia_id": p.id, "challenge_id": c.id}, follow_redirects=False)
+    assert "error=already_completed" in response.headers["location"]
+
+    completion = session.query(Completion).one()
+    client.post(f"/admin/rollback/{completion.id}")
+    session.expire_all()
+    assert session.query(Completion).count() == 0
+    assert session.get(Pattuglia, p.id).current_score == 0